@@ -1,8 +1,7 @@
 import shakedown
 
-import sdk_plan as plan
 import sdk_utils as utils
-import sdk_tasks as tasks
+import sdk_wait
 
 PACKAGE_NAME = 'hdfs'
 FOLDERED_SERVICE_NAME = utils.get_foldered_name(PACKAGE_NAME)
@@ -84,6 +83,9 @@ def find_java_home(host):
 
 
 def check_healthy(count=DEFAULT_TASK_COUNT):
-    plan.wait_for_completed_deployment(PACKAGE_NAME, timeout_seconds=25 * 60)
-    plan.wait_for_completed_recovery(PACKAGE_NAME, timeout_seconds=25 * 60)
-    tasks.check_running(PACKAGE_NAME, count)
+    sdk_wait.wait_for_all([
+        sdk_wait.plan_status(PACKAGE_NAME, 'deploy', 'COMPLETE'),
+        sdk_wait.plan_status(PACKAGE_NAME, 'recovery', 'COMPLETE'),
+        sdk_wait.tasks_running(PACKAGE_NAME, count)],
+        # the total of the deploy, recovery and running task waits, when they ran one after another
+        timeout_seconds=(25 + 25 + 15) * 60)
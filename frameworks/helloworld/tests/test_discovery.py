@@ -4,34 +4,39 @@ import shakedown
 
 import sdk_install as install
 import sdk_plan as plan
+import sdk_utils
 
 from tests.config import (
     PACKAGE_NAME
 )
+FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+# Installs its own foldered service, so run_tests.py may run it in parallel with other such modules
+SHARDABLE = True
 
 
 def setup_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
     options = {
         "service": {
+            "name": FOLDERED_SERVICE_NAME,
             "spec_file": "examples/discovery.yml"
         }
     }
 
-    install.install(PACKAGE_NAME, 1, additional_options=options)
+    install.install(PACKAGE_NAME, 1, service_name=FOLDERED_SERVICE_NAME, additional_options=options)
 
 
 def teardown_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
 
 
 @pytest.mark.sanity
 def test_task_dns_prefix_points_to_all_tasks():
     pod_info = dcos.http.get(
-        shakedown.dcos_service_url(PACKAGE_NAME) +
+        shakedown.dcos_service_url(FOLDERED_SERVICE_NAME) +
         "/v1/pods/{}/info".format("hello-0")).json()
 
     # Assert that DiscoveryInfo is correctly set on tasks.
     assert(all(p["info"]["discovery"]["name"] == "hello-0" for p in pod_info))
     # Assert that the hello-0.hello-world.mesos DNS entry points to the right IP.
-    plan.wait_for_completed_deployment(PACKAGE_NAME)
+    plan.wait_for_completed_deployment(FOLDERED_SERVICE_NAME)
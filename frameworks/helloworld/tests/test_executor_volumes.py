@@ -8,27 +8,31 @@ import sdk_utils
 from tests.config import (
     PACKAGE_NAME
 )
+FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+# Installs its own foldered service, so run_tests.py may run it in parallel with other such modules
+SHARDABLE = True
 
 
 def setup_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
     options = {
         "service": {
+            "name": FOLDERED_SERVICE_NAME,
             "spec_file": "examples/executor_volume.yml"
         }
     }
 
-    install.install(PACKAGE_NAME, 3, additional_options=options)
+    install.install(PACKAGE_NAME, 3, service_name=FOLDERED_SERVICE_NAME, additional_options=options)
 
 
 def teardown_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
 
 
 @pytest.mark.sanity
 @pytest.mark.executor_volumes
 def test_deploy():
-    deployment_plan = plan.get_deployment_plan(PACKAGE_NAME)
+    deployment_plan = plan.get_deployment_plan(FOLDERED_SERVICE_NAME)
     sdk_utils.out("deployment plan: " + str(deployment_plan))
 
     assert(len(deployment_plan['phases']) == 3)
@@ -43,12 +47,12 @@ def test_deploy():
 @pytest.mark.sanity
 @pytest.mark.executor_volumes
 def test_sidecar():
-    plan.start_plan(PACKAGE_NAME, 'sidecar')
+    plan.start_plan(FOLDERED_SERVICE_NAME, 'sidecar')
 
-    started_plan = plan.get_plan(PACKAGE_NAME, 'sidecar')
+    started_plan = plan.get_plan(FOLDERED_SERVICE_NAME, 'sidecar')
     sdk_utils.out("sidecar plan: " + str(started_plan))
     assert(len(started_plan['phases']) == 1)
     assert(started_plan['phases'][0]['name'] == 'sidecar-deploy')
     assert(len(started_plan['phases'][0]['steps']) == 2)
 
-    plan.wait_for_completed_plan(PACKAGE_NAME, 'sidecar')
+    plan.wait_for_completed_plan(FOLDERED_SERVICE_NAME, 'sidecar')
@@ -22,6 +22,7 @@ from tests.config import (
     bump_world_cpus
 )
 FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+ZK_SERVICE_PATH = sdk_utils.get_zk_path(PACKAGE_NAME)
 
 
 def setup_module(module):
@@ -237,7 +238,7 @@ def test_lock():
     marathon_client = dcos.marathon.create_client()
 
     # Get ZK state from running framework
-    zk_path = "dcos-service-{}/ConfigTarget".format(FOLDERED_SERVICE_NAME)
+    zk_path = "dcos-service-{}/ConfigTarget".format(ZK_SERVICE_PATH)
     zk_config_old = shakedown.get_zk_node_data(zk_path)
 
     # Get marathon app
@@ -7,28 +7,32 @@ import sdk_utils
 from tests.config import (
     PACKAGE_NAME
 )
+FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+# Installs its own foldered service, so run_tests.py may run it in parallel with other such modules
+SHARDABLE = True
 
 
 def setup_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
     options = {
         "service": {
+            "name": FOLDERED_SERVICE_NAME,
             "spec_file": "examples/sidecar.yml"
         }
     }
 
     # this yml has 2 hello's + 0 world's:
-    install.install(PACKAGE_NAME, 2, additional_options=options)
+    install.install(PACKAGE_NAME, 2, service_name=FOLDERED_SERVICE_NAME, additional_options=options)
 
 
 def teardown_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
 
 
 @pytest.mark.sanity
 def test_deploy():
-    plan.wait_for_completed_deployment(PACKAGE_NAME)
-    deployment_plan = plan.get_deployment_plan(PACKAGE_NAME)
+    plan.wait_for_completed_deployment(FOLDERED_SERVICE_NAME)
+    deployment_plan = plan.get_deployment_plan(FOLDERED_SERVICE_NAME)
     sdk_utils.out("deployment plan: " + str(deployment_plan))
 
     assert(len(deployment_plan['phases']) == 2)
@@ -49,12 +53,12 @@ def test_sidecar_parameterized():
 
 
 def run_plan(plan_name, params=None):
-    plan.start_plan(PACKAGE_NAME, plan_name, params)
+    plan.start_plan(FOLDERED_SERVICE_NAME, plan_name, params)
 
-    started_plan = plan.get_plan(PACKAGE_NAME, plan_name)
+    started_plan = plan.get_plan(FOLDERED_SERVICE_NAME, plan_name)
     sdk_utils.out("sidecar plan: " + str(started_plan))
     assert(len(started_plan['phases']) == 1)
     assert(started_plan['phases'][0]['name'] == plan_name + '-deploy')
     assert(len(started_plan['phases'][0]['steps']) == 2)
 
-    plan.wait_for_completed_plan(PACKAGE_NAME, plan_name)
+    plan.wait_for_completed_plan(FOLDERED_SERVICE_NAME, plan_name)
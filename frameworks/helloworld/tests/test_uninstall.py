@@ -4,31 +4,39 @@ import sdk_install as install
 import sdk_marathon as marathon
 import sdk_plan as plan
 import sdk_tasks as tasks
+import sdk_utils
 from tests.config import (
     PACKAGE_NAME,
     DEFAULT_TASK_COUNT,
     check_running
 )
+FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+# Installs its own foldered service, so run_tests.py may run it in parallel with other such modules
+SHARDABLE = True
 
 
 def setup_module(module):
-    install.uninstall(PACKAGE_NAME)
-    install.install(PACKAGE_NAME, DEFAULT_TASK_COUNT)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
+    install.install(
+        PACKAGE_NAME,
+        DEFAULT_TASK_COUNT,
+        service_name=FOLDERED_SERVICE_NAME,
+        additional_options={"service": { "name": FOLDERED_SERVICE_NAME } })
 
 
 def teardown_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
 
 
 @pytest.mark.sanity
 def test_uninstall():
-    check_running()
+    check_running(FOLDERED_SERVICE_NAME)
 
     # add the needed envvar in marathon and confirm that the uninstall "deployment" succeeds:
-    config = marathon.get_config(PACKAGE_NAME)
+    config = marathon.get_config(FOLDERED_SERVICE_NAME)
     env = config['env']
     env['SDK_UNINSTALL'] = 'w00t'
-    marathon.update_app(PACKAGE_NAME, config)
-    plan.wait_for_completed_deployment(PACKAGE_NAME)
-    tasks.check_running(PACKAGE_NAME, 0)
+    marathon.update_app(FOLDERED_SERVICE_NAME, config)
+    plan.wait_for_completed_deployment(FOLDERED_SERVICE_NAME)
+    tasks.check_running(FOLDERED_SERVICE_NAME, 0)
 
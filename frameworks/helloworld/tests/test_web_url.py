@@ -7,28 +7,32 @@ import sdk_utils
 from tests.config import (
     PACKAGE_NAME
 )
+FOLDERED_SERVICE_NAME = sdk_utils.get_foldered_name(PACKAGE_NAME)
+# Installs its own foldered service, so run_tests.py may run it in parallel with other such modules
+SHARDABLE = True
 
 
 def setup_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
     options = {
         "service": {
+            "name": FOLDERED_SERVICE_NAME,
             "spec_file": "examples/web-url.yml"
         }
     }
 
     # this config produces 1 hello's + 0 world's:
-    install.install(PACKAGE_NAME, 1, additional_options=options)
+    install.install(PACKAGE_NAME, 1, service_name=FOLDERED_SERVICE_NAME, additional_options=options)
 
 
 def teardown_module(module):
-    install.uninstall(PACKAGE_NAME)
+    install.uninstall(FOLDERED_SERVICE_NAME, package_name=PACKAGE_NAME)
 
 
 @pytest.mark.sanity
 def test_deploy():
-    plan.wait_for_completed_deployment(PACKAGE_NAME)
-    deployment_plan = plan.get_deployment_plan(PACKAGE_NAME)
+    plan.wait_for_completed_deployment(FOLDERED_SERVICE_NAME)
+    deployment_plan = plan.get_deployment_plan(FOLDERED_SERVICE_NAME)
     sdk_utils.out("deployment_plan: " + str(deployment_plan))
 
     assert(len(deployment_plan['phases']) == 1)
@@ -4,10 +4,12 @@ import sys
 
 import argparse
 import logging
+import queue
 import shutil
 import string
 import subprocess
 import tempfile
+import threading
 import time
 
 def get_repo_root():
@@ -21,6 +23,8 @@ import branch_changes
 import clustinfo
 import fwinfo
 import launch_ccm_cluster
+import outputmux
+import testhistory
 
 
 work_dir = None
@@ -45,14 +49,17 @@ def parse_args(args=sys.argv):
             help="requires a prior build")
     parser.add_argument("--build-only", action='store_false', dest='run_tests')
     parser.add_argument("--parallel", action='store_true',
-            help="Use more than one cluster to try to speed up the tests")
+            help="Use more than one cluster to try to speed up the tests.  "
+                 "Light frameworks may share a cluster.")
     parser.add_argument("--cluster-count", type=int, default=2,
             help="Ignored unless using --parallel.  "
                  "Number of clusters to run tests on. "
                  "Large values are likely to break CCM.")
-    parser.add_argument("--order", choices=('random', 'ordered'), default='random',
+    parser.add_argument("--order", choices=('random', 'ordered', 'duration'), default='random',
             help="Run tests in random order, or the order given on the command line.  "
-            "In the case of no tests listed, ordered means alpha order.")
+            "In the case of no tests listed, ordered means alpha order.  "
+            "duration runs the longest frameworks first, according to the "
+            "durations of previous runs.")
     parser.add_argument("--cluster-url", help="Use this already existing cluster, "
             "don't bring up new ones.")
     parser.add_argument("--cluster-token", help="Auth access when using cluster-url.")
@@ -192,11 +199,31 @@ def setup_frameworks(run_attrs):
         for framework in run_attrs.test:
             fwinfo.add_framework(framework, dcos_version=version)
 
+    try:
+        history = testhistory.TestHistory()
+        try:
+            fwinfo.apply_duration_history(history.framework_durations())
+        finally:
+            history.close()
+    except Exception:
+        logger.exception("Failed to read test history, using default duration estimates")
+
     if run_attrs.order == "random":
         fwinfo.shuffle_order()
+    elif run_attrs.order == "duration":
+        fwinfo.order_by_duration()
 
     fw_names = fwinfo.get_framework_names()
     logger.info("Frameworks initialized: %s", ", ".join(fw_names))
+    cluster_count = run_attrs.cluster_count if run_attrs.parallel else 1
+    logger.info("Predicted test run time on %s cluster(s): %dm", cluster_count,
+                fwinfo.predict_run_time(cluster_count) // 60)
+
+def _record_history(framework, action_name):
+    action = framework.actions[action_name]
+    testhistory.record_framework(framework.name, action['start'],
+                                 action['finish'] - action['start'],
+                                 action['ok'])
 
 
 def _action_wrapper(action_name, framework, function, *args):
@@ -298,9 +325,13 @@ def setup_clusters(run_attrs):
         return
     elif count > 1 and (run_attrs.cluster_url):
         sys.exit("Sorry, no support for multiple externally set up clusters yet.")
-    for i in range(count):
-        human_count = i+1
-        clustinfo.start_cluster(reporting_name="cluster number %s" % human_count)
+    start_configs = [launch_ccm_cluster.StartConfig(private_agents=6)
+                     for _ in range(count)]
+    reporting_names = ["cluster number %s" % (i+1) for i in range(count)]
+    # launched all at once; logged as each comes up
+    for cluster in clustinfo.start_clusters(start_configs, reporting_names):
+        logger.info("Cluster %s ready (%s/%s)", cluster.cluster_id,
+                    clustinfo.running_count(), count)
 
 def teardown_clusters():
     logger.info("Shutting down all clusters.")
@@ -323,9 +354,9 @@ def _one_cluster_linear_tests(run_attrs, repo_root, continue_on_error):
     for framework in fwinfo.get_frameworks():
         func = run_test
         args = framework, cluster, repo_root, fail_fast
+        action_name = "Run %s tests" % framework.name
         try:
-            _action_wrapper("Run %s tests" % framework.name,
-                    framework, func, *args)
+            _action_wrapper(action_name, framework, func, *args)
         except Exception as e:
             all_ok = False
             if fail_fast:
@@ -333,126 +364,174 @@ def _one_cluster_linear_tests(run_attrs, repo_root, continue_on_error):
                 raise
             else:
                 logger.info("Tests for % tests failed.", framework.name)
+        finally:
+            _record_history(framework, action_name)
     return all_ok
 
-def _handle_test_completions():
-    all_tests_ok = True
-    for framework in fwinfo.get_frameworks():
-        if not framework.running:
-            # never started
-            continue
-        pollval = framework.popen.poll()
-        if pollval == None:
-            # probably still running; try again later
-            continue
-        action_name = "Test %s completed" % framework.name
-        framework.start_action(action_name)
-        logger.info("%s test exit code: %s", framework.name, pollval)
-        if pollval == 0:
-            # test exited with success
-            logger.info("%s tests completed successfully.  PASS",
-                        framework.name)
-        else:
-            logger.info("%s tests failed.  FAILED", framework.name)
-            all_tests_ok = False
-
-        framework.running = False
-        logger.info("%s unclaiming cluster id %s", framework.name,
-                framework.cluster.cluster_id)
-        framework.cluster.unclaim(framework)
-        framework.cluster = None
-
-        logger.info("%s test output follows ------------>>>>>>", framework.name)
-        framework.output_file.seek(0)
-        for line in framework.output_file:
-            sys.stdout.buffer.write(line)
-        sys.stdout.flush()
-        framework.output_file.close()
-        logger.info("<<<<<<------------ end %s test output", framework.name)
-
-        if pollval == 0:
-            framework.finish_action_ok(action_name)
-        else:
-            framework.finish_action_fail(action_name)
+# Events for the multicluster scheduler, in order of occurrence:
+#  ("completed", framework): a background test process has exited.  Fed by
+#   one waiter thread per background test (see start_test_background).
+#  ("cluster available", cluster): a cluster has been launched or recycled.
+#   Fed by the cluster pool's background threads.
+_scheduler_events = queue.Queue()
+
+# Live, framework-prefixed output of all background tests.
+_output_mux = outputmux.OutputMux()
+
+# How long a background test may go without printing a line before we warn
+# that it looks stuck, and how often to report on running tests meanwhile.
+STALL_WARNING_SECONDS = 20 * 60
+STATUS_INTERVAL_SECONDS = 5 * 60
+# How long to wait for the rest of a background test's output once it has
+# exited.  Normally this is immediate, but something it started may still be
+# holding its stdout open.
+OUTPUT_DRAIN_SECONDS = 60
+
+def _wait_for_exit(framework, output_stream):
+    framework.popen.wait()
+    # make sure all the output has landed before reporting completion
+    if not output_stream.closed.wait(OUTPUT_DRAIN_SECONDS):
+        logger.warning("%s exited, but its output is still open after %ds; "
+                       "reporting completion anyway", framework.name,
+                       OUTPUT_DRAIN_SECONDS)
+    _scheduler_events.put(("completed", framework))
+
+def _handle_test_completion(framework, pool):
+    "Record the result of a background test which has exited, and free its cluster"
+    returncode = framework.popen.returncode
+    action_name = "Test %s completed" % framework.name
+    framework.start_action(action_name)
+    logger.info("%s test exit code: %s", framework.name, returncode)
+    if returncode == 0:
+        # test exited with success
+        logger.info("%s tests completed successfully.  PASS",
+                    framework.name)
+    else:
+        logger.info("%s tests failed.  FAILED", framework.name)
 
-    return all_tests_ok
+    framework.running = False
+    logger.info("%s releasing cluster id %s", framework.name,
+            framework.cluster.cluster_id)
+    pool.release(framework)
+    framework.cluster = None
 
+    # the output was already streamed live, see _output_mux
+    framework.output_file.close()
+    logger.info("%s test output: %s", framework.name, framework.output_file.name)
 
-def _multicluster_linear_per_cluster(run_attrs, repo_root, continue_on_error):
+    if returncode == 0:
+        framework.finish_action_ok(action_name)
+    else:
+        framework.finish_action_fail(action_name)
+
+    # measured from launch rather than from the completion action above
+    launch = framework.actions["Launch %s tests" % framework.name]
+    testhistory.record_framework(framework.name, launch['start'],
+                                 time.time() - launch['start'],
+                                 returncode == 0)
+    return returncode == 0
+
+
+def _log_schedule_status(pending, pool):
+    info_bits = []
+    for cluster in clustinfo._clusters:
+        template = "cluster_id=%s (%s/%s agents free%s) in use by frameworks=%s"
+        info_bits.append(template % (cluster.cluster_id, cluster.free_agents(),
+                                     cluster.agent_count,
+                                     "" if cluster.available else ", recycling",
+                                     cluster.in_use()))
+    info_bits.append("%s cluster(s) launching or recycling" % pool.busy_count())
+    now = time.time()
+    running_bits = []
+    for framework in fwinfo.running_frameworks():
+        started = framework.actions["Launch %s tests" % framework.name]['start']
+        remaining = framework.estimated_duration - (now - started)
+        running_bits.append("%s (~%dm left)" % (framework.name,
+                                                 max(0, remaining) // 60))
+    logger.info("Running: %s; pending: %s; %s",
+                ", ".join(running_bits) or "none",
+                ", ".join(framework.name for framework in pending) or "none",
+                ", ".join(info_bits))
+    for name, size, quiet_seconds in _output_mux.status():
+        logger.info("%s.out: %s bytes, last line %ds ago", name, size, quiet_seconds)
+        if quiet_seconds > STALL_WARNING_SECONDS:
+            logger.warning("%s has printed nothing for %dm; it may be stuck",
+                           name, quiet_seconds // 60)
+
+
+def _multicluster_scheduled(run_attrs, repo_root, continue_on_error):
+    """Run framework tests in the background across up to cluster_count
+    clusters.
+
+    Clusters come from a clustinfo.ClusterPool, which launches them all up
+    front in the background and recycles them between frameworks.  Pending
+    frameworks form a work queue.  Whenever a framework fits in the unclaimed
+    agents of an available cluster (see clustinfo.get_cluster_with_capacity)
+    it's leased and started there, so that several light frameworks can
+    share one cluster while heavy ones occupy a whole cluster.  Frameworks
+    which don't fit yet are skipped over in favor of later ones which do.
+    Between launches we block until a test process exits or a cluster
+    becomes available, rather than polling.  Tests which overrun their lease
+    or whose cluster stops responding are terminated.
+    """
     fail_fast = not continue_on_error
-    test_list = list(fwinfo.get_framework_names())
-    next_test = None
+    pending = list(fwinfo.get_frameworks())
+    pool = clustinfo.ClusterPool(run_attrs.cluster_count,
+            on_available=lambda cluster: _scheduler_events.put(("cluster available", cluster)))
+    pool.prewarm(min(run_attrs.cluster_count, len(pending)))
+    terminated = set()
     all_ok = True
     try:
         while True:
-            # acquire the next test, if there is one
-            if not next_test and test_list:
-                next_test = test_list.pop(0)
-                logger.info("Next test to run: %s", next_test)
-            if next_test:
-                # we have a test to run, find a cluster to run it on.
-                avail_cluster = clustinfo.get_idle_cluster()
-                logger.debug("avail_cluster=%s", avail_cluster)
-                if not avail_cluster and clustinfo.running_count() < run_attrs.cluster_count:
-                    # we're supposed to start more clusters, so do so
-                    human_count = clustinfo.running_count()+1
-                    logger.info("Launching cluster %s towards count %s",
-                                  human_count, run_attrs.cluster_count)
-                    # TODO: retry cluster launches
-                    start_config = launch_ccm_cluster.StartConfig(private_agents=6)
-                    avail_cluster = clustinfo.start_cluster(start_config,
-                            reporting_name="Cluster %s" % human_count)
-                elif not avail_cluster:
-                    # We're not supposed to start more clusters, so wait, and
-                    # check for test completion.
-                    info_bits = []
-                    for cluster in clustinfo._clusters:
-                        template = "cluster_id=%s in use by frameworks=%s"
-                        info_bits.append(template % (cluster.cluster_id,
-                                                     cluster.in_use()))
-                    logger.info("Waiting for cluster to launch %s; %s",
-                                  next_test, ", ".join(info_bits))
-                    # TODO: report .out sizes for running tests
-                    time.sleep(30) # waiting for an available cluster
-                    # meanwhile, a test might finish
-                    run_ok = _handle_test_completions()
-                    if not run_ok:
-                        all_ok = False
-                        if fail_fast:
-                            logger.info("Some tests failed; aborting early") # TODO paramaterize
-                            break
+            # Start everything which fits right now, in queue order.
+            for framework in list(pending):
+                lease = pool.try_lease(framework)
+                if not lease:
                     continue
-
-                # At this point, we have a cluster and a test, so start it.
-                logger.info("Testing framework=%s in background on cluster=%s.",
-                             next_test, avail_cluster.cluster_id)
-                framework = fwinfo.get_framework(next_test)
+                cluster = lease.cluster
+                logger.info("Testing framework=%s (%s agents, ~%dm) in background on cluster=%s.",
+                             framework.name, framework.required_agents,
+                             framework.estimated_duration // 60,
+                             cluster.cluster_id)
+                pending.remove(framework)
                 func = start_test_background
-                args = framework, avail_cluster, repo_root, fail_fast
+                args = framework, cluster, repo_root, fail_fast
                 _action_wrapper("Launch %s tests" % framework.name,
                         framework, func, *args)
-                next_test = None
-                avail_cluster = None
-            else:
-                # No tests left, handle completion and waiting for completion.
-                if not fwinfo.running_frameworks():
+
+            if not fwinfo.running_frameworks():
+                if not pending:
                     logger.info("No framework tests running.  All done.")
                     break # all tests done
-                logger.info("No framework tests to launch, waiting for completions.")
-                # echo status
-                time.sleep(30) # waiting for tests to complete
-
-            # after launching a test, or waiting, check for test completion.
-            run_ok = _handle_test_completions()
-            if not run_ok:
+                if not pool.busy_count() and not clustinfo.get_idle_cluster():
+                    # an idle cluster accepts any framework, so there are none
+                    # left: every launch or recycle must have failed
+                    raise Exception("No clusters left to run frameworks: %s" %
+                                    [framework.name for framework in pending])
+
+            _log_schedule_status(pending, pool)
+            for lease in pool.expired_leases():
+                framework = lease.framework
+                if framework.name in terminated:
+                    continue
+                logger.warning("%s lease on cluster %s expired or cluster unhealthy; terminating tests",
+                               framework.name, lease.cluster.cluster_id)
+                terminated.add(framework.name)
+                framework.popen.terminate() # completion is reported as usual
+            try:
+                event, subject = _scheduler_events.get(
+                        timeout=min(STATUS_INTERVAL_SECONDS,
+                                    clustinfo.ClusterPool.HEALTH_CHECK_INTERVAL_SECONDS))
+            except queue.Empty:
+                continue
+            if event == "cluster available":
+                logger.info("Cluster %s available", subject.cluster_id)
+                continue
+            if not _handle_test_completion(subject, pool):
                 all_ok = False
                 if fail_fast:
                     logger.info("Some tests failed; aborting early") # TODO paramaterize
                     break
-            all_ok = _handle_test_completions()
-            if fail_fast and not all_ok:
-                logger.info("Some tests failed; aborting early") # TODO paramaterize
-                break
     finally:
         # TODO probably should also make this teardown optional
         for framework_name in fwinfo.get_framework_names():
@@ -469,8 +548,8 @@ def run_tests(run_attrs, repo_root):
         all_passed = False
         if run_attrs.parallel:
             logger.debug("Running multicluster test run")
-            all_passed = _multicluster_linear_per_cluster(run_attrs, repo_root,
-                                                          run_attrs.continue_on_error)
+            all_passed = _multicluster_scheduled(run_attrs, repo_root,
+                                                 run_attrs.continue_on_error)
         else:
             all_passed = _one_cluster_linear_tests(run_attrs, repo_root,
                                                    run_attrs.continue_on_error)
@@ -515,6 +594,10 @@ def _setup_strict(framework, cluster, repo_root):
 
         logger.info("%s role setup script(s) completed", framework.name)
 
+def _runtests_script(repo_root):
+    "The script which runs a framework's tests (replaced in tools/bench_scheduler.py)"
+    return os.path.join(repo_root, 'tools', 'run_tests.py')
+
 def start_test_background(framework, cluster, repo_root, fail_fast):
     """Start one test on a cluster as a subprocess.
     The state of these subprocesses lives in the framework objects stored in
@@ -533,7 +616,7 @@ def start_test_background(framework, cluster, repo_root, fail_fast):
     custom_env['CLUSTER_URL'] = cluster.url
     custom_env['CLUSTER_AUTH_TOKEN'] = cluster.auth_token
 
-    runtests_script = os.path.join(repo_root, 'tools', 'run_tests.py')
+    runtests_script = _runtests_script(repo_root)
 
 
     # Why this trailing slash here? no idea.
@@ -546,14 +629,18 @@ def start_test_background(framework, cluster, repo_root, fail_fast):
 
     output_filename = os.path.join(get_work_dir(), "%s.out" % framework.name)
     output_file = open(output_filename, "w+b")
-    popen_obj = subprocess.Popen(cmd_args, stdout=output_file,
-                                 stderr=output_file, env=custom_env)
+    popen_obj = subprocess.Popen(cmd_args, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, env=custom_env)
+    output_stream = _output_mux.add(framework.name, popen_obj.stdout, output_file)
 
     framework.running = True
     framework.popen = popen_obj
     framework.output_file = output_file
     framework.cluster = cluster
-    cluster.claim(framework)
+    waiter = threading.Thread(target=_wait_for_exit,
+                              args=(framework, output_stream),
+                              name="wait-%s" % framework.name, daemon=True)
+    waiter.start()
     logger.info("Shakedown for %s now running in background", framework.name)
 
 def run_test(framework, cluster, repo_root, fail_fast):
@@ -568,7 +655,7 @@ def run_test(framework, cluster, repo_root, fail_fast):
     custom_env['TEST_GITHUB_LABEL'] = framework.name
     custom_env['CLUSTER_URL'] = cluster.url
     custom_env['CLUSTER_AUTH_TOKEN'] = cluster.auth_token
-    runtests_script = os.path.join(repo_root, 'tools', 'run_tests.py')
+    runtests_script = _runtests_script(repo_root)
     # Why this trailing slash here? no idea.
     framework_testdir = os.path.join(framework.dir, 'tests') + "/"
     cmd_args = [runtests_script, 'shakedown', framework_testdir]
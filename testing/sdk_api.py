@@ -1,6 +1,6 @@
-import dcos
 import shakedown
 
+import sdk_cmd
 import sdk_utils
 
 def get(service_name, endpoint):
@@ -10,11 +10,9 @@ def get(service_name, endpoint):
     :returns: JSON response from the provided scheduler API endpoint
     :rtype: Response
     '''
-    response = dcos.http.get("{}{}".format(
+    return sdk_cmd.request('get', "{}{}".format(
         shakedown.dcos_service_url(service_name),
-        endpoint))
-    response.raise_for_status()
-    return response
+        endpoint), retry=False, log_response=False)
 
 
 def is_suppressed(service_name):
@@ -1,27 +1,186 @@
 '''Utilities relating to running commands and HTTP requests'''
 
+import collections
+import random
+import threading
+import time
+import urllib.parse
+
+import dcos.config
+import dcos.errors
 import dcos.http
+import requests
+import requests.adapters
+import requests.exceptions
 import sdk_utils
 import shakedown
 
+# Maximum number of requests which may be in flight at once across all threads, and the number of
+# keep-alive connections retained for each cluster host:
+MAX_CONCURRENT_REQUESTS = 16
+POOL_SIZE_PER_HOST = 16
+
+# Timeouts applied to requests which don't specify their own, mirroring dcos.http: connecting should be
+# quick, while the read timeout may be overridden by the core.timeout config:
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5
+DEFAULT_READ_TIMEOUT_SECONDS = 180
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_default_timeout = None
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+_latencies = collections.defaultdict(lambda: {'count': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+_latencies_lock = threading.Lock()
 
-def request(method, url, retry=True, log_args=True, **kwargs):
+# Called with each CLI command which succeeded, see add_cli_hook():
+_cli_hooks = []
+
+
+def request(method, url, retry=True, log_args=True, log_response=True, retry_timeout_seconds=120, **kwargs):
+    '''Sends an HTTP request to the cluster over a pooled keep-alive connection, raising
+    dcos.errors.DCOSHTTPException on a non-2xx response, or dcos.errors.DCOSException if no response
+    was received (as dcos.http does). If retry is set, failed requests are retried
+    with jittered exponential backoff for up to retry_timeout_seconds. Each attempt is subject to
+    get_default_timeout() unless a timeout is provided in kwargs.'''
     def fn():
-        response = dcos.http.request(method, url, **kwargs)
-        if log_args:
-            sdk_utils.out('Got {} for {} {} (args: {})'.format(
-                response.status_code, method.upper(), url, kwargs))
-        else:
-            sdk_utils.out('Got {} for {} {} ({} args)'.format(
-                response.status_code, method.upper(), url, len(kwargs)))
-        response.raise_for_status()
+        try:
+            response = _send(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise dcos.errors.DCOSException('Failed to send {} {}: {}'.format(method.upper(), url, e)) from e
+        if log_response:
+            if log_args:
+                sdk_utils.out('Got {} for {} {} (args: {})'.format(
+                    response.status_code, method.upper(), url, kwargs))
+            else:
+                sdk_utils.out('Got {} for {} {} ({} args)'.format(
+                    response.status_code, method.upper(), url, len(kwargs)))
+        if not 200 <= response.status_code < 300:
+            raise dcos.errors.DCOSHTTPException(response)
         return response
     if retry:
-        return shakedown.wait_while_exceptions(lambda: fn())
+        return _retry(fn, '{} {}'.format(method.upper(), url), retry_timeout_seconds)
     else:
         return fn()
 
 
+def new_session():
+    '''Returns a requests.Session carrying the cluster's auth token and TLS settings, for callers which
+    poll the same endpoints repeatedly and want to reuse connections rather than reconnect each time'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE_PER_HOST)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Authorization'] = 'token={}'.format(shakedown.dcos_acs_token())
+    # Mirror dcos.http's handling of core.ssl_verify: 'true'/'false' or a path to a CA bundle:
+    ssl_verify = dcos.config.get_config_val('core.ssl_verify')
+    if ssl_verify is not None:
+        if ssl_verify.lower() == 'true':
+            session.verify = True
+        elif ssl_verify.lower() == 'false':
+            session.verify = False
+        else:
+            session.verify = ssl_verify
+    return session
+
+
+def get_session(url):
+    '''Returns the shared session for the host in the provided URL, creating it if needed'''
+    host = urllib.parse.urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = new_session()
+            _sessions[host] = session
+        return session
+
+
+def _renew_session(url, stale_session):
+    '''Replaces the shared session for the host in the provided URL with one carrying the current
+    auth token, unless another thread has already replaced it'''
+    host = urllib.parse.urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None or session is stale_session:
+            session = new_session()
+            _sessions[host] = session
+    # the stale session isn't closed, as other threads may still have requests in flight on it
+    return session
+
+
+def get_default_timeout():
+    '''Returns the (connect, read) timeout for requests which don't specify their own'''
+    global _default_timeout
+    if _default_timeout is None:
+        read_timeout = dcos.config.get_config_val('core.timeout')
+        _default_timeout = (DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                            float(read_timeout) if read_timeout else DEFAULT_READ_TIMEOUT_SECONDS)
+    return _default_timeout
+
+
+def get_latency_stats():
+    '''Returns a dict of "METHOD /path" => {count, errors, mean_ms, max_ms} for all requests so far'''
+    with _latencies_lock:
+        return {endpoint: {
+            'count': stats['count'],
+            'errors': stats['errors'],
+            'mean_ms': 1000 * stats['total_seconds'] / stats['count'],
+            'max_ms': 1000 * stats['max_seconds']} for endpoint, stats in _latencies.items()}
+
+
+def print_latency_stats():
+    stats = get_latency_stats()
+    sdk_utils.out('HTTP request latencies ({} endpoints):'.format(len(stats)))
+    for endpoint in sorted(stats, key=lambda e: -stats[e]['count']):
+        sdk_utils.out('  {count:5d} requests, {errors:3d} errors, mean {mean_ms:7.1f}ms, max {max_ms:7.1f}ms: '
+                      '{endpoint}'.format(endpoint=endpoint, **stats[endpoint]))
+
+
+def _send(method, url, **kwargs):
+    endpoint = '{} {}'.format(method.upper(), urllib.parse.urlparse(url).path)
+    start = time.time()
+    failed = True
+    kwargs.setdefault('timeout', get_default_timeout())
+    try:
+        with _request_slots:
+            session = get_session(url)
+            response = session.request(method, url, **kwargs)
+            if response.status_code == 401:
+                # The session's token was read when it was created, and may since have expired or
+                # been replaced by a new login:
+                sdk_utils.out('Got 401 for {}, retrying with a new session'.format(endpoint))
+                response = _renew_session(url, session).request(method, url, **kwargs)
+        failed = not 200 <= response.status_code < 300
+        return response
+    finally:
+        elapsed = time.time() - start
+        with _latencies_lock:
+            stats = _latencies[endpoint]
+            stats['count'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            if failed:
+                stats['errors'] += 1
+
+
+def _retry(fn, description, timeout_seconds, initial_backoff_seconds=1, max_backoff_seconds=30):
+    start = time.time()
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            attempt += 1
+            # "Full jitter": sleep a random duration up to the exponential backoff ceiling, so that
+            # concurrent pollers which fail together don't all retry together.
+            backoff = random.uniform(0, min(max_backoff_seconds, initial_backoff_seconds * 2 ** attempt))
+            if time.time() - start + backoff > timeout_seconds:
+                raise
+            sdk_utils.out('Retrying {} in {:.1f}s after attempt {} failed: {}'.format(
+                description, backoff, attempt, e))
+            time.sleep(backoff)
+
+
 def run_cli(cmd, print_output=True):
     (stdout, stderr, ret) = shakedown.run_dcos_command(cmd, print_output=print_output)
     if ret != 0:
@@ -29,4 +188,12 @@ def run_cli(cmd, print_output=True):
             ret, cmd, stdout, stderr)
         sdk_utils.out(err)
         raise dcos.errors.DCOSException(err)
+    for hook in _cli_hooks:
+        hook(cmd)
     return stdout
+
+
+def add_cli_hook(fn):
+    '''Registers fn(cmd) to be called after each successful run_cli(cmd), e.g. for dropping cached
+    state which the command may have changed'''
+    _cli_hooks.append(fn)
@@ -39,6 +39,7 @@ def install(
         wait_for_completion=True,
         timeout_sec=timeout_seconds,
         expected_running_tasks=running_task_count)
+    sdk_tasks.invalidate(service_name)
 
     # 2. Ensure the framework is suppressed.
     #
@@ -120,6 +121,7 @@ def uninstall(service_name, package_name=None, role=None, principal=None, zk=Non
             sdk_utils.out('Got exception when uninstalling package: {}'.format(e))
         finally:
             sdk_utils.list_reserved_resources()
+    sdk_tasks.invalidate(service_name)
 
 
 def get_package_options(additional_options={}):
@@ -3,14 +3,13 @@
 import shakedown
 
 import sdk_cmd
+import sdk_tasks
 import sdk_utils
 
 
 def get_config(app_name):
     # Be permissive of flakes when fetching the app content:
-    def fn():
-        return sdk_cmd.request('get', api_url('apps/{}'.format(app_name)), retry=False, log_args=False)
-    config = shakedown.wait_for(lambda: fn()).json()['app']
+    config = sdk_cmd.request('get', api_url('apps/{}'.format(app_name)), log_args=False).json()['app']
 
     # The configuration JSON that marathon returns doesn't match the configuration JSON it accepts,
     # so we have to remove some offending fields to make it re-submittable, since it's not possible to
@@ -35,6 +34,8 @@ def update_app(app_name, config, timeout=600):
 
     sdk_utils.out("Waiting for Marathon deployment of {} to complete...".format(app_name))
     shakedown.deployment_wait(app_id=app_name, timeout=timeout)
+    # The app id doesn't necessarily match the service name that tasks were fetched with:
+    sdk_tasks.invalidate()
 
 
 def destroy_app(app_name):
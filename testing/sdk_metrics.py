@@ -3,30 +3,51 @@ Utilities relating to verifying the metrics functionality as reported
 by the DC/OS metrics component.
 '''
 
+import array
+import collections
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+
 import shakedown
 
 import sdk_utils as utils
 import sdk_cmd as cmd
+import sdk_tasks
 import json
 
-def get_metrics(service_name, task_name):
+# (agent_id, container_id) => executor_id, for every container app we've fetched so far. A container
+# always belongs to the same executor, so repeat lookups can skip straight to the relevant container.
+_container_executors = {}
+_container_executors_lock = threading.Lock()
+
+
+def get_metrics(service_name, task_name, max_workers=8):
     """Return a list of metrics datapoints.
 
     Keyword arguments:
     service_name -- the name of the service to get metrics for
     task_name -- the name of the task whose agent to run metrics commands from
+    max_workers -- the number of containers on the agent to query concurrently
     """
-    tasks = shakedown.get_service_tasks(service_name)
-    for task in tasks:
-        if task['name'] == task_name:
-            task_to_check = task
-
+    task_to_check = sdk_tasks.get_snapshot(service_name).get(task_name)
     if task_to_check is None:
         raise Exception("Could not find task")
 
     agent_id = task_to_check['slave_id']
     executor_id = task_to_check['executor_id']
 
+    # If we've already seen the executor's container, try it alone before listing the agent's containers
+    with _container_executors_lock:
+        known_containers = [container for (agent, container), executor in _container_executors.items()
+                            if agent == agent_id and executor == executor_id]
+    for container in known_containers:
+        app_json = _get_container_app(agent_id, container)
+        if app_json is not None and app_json['dimensions']['executor_id'] == executor_id:
+            return app_json['datapoints']
+
     # Fetch the list of containers for the agent
     containers_url = "{}/system/v1/agent/{}/metrics/v0/containers".format(shakedown.dcos_url(), agent_id)
     containers_response = cmd.request("GET", containers_url, retry=False)
@@ -34,19 +55,54 @@ def get_metrics(service_name, task_name):
         utils.out("Unable to fetch containers list")
         raise Exception("Unable to fetch containers list: {}".format(containers_url))
 
-    for container in json.loads(containers_response.text):
-        app_url = "{}/system/v1/agent/{}/metrics/v0/containers/{}/app".format(shakedown.dcos_url(), agent_id, container)
-        app_response = cmd.request("GET", app_url, retry=False)
-        if app_response.ok is None:
-            continue
+    # Skip containers which we already know to belong to other executors
+    with _container_executors_lock:
+        containers = [container for container in json.loads(containers_response.text)
+                      if _container_executors.get((agent_id, container)) in (None, executor_id)]
 
-        app_json = json.loads(app_response.text)
-        if app_json['dimensions']['executor_id'] == executor_id:
-            return app_json['datapoints']
+    found = threading.Event()
+
+    def fetch(container):
+        if found.is_set():
+            return None
+        app_json = _get_container_app(agent_id, container)
+        if app_json is not None and app_json['dimensions']['executor_id'] == executor_id:
+            found.set()
+            return app_json
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(fetch, container) for container in containers]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                app_json = future.result()
+                if app_json is not None:
+                    return app_json['datapoints']
+        finally:
+            # Don't bother fetching anything which hasn't started yet
+            for future in futures:
+                future.cancel()
 
     raise Exception("No metrics found")
 
 
+def _get_container_app(agent_id, container):
+    """Returns the app metrics JSON for a container, or None if it couldn't be retrieved."""
+    app_url = "{}/system/v1/agent/{}/metrics/v0/containers/{}/app".format(shakedown.dcos_url(), agent_id, container)
+    try:
+        app_response = cmd.request("GET", app_url, retry=False)
+    except Exception as e:
+        utils.out("Unable to fetch metrics for container {}: {}".format(container, e))
+        return None
+    if app_response.ok is None:
+        return None
+
+    app_json = json.loads(app_response.text)
+    with _container_executors_lock:
+        _container_executors[(agent_id, container)] = app_json['dimensions']['executor_id']
+    return app_json
+
+
 def wait_for_any_metrics(service_name, task_name, timeout):
     def metrics_exist():
         utils.out("verifying metrics exist for {}".format(service_name))
@@ -54,3 +110,175 @@ def wait_for_any_metrics(service_name, task_name, timeout):
         return len(service_metrics) != 0
 
     shakedown.wait_for(metrics_exist, timeout)
+
+
+class MetricsCollector(object):
+    """Samples the metrics datapoints of all of a service's running tasks in a background thread.
+
+    Samples are held in memory as per-series arrays of (timestamp, value) doubles. Once more than
+    max_buffered_samples are held, they are appended to a spill file on disk and the arrays are
+    cleared. summary() aggregates everything collected so far, including any spilled samples.
+    close() (called on leaving the with block) deletes the spill file and the buffered samples.
+
+    with sdk_metrics.MetricsCollector(PACKAGE_NAME) as collector:
+        ... run test ...
+        collector.write_summary('metrics-summary.json', 'test_soak')
+    """
+
+    def __init__(self, service_name, interval_seconds=10, max_buffered_samples=1000000, spill_dir=None):
+        self.service_name = service_name
+        self.interval_seconds = interval_seconds
+        self.max_buffered_samples = max_buffered_samples
+        self._spill_dir = spill_dir
+        self._spill_path = None
+        self._spilled_metrics = set()
+        # (task_name, metric_name) => (timestamps, values)
+        self._series = collections.defaultdict(lambda: (array.array('d'), array.array('d')))
+        self._buffered_samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sample_errors = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        self.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-{}'.format(self.service_name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Discards all collected samples, including the spill file. Call stop() first."""
+        with self._lock:
+            if self._spill_path is not None:
+                try:
+                    os.remove(self._spill_path)
+                except OSError as e:
+                    utils.out("Unable to remove metrics spill file {}: {}".format(self._spill_path, e))
+                self._spill_path = None
+            self._spilled_metrics.clear()
+            self._series.clear()
+            self._buffered_samples = 0
+
+    def sample(self):
+        """Records the current datapoints of every running task in the service."""
+        now = time.time()
+        for task in sdk_tasks.get_snapshot(self.service_name).with_state('TASK_RUNNING'):
+            try:
+                datapoints = get_metrics(self.service_name, task['name'])
+            except Exception as e:
+                with self._lock:
+                    self.sample_errors += 1
+                utils.out("Unable to sample metrics for {}: {}".format(task['name'], e))
+                continue
+            with self._lock:
+                for datapoint in datapoints:
+                    try:
+                        value = float(datapoint['value'])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    timestamps, values = self._series[(task['name'], datapoint['name'])]
+                    timestamps.append(now)
+                    values.append(value)
+                    self._buffered_samples += 1
+                if self._buffered_samples > self.max_buffered_samples:
+                    self._spill()
+
+    def summary(self):
+        """Returns {metric_name: {count, tasks, p50, p95, max}}, aggregated across all tasks.
+
+        Metrics are aggregated one at a time, each with a pass over the spill file, so that only one
+        metric's samples are held in memory at once (on top of those not yet spilled)."""
+        summary = {}
+        with self._lock:
+            metric_names = self._spilled_metrics | set(metric_name for _, metric_name in self._series)
+            for metric_name in sorted(metric_names):
+                values = array.array('d')
+                task_names = set()
+                for task_name, series_values in self._metric_series(metric_name):
+                    values.extend(series_values)
+                    task_names.add(task_name)
+                values = array.array('d', sorted(values))
+                summary[metric_name] = {
+                    'count': len(values),
+                    'tasks': len(task_names),
+                    'p50': _percentile(values, 50),
+                    'p95': _percentile(values, 95),
+                    'max': values[-1]}
+        return summary
+
+    def write_summary(self, path, test_name):
+        """Writes the summary to a JSON file for comparison across builds."""
+        with open(path, 'w') as f:
+            json.dump({
+                'test': test_name,
+                'service': self.service_name,
+                'interval_seconds': self.interval_seconds,
+                'sample_errors': self.sample_errors,
+                'metrics': self.summary()}, f, indent=2, sort_keys=True)
+        utils.out("Wrote metrics summary for {} to {}".format(test_name, path))
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                self.sample()
+            except Exception as e:
+                with self._lock:
+                    self.sample_errors += 1
+                utils.out("Failed to sample metrics for {}: {}".format(self.service_name, e))
+            self._stop.wait(max(0, self.interval_seconds - (time.time() - start)))
+
+    def _spill(self):
+        """Appends the buffered series to the spill file as JSON lines. Must be called with the lock held."""
+        if self._spill_path is None:
+            fd, self._spill_path = tempfile.mkstemp(
+                prefix='metrics-{}-'.format(self.service_name.strip('/').replace('/', '__')),
+                suffix='.jsonl', dir=self._spill_dir)
+            os.close(fd)
+        with open(self._spill_path, 'a') as f:
+            for (task_name, metric_name), (timestamps, values) in self._series.items():
+                # prefixed with the metric name, so that summary() can skip other metrics' lines
+                # without parsing them
+                f.write(json.dumps(metric_name) + '\t' + json.dumps({
+                    'task': task_name,
+                    'timestamps': timestamps.tolist(),
+                    'values': values.tolist()}) + '\n')
+                self._spilled_metrics.add(metric_name)
+        utils.out("Spilled {} metrics samples to {}".format(self._buffered_samples, self._spill_path))
+        self._series.clear()
+        self._buffered_samples = 0
+
+    def _metric_series(self, metric_name):
+        """Yields (task_name, values) of the metric for spilled and then buffered samples. Must be
+        called with the lock held."""
+        if self._spill_path is not None and metric_name in self._spilled_metrics:
+            prefix = json.dumps(metric_name)
+            with open(self._spill_path) as f:
+                for line in f:
+                    line_metric, _, entry = line.partition('\t')
+                    if line_metric == prefix:
+                        entry = json.loads(entry)
+                        yield entry['task'], entry['values']
+        for (task_name, series_metric), (_, values) in self._series.items():
+            if series_metric == metric_name:
+                yield task_name, values
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already-sorted non-empty sequence."""
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
@@ -1,7 +1,11 @@
 '''Utilities relating to interaction with service plans'''
 
-import dcos
+import collections
+import threading
+import time
+
 import sdk_api
+import sdk_cmd
 import sdk_utils
 import shakedown
 
@@ -21,8 +25,10 @@ def get_plan(service_name, plan):
 
 
 def start_plan(service_name, plan, parameters=None):
-    return dcos.http.post(
+    return sdk_cmd.request(
+        'post',
         "{}/v1/plans/{}/start".format(shakedown.dcos_service_url(service_name), plan),
+        retry=False,
         json=parameters if parameters is not None else {})
 
 
@@ -55,41 +61,132 @@ def wait_for_in_progress_plan(service_name, plan_name, timeout_seconds=15 * 60):
 
 
 def wait_for_plan_status(service_name, plan_name, status, timeout_seconds=15 * 60):
-    def fn():
-        plan = get_plan(service_name, plan_name)
-        sdk_utils.out('Waiting for {} plan to have {} status:\n{}'.format(
-            plan_name, status, plan_string(plan_name, plan)))
-        if plan and plan['status'] == status:
-            return plan
-        else:
-            return False
-    return shakedown.wait_for(fn, noisy=True, timeout_seconds=timeout_seconds)
+    return get_watcher(service_name, plan_name).wait_for(
+        plan_status(plan_name, status), timeout_seconds=timeout_seconds)
 
 
 def wait_for_phase_status(service_name, plan_name, phase_name, status, timeout_seconds=15 * 60):
-    def fn():
-        plan = get_plan(service_name, plan_name)
-        phase = get_phase(plan, phase_name)
-        sdk_utils.out('Waiting for {}.{} phase to have {} status:\n{}'.format(
-            plan_name, phase_name, status, plan_string(plan_name, plan)))
-        if phase and phase['status'] == status:
-            return plan
-        else:
-            return False
-    return shakedown.wait_for(fn, noisy=True, timeout_seconds=timeout_seconds)
+    return get_watcher(service_name, plan_name).wait_for(
+        phase_status(plan_name, phase_name, status), timeout_seconds=timeout_seconds)
 
 
 def wait_for_step_status(service_name, plan_name, phase_name, step_name, status, timeout_seconds=15 * 60):
-    def fn():
-        plan = get_plan(service_name, plan_name)
+    return get_watcher(service_name, plan_name).wait_for(
+        step_status(plan_name, phase_name, step_name, status), timeout_seconds=timeout_seconds)
+
+
+# Conditions which may be passed to PlanWatcher.wait_for(). Each is a (description, predicate) tuple,
+# where the predicate is given the latest plan snapshot and returns whether the condition holds.
+
+def plan_status(plan_name, status):
+    return ('{} plan to have {} status'.format(plan_name, status),
+            lambda plan: plan['status'] == status)
+
+
+def phase_status(plan_name, phase_name, status):
+    def fn(plan):
+        phase = get_phase(plan, phase_name)
+        return phase is not None and phase['status'] == status
+    return ('{}.{} phase to have {} status'.format(plan_name, phase_name, status), fn)
+
+
+def step_status(plan_name, phase_name, step_name, status):
+    def fn(plan):
         step = get_step(get_phase(plan, phase_name), step_name)
-        sdk_utils.out('Waiting for {}.{}.{} step to have {} status:\n{}'.format(
-            plan_name, phase_name, step_name, status, plan_string(plan_name, plan)))
-        if step and step['status'] == status:
-            return plan
-        else:
-            return False
-    return shakedown.wait_for(fn, noisy=True, timeout_seconds=timeout_seconds)
+        return step is not None and step['status'] == status
+    return ('{}.{}.{} step to have {} status'.format(plan_name, phase_name, step_name, status), fn)
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(service_name, plan_name):
+    '''Returns the shared PlanWatcher for the provided service and plan, creating it if needed'''
+    key = (service_name, plan_name)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = PlanWatcher(service_name, plan_name)
+            _watchers[key] = watcher
+        return watcher
+
+
+class PlanWatcher(object):
+    '''Polls a single plan over the shared keep-alive HTTP session on behalf of any number of waiters.
+
+    Polling starts at min_poll_seconds and backs off towards max_poll_seconds while the plan is
+    unchanged, dropping back to the minimum as soon as a change is seen. Snapshots which are still
+    within the current poll interval are shared between all callers rather than being re-fetched.'''
+
+    def __init__(self, service_name, plan_name, min_poll_seconds=1, max_poll_seconds=10):
+        self.service_name = service_name
+        self.plan_name = plan_name
+        self._min_poll_seconds = min_poll_seconds
+        self._max_poll_seconds = max_poll_seconds
+        self._poll_seconds = min_poll_seconds
+        self._lock = threading.Lock()
+        self._plan = None
+        self._fetched_at = 0
+        self.fetch_count = 0
+
+    def snapshot(self, max_age_seconds=None):
+        '''Returns the latest plan, only fetching a new copy if the cached one is older than
+        max_age_seconds (default: the current poll interval). Returns None if the plan could not
+        be retrieved.'''
+        if max_age_seconds is None:
+            max_age_seconds = self._poll_seconds
+        with self._lock:
+            if self._fetched_at and time.time() - self._fetched_at < max_age_seconds:
+                return self._plan
+            new_plan = self._fetch()
+            changes = plan_changes(self.plan_name, self._plan, new_plan)
+            if changes:
+                self._poll_seconds = self._min_poll_seconds
+                sdk_utils.out('{} plan changed ({} fetches so far):\n- {}\n{}'.format(
+                    self.plan_name, self.fetch_count, '\n- '.join(changes),
+                    plan_string(self.plan_name, new_plan)))
+            else:
+                self._poll_seconds = min(self._poll_seconds * 2, self._max_poll_seconds)
+            self._plan = new_plan
+            self._fetched_at = time.time()
+            return new_plan
+
+    def wait_for(self, *conditions, timeout_seconds=15 * 60):
+        '''Waits until all of the provided (description, predicate) conditions hold against the same
+        plan snapshot, and returns that snapshot. Raises shakedown.TimeoutExpired on timeout.'''
+        description = ', '.join(desc for desc, _ in conditions)
+        sdk_utils.out('Waiting for {}'.format(description))
+        start = time.time()
+        # Always start from a fresh snapshot: the caller may have just modified the service.
+        plan = self.snapshot(max_age_seconds=0)
+        while True:
+            if plan:
+                pending = [desc for desc, predicate in conditions if not predicate(plan)]
+                if not pending:
+                    sdk_utils.out('Done waiting for {} after {}:\n{}'.format(
+                        description, shakedown.pretty_duration(time.time() - start),
+                        plan_string(self.plan_name, plan)))
+                    return plan
+            else:
+                pending = [desc for desc, _ in conditions]
+            remaining = timeout_seconds - (time.time() - start)
+            if remaining <= 0:
+                sdk_utils.out('Timed out waiting for {}:\n{}'.format(
+                    ', '.join(pending), plan_string(self.plan_name, plan)))
+                raise shakedown.TimeoutExpired(timeout_seconds, description)
+            time.sleep(min(self._poll_seconds, remaining))
+            plan = self.snapshot()
+
+    def _fetch(self):
+        self.fetch_count += 1
+        url = '{}/v1/plans/{}'.format(shakedown.dcos_service_url(self.service_name), self.plan_name)
+        try:
+            # 200 when the plan is complete, 202 when it's still in progress:
+            return sdk_cmd.request('get', url, retry=False, log_response=False).json()
+        except Exception as e:
+            sdk_utils.out('Failed to fetch {} plan: {}'.format(self.plan_name, e))
+            return None
 
 
 def get_phase(plan, name):
@@ -128,3 +225,34 @@ def plan_string(plan_name, plan):
     if plan.get('errors', []):
         plan_str += '\n- errors: {}'.format(', '.join(plan['errors']))
     return plan_str
+
+
+def plan_changes(plan_name, old_plan, new_plan):
+    '''Returns a list of human-readable status transitions between two snapshots of the same plan'''
+    if old_plan is None and new_plan is None:
+        return []
+    if old_plan is None or new_plan is None:
+        return ['{}: {} => {}'.format(
+            plan_name,
+            'NULL' if old_plan is None else old_plan['status'],
+            'NULL' if new_plan is None else new_plan['status'])]
+    changes = []
+    if old_plan['status'] != new_plan['status']:
+        changes.append('{}: {} => {}'.format(plan_name, old_plan['status'], new_plan['status']))
+    old_statuses = _element_statuses(old_plan)
+    for name, status in _element_statuses(new_plan).items():
+        old_status = old_statuses.get(name)
+        if old_status != status:
+            changes.append('{}: {} => {}'.format(name, old_status, status))
+    if old_plan.get('errors', []) != new_plan.get('errors', []):
+        changes.append('errors: {}'.format(', '.join(new_plan.get('errors', []))))
+    return changes
+
+
+def _element_statuses(plan):
+    statuses = collections.OrderedDict()
+    for phase in plan['phases']:
+        statuses[phase['name']] = phase['status']
+        for step in phase['steps']:
+            statuses['{}.{}'.format(phase['name'], step['name'])] = step['status']
+    return statuses
@@ -1,15 +1,134 @@
 '''Utilities relating to running commands and HTTP requests'''
 
+import bisect
+import collections
+import re
+import threading
+import time
+
 import dcos.errors
+import sdk_cmd
 import sdk_plan
 import sdk_utils
 import shakedown
 
+# How long a fetched task list is served from memory before it is fetched again. This is kept short
+# so that polling callers still observe changes promptly, while lookups made within the same poll
+# cycle share a single fetch. Set to 0 to disable caching.
+TASK_CACHE_TTL_SECONDS = 2
+
+# SDK task names are of the form "<pod-type>-<pod-index>-<task-name>":
+_POD_TASK_NAME_PATTERN = re.compile(r'^((.+)-[0-9]+)-[^-].*$')
+# CLI commands which relaunch a service's tasks, e.g. "hello-world --name=foo pods restart hello-0":
+_POD_RELAUNCH_PATTERN = re.compile(r'\bpods? (restart|replace)\b')
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(service_name, max_age_seconds=None):
+    '''Returns a TaskSnapshot of the service's tasks, reusing a cached snapshot if it's younger than
+    max_age_seconds (default: TASK_CACHE_TTL_SECONDS)'''
+    if max_age_seconds is None:
+        max_age_seconds = TASK_CACHE_TTL_SECONDS
+    with _snapshots_lock:
+        snapshot = _snapshots.get(service_name)
+    if snapshot is not None and time.time() - snapshot.fetched_at < max_age_seconds:
+        return snapshot
+    snapshot = TaskSnapshot(service_name, shakedown.get_service_tasks(service_name))
+    with _snapshots_lock:
+        _snapshots[service_name] = snapshot
+    return snapshot
+
+
+def invalidate(service_name=None):
+    '''Drops the cached tasks for the provided service, or for all services if none is provided.
+    Should be called after anything which is known to have changed a service's tasks.'''
+    with _snapshots_lock:
+        if service_name is None:
+            _snapshots.clear()
+        else:
+            _snapshots.pop(service_name, None)
+
+
+def _invalidate_after_pod_relaunch(cmd):
+    if _POD_RELAUNCH_PATTERN.search(cmd):
+        # We don't know which service the command was for:
+        invalidate()
+
+
+sdk_cmd.add_cli_hook(_invalidate_after_pod_relaunch)
+
+
+class TaskSnapshot(object):
+    '''An immutable listing of a service's tasks at a point in time, indexed by name, pod and state.
+
+    Indexes are built once when the snapshot is created, so that the many lookups made against a
+    snapshot don't each rescan what may be thousands of historical tasks on long-running clusters.'''
+
+    def __init__(self, service_name, tasks):
+        self.service_name = service_name
+        self.tasks = tasks
+        self.fetched_at = time.time()
+        # Tasks sorted by name, with a parallel list of names for bisecting on prefix queries:
+        self._sorted_tasks = sorted(tasks, key=lambda t: t['name'])
+        self._sorted_names = [t['name'] for t in self._sorted_tasks]
+        self._by_name = {}
+        self._by_pod_type = collections.defaultdict(list)
+        self._by_state = collections.defaultdict(list)
+        for task in tasks:
+            self._by_name[task['name']] = task
+            self._by_pod_type[pod_type(task['name'])].append(task)
+            self._by_state[task['state']].append(task)
+
+    def get(self, task_name):
+        '''Returns the task with exactly the provided name, or None if no such task exists'''
+        return self._by_name.get(task_name)
+
+    def with_state(self, state):
+        return self._by_state.get(state, [])
+
+    def with_pod_type(self, pod_type):
+        return self._by_pod_type.get(pod_type, [])
+
+    def with_prefix(self, prefix):
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        end = start
+        while end < len(self._sorted_names) and self._sorted_names[end].startswith(prefix):
+            end += 1
+        return self._sorted_tasks[start:end]
+
+
+def pod_name(task_name):
+    '''Returns the pod instance of an SDK task name, e.g. "hello-0-server" => "hello-0", or the task
+    name itself if it doesn't follow the "<type>-<index>-<task>" convention'''
+    match = _POD_TASK_NAME_PATTERN.match(task_name)
+    return match.group(1) if match else task_name
+
+
+def pod_type(task_name):
+    '''Returns the pod type of an SDK task name, e.g. "hello-0-server" => "hello", or the task name
+    itself if it doesn't follow the "<type>-<index>-<task>" convention'''
+    match = _POD_TASK_NAME_PATTERN.match(task_name)
+    return match.group(2) if match else task_name
+
+
+def get_pod_rollout(old_task_ids, tasks):
+    '''Compares a previous set of task ids against the current tasks, returning a tuple of
+    (rolled, not_rolled) pod names. A pod has rolled once none of its current tasks are old.'''
+    old_task_ids = set(old_task_ids)
+    pods = collections.defaultdict(bool)
+    for task in tasks:
+        name = pod_name(task['name'])
+        pods[name] = pods[name] or task['id'] in old_task_ids
+    return (sorted(name for name, has_old in pods.items() if not has_old),
+            sorted(name for name, has_old in pods.items() if has_old))
+
 
 def check_running(service_name, expected_task_count, timeout_seconds=15 * 60):
     def fn():
         try:
-            tasks = shakedown.get_service_tasks(service_name)
+            tasks = get_snapshot(service_name).tasks
         except dcos.errors.DCOSHTTPException:
             sdk_utils.out('Failed to get tasks for service {}'.format(service_name))
             tasks = []
@@ -30,29 +149,26 @@ def check_running(service_name, expected_task_count, timeout_seconds=15 * 60):
     shakedown.wait_for(lambda: fn(), noisy=True, timeout_seconds=timeout_seconds)
 
 
-def get_task_ids(service_name, task_prefix):
-    tasks = shakedown.get_service_tasks(service_name)
-    matching_tasks = [t for t in tasks if t['name'].startswith(task_prefix)]
-    return [t['id'] for t in matching_tasks]
+def get_task_ids(service_name, task_prefix, max_age_seconds=None):
+    return [t['id'] for t in get_snapshot(service_name, max_age_seconds).with_prefix(task_prefix)]
 
 
 def check_tasks_updated(service_name, prefix, old_task_ids, timeout_seconds=15 * 60):
+    old_task_set = set(old_task_ids)
+
     def fn():
         try:
-            task_ids = get_task_ids(service_name, prefix)
+            tasks = get_snapshot(service_name).with_prefix(prefix)
         except dcos.errors.DCOSHTTPException:
             sdk_utils.out('Failed to get task ids for service {}'.format(service_name))
-            task_ids = []
-
-        sdk_utils.out('Waiting for tasks starting with "{}" to be updated:\n- Old tasks: {}\n- Current tasks: {}'.format(
-            prefix, sorted(old_task_ids), sorted(task_ids)))
-        all_updated = True
-        for id in task_ids:
-            if id in old_task_ids:
-                all_updated = False
-        if len(task_ids) < len(old_task_ids):
-            all_updated = False
-        return all_updated
+            tasks = []
+        task_ids = set(t['id'] for t in tasks)
+        rolled, not_rolled = get_pod_rollout(old_task_set, tasks)
+
+        sdk_utils.out('Waiting for tasks starting with "{}" to be updated:\n- Old tasks: {}\n- Current tasks: {}\n'
+                      '- Rolled pods: {}\n- Pods not yet rolled: {}'.format(
+                          prefix, sorted(old_task_set), sorted(task_ids), rolled, not_rolled))
+        return not (task_ids & old_task_set) and len(task_ids) >= len(old_task_set)
 
     shakedown.wait_for(lambda: fn(), noisy=True, timeout_seconds=timeout_seconds)
 
@@ -60,7 +176,7 @@ def check_tasks_updated(service_name, prefix, old_task_ids, timeout_seconds=15 *
 def check_tasks_not_updated(service_name, prefix, old_task_ids):
     sdk_plan.wait_for_completed_deployment(service_name)
     sdk_plan.wait_for_completed_recovery(service_name)
-    task_ids = get_task_ids(service_name, prefix)
+    task_ids = get_task_ids(service_name, prefix, max_age_seconds=0)
     task_sets = "\n- Old tasks: {}\n- Current tasks: {}".format(sorted(old_task_ids), sorted(task_ids))
     sdk_utils.out('Checking tasks starting with "{}" have not been updated:{}'.format(prefix, task_sets))
     assert set(old_task_ids).issubset(set(task_ids)), "Tasks got updated:{}".format(task_sets)
@@ -76,5 +192,8 @@ def kill_task_with_pattern(pattern, agent_host=None):
     else:
         result = shakedown.run_command_on_agent(agent_host, command)
 
+    # We don't know which service(s) the pattern matched:
+    invalidate()
+
     if not result:
         raise RuntimeError('Failed to kill task with pattern "{}"'.format(pattern))
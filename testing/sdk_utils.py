@@ -1,6 +1,10 @@
+import json
+import os
 import sys
 
 import dcos
+import dcos.errors
+import dcos.http
 import shakedown
 import pytest
 
@@ -50,11 +54,51 @@ def list_reserved_resources():
         out(msg % (slave['id'], slave['hostname'], reserved_resources))
 
 
+def unreserve_resources():
+    '''Destroys any persistent volumes and releases any dynamic reservations left on agents, for
+       example by uninstalls which didn't clean up after themselves, so that a cluster may be reused
+       by other tests.'''
+    master_url = '{}/mesos'.format(shakedown.dcos_url())
+    slaves = dcos.http.get('{}/slaves'.format(master_url)).json()['slaves']
+    for slave in slaves:
+        for role, resources in slave.get('reserved_resources_full', {}).items():
+            volumes = [r for r in resources if 'persistence' in r.get('disk', {})]
+            reservations = [_without_volume_info(r) for r in resources]
+            out('Releasing {} volumes/{} reservations for role {} on {}'.format(
+                len(volumes), len(reservations), role, slave['hostname']))
+            try:
+                if volumes:
+                    dcos.http.post('{}/destroy-volumes'.format(master_url),
+                                   data={'slaveId': slave['id'], 'volumes': json.dumps(volumes)})
+                dcos.http.post('{}/unreserve'.format(master_url),
+                               data={'slaveId': slave['id'], 'resources': json.dumps(reservations)})
+            except dcos.errors.DCOSException as e:
+                out('Failed to release resources for role {} on {}: {}'.format(role, slave['hostname'], e))
+
+
+def _without_volume_info(resource):
+    '''Once a volume is destroyed, the underlying disk reservation no longer has its persistence info'''
+    if 'persistence' not in resource.get('disk', {}):
+        return resource
+    resource = dict(resource)
+    disk = {k: v for k, v in resource['disk'].items() if k not in ('persistence', 'volume')}
+    if disk:
+        resource['disk'] = disk
+    else:
+        del resource['disk']
+    return resource
+
+
 def get_foldered_name(service_name):
     # DCOS 1.9 & earlier don't support "foldered", service names aka marathon
     # group names
     if shakedown.dcos_version_less_than("1.10"):
         return service_name
+    # When test modules are run in parallel shards (see run_tests.py), each
+    # shard gets its own subfolder so that their services don't collide
+    shard_folder = os.environ.get('TEST_SERVICE_FOLDER')
+    if shard_folder:
+        return "/test/integration/{}/{}".format(shard_folder, service_name)
     return "/test/integration/" + service_name
 
 def get_zk_path(service_name):
@@ -62,6 +106,9 @@ def get_zk_path(service_name):
     # group names
     if shakedown.dcos_version_less_than("1.10"):
         return service_name
+    shard_folder = os.environ.get('TEST_SERVICE_FOLDER')
+    if shard_folder:
+        return "test__integration__{}__{}".format(shard_folder, service_name)
     return "test__integration__" + service_name
 
 
@@ -0,0 +1,102 @@
+'''Utilities for waiting on several service conditions at once.
+
+Rather than waiting on each condition serially with its own polling loop, tests declare all the
+conditions they need and a single loop evaluates them against state which is fetched at most once
+per cycle, no matter how many conditions read it:
+
+    sdk_wait.wait_for_all([
+        sdk_wait.plan_status('hdfs', 'deploy', 'COMPLETE'),
+        sdk_wait.plan_status('hdfs', 'recovery', 'COMPLETE'),
+        sdk_wait.tasks_running('hdfs', 8)])
+'''
+
+import dcos.errors
+import shakedown
+
+import sdk_api
+import sdk_plan
+import sdk_tasks
+import sdk_utils
+
+
+def plan_status(service_name, plan_name, status):
+    description, fn = sdk_plan.plan_status(plan_name, status)
+    return ('{}: {}'.format(service_name, description),
+            lambda snapshots: _check_plan(snapshots.plan(service_name, plan_name), fn))
+
+
+def phase_status(service_name, plan_name, phase_name, status):
+    description, fn = sdk_plan.phase_status(plan_name, phase_name, status)
+    return ('{}: {}'.format(service_name, description),
+            lambda snapshots: _check_plan(snapshots.plan(service_name, plan_name), fn))
+
+
+def step_status(service_name, plan_name, phase_name, step_name, status):
+    description, fn = sdk_plan.step_status(plan_name, phase_name, step_name, status)
+    return ('{}: {}'.format(service_name, description),
+            lambda snapshots: _check_plan(snapshots.plan(service_name, plan_name), fn))
+
+
+def tasks_running(service_name, expected_task_count):
+    def fn(snapshots):
+        return len(snapshots.tasks(service_name).with_state('TASK_RUNNING')) >= expected_task_count
+    return ('{}: at least {} running tasks'.format(service_name, expected_task_count), fn)
+
+
+def suppressed(service_name):
+    return ('{}: suppressed'.format(service_name), lambda snapshots: snapshots.suppressed(service_name))
+
+
+def wait_for_all(conditions, timeout_seconds=15 * 60, sleep_seconds=5):
+    '''Waits until all of the provided (description, predicate) conditions hold in the same polling
+    cycle. Each predicate is passed a Snapshots object for that cycle.'''
+    def fn():
+        snapshots = Snapshots()
+        pending = [description for description, predicate in conditions if not predicate(snapshots)]
+        sdk_utils.out('Waiting for {}/{} conditions ({} requests this cycle):\n- {}'.format(
+            len(pending), len(conditions), snapshots.fetch_count,
+            '\n- '.join(pending) if pending else '(none)'))
+        return not pending
+
+    shakedown.wait_for(fn, noisy=True, timeout_seconds=timeout_seconds, sleep_seconds=sleep_seconds)
+
+
+class Snapshots(object):
+    '''Lazily fetches and caches service state for the duration of a single polling cycle'''
+
+    def __init__(self):
+        self._plans = {}
+        self._tasks = {}
+        self._suppressed = {}
+        self.fetch_count = 0
+
+    def plan(self, service_name, plan_name):
+        key = (service_name, plan_name)
+        if key not in self._plans:
+            self.fetch_count += 1
+            self._plans[key] = sdk_plan.get_watcher(service_name, plan_name).snapshot(max_age_seconds=0)
+        return self._plans[key]
+
+    def tasks(self, service_name):
+        if service_name not in self._tasks:
+            self.fetch_count += 1
+            try:
+                self._tasks[service_name] = sdk_tasks.get_snapshot(service_name, max_age_seconds=0)
+            except dcos.errors.DCOSHTTPException:
+                sdk_utils.out('Failed to get tasks for service {}'.format(service_name))
+                self._tasks[service_name] = sdk_tasks.TaskSnapshot(service_name, [])
+        return self._tasks[service_name]
+
+    def suppressed(self, service_name):
+        if service_name not in self._suppressed:
+            self.fetch_count += 1
+            try:
+                self._suppressed[service_name] = sdk_api.is_suppressed(service_name)
+            except Exception as e:
+                sdk_utils.out('Failed to get suppressed state for service {}: {}'.format(service_name, e))
+                self._suppressed[service_name] = False
+        return self._suppressed[service_name]
+
+
+def _check_plan(plan, fn):
+    return plan is not None and fn(plan)
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Serves the files in a directory over HTTP, for agents fetching locally
+published artifacts (see publish_http.py).
+
+Each connection is handled in its own thread, so that several agents
+fetching the same large scheduler/executor artifacts at once don't queue
+behind each other.  File bodies are sent with sendfile(), without copying
+them through userspace.  Connections are kept alive between requests, and
+single byte ranges (Range/If-Range) and conditional requests
+(If-None-Match/If-Modified-Since) are supported, so that interrupted or
+repeated fetches don't start over.
+
+Only regular files directly reachable from the root are served: there are
+no directory listings, and hidden files (such as the server's own pid and
+log files) are not served.
+
+Each request's client, status, size and duration are logged and kept in
+memory.  Aggregate throughput, connection counts and per-file timings are
+served as json at /_stats (add ?requests=1 for the individual requests), and
+written to --stats-file on exit, for correlating slow deployments with
+artifact fetches.
+
+  $ ./artifact_server.py /tmp/dcos-http-hello-world --host 0.0.0.0 --port 8000
+"""
+
+import argparse
+import collections
+import email.utils
+import http.server
+import json
+import logging
+import mimetypes
+import os
+import re
+import signal
+import socketserver
+import stat
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# one range, e.g. "bytes=0-499", "bytes=500-" or "bytes=-500"
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+STATS_PATH = '/_stats'
+# the most recent requests are kept individually, everything is kept in the totals
+MAX_RECENT_REQUESTS = 10000
+# throughput is also reported over requests completed within this window
+RECENT_WINDOW_SECONDS = 60
+
+
+def make_etag(file_stat):
+    return '"{:x}-{:x}"'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def _etag_matches(header, etag):
+    "Weak comparison against an If-None-Match list, per RFC 7232"
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.replace('W/', '', 1) == etag:
+            return True
+    return False
+
+
+def parse_range(header, size):
+    """Returns the (start, end) byte offsets (inclusive) requested by a Range
+    header against a file of the given size, None if the header should be
+    ignored (malformed or multiple ranges, which we answer with the whole
+    file), or False if the range can't be satisfied."""
+    match = _RANGE_PATTERN.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return (max(0, size - length), size - 1)
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        return False
+    return (start, min(end, size - 1))
+
+
+class ServerStats(object):
+    "Per-request metrics and connection counts, updated by the handler threads"
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._connections_open = 0
+        self._connections_peak = 0
+        self._connections_total = 0
+        self._requests_active = 0
+        self._requests_total = 0
+        self._bytes_total = 0
+        self._seconds_total = 0.0
+        self._statuses = collections.Counter()
+        self._paths = {}
+        self._recent = collections.deque(maxlen=MAX_RECENT_REQUESTS)
+
+    def connection_opened(self):
+        with self._lock:
+            self._connections_open += 1
+            self._connections_total += 1
+            self._connections_peak = max(self._connections_peak, self._connections_open)
+
+    def connection_closed(self):
+        with self._lock:
+            self._connections_open -= 1
+
+    def request_started(self):
+        with self._lock:
+            self._requests_active += 1
+
+    def request_finished(self, client, method, path, status, sent_bytes, start, seconds):
+        with self._lock:
+            self._requests_active -= 1
+            self._requests_total += 1
+            self._bytes_total += sent_bytes
+            self._seconds_total += seconds
+            self._statuses[status] += 1
+            if status in (200, 206, 304):
+                # not for errors, so that bogus paths can't grow this without bound
+                path_stats = self._paths.setdefault(path, {
+                    'requests': 0, 'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                path_stats['requests'] += 1
+                path_stats['bytes'] += sent_bytes
+                path_stats['seconds'] += seconds
+                path_stats['max_seconds'] = max(path_stats['max_seconds'], seconds)
+            self._recent.append({
+                'client': client, 'method': method, 'path': path, 'status': status,
+                'bytes': sent_bytes, 'start': start, 'seconds': seconds})
+
+    def snapshot(self, include_requests=False):
+        now = time.time()
+        uptime = now - self.started
+        with self._lock:
+            window_start = now - RECENT_WINDOW_SECONDS
+            recent_bytes = sum(request['bytes'] for request in self._recent
+                               if request['start'] + request['seconds'] >= window_start)
+            snapshot = {
+                'started': self.started,
+                'uptime_seconds': uptime,
+                'connections': {
+                    'open': self._connections_open,
+                    'peak': self._connections_peak,
+                    'total': self._connections_total},
+                'requests': {
+                    'active': self._requests_active,
+                    'total': self._requests_total,
+                    'by_status': {str(status): count for status, count in self._statuses.items()}},
+                'bytes_sent': self._bytes_total,
+                'throughput_bytes_per_second': {
+                    'overall': self._bytes_total / uptime if uptime else 0,
+                    'last_{}s'.format(RECENT_WINDOW_SECONDS): recent_bytes / min(uptime, RECENT_WINDOW_SECONDS) if uptime else 0,
+                    # how fast individual fetches went, while they were going
+                    'per_request': self._bytes_total / self._seconds_total if self._seconds_total else 0},
+                'paths': {path: dict(path_stats) for path, path_stats in self._paths.items()}}
+            if include_requests:
+                snapshot['recent_requests'] = list(self._recent)
+        return snapshot
+
+    def summary(self):
+        snapshot = self.snapshot()
+        return '{} requests, {} bytes sent in {:.0f}s, peak {} concurrent connections'.format(
+            snapshot['requests']['total'], snapshot['bytes_sent'],
+            snapshot['uptime_seconds'], snapshot['connections']['peak'])
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'dcos-commons-artifact-server'
+    # drop idle keep-alive connections, rather than holding a thread for each forever
+    timeout = 60
+
+    def setup(self):
+        super().setup()
+        self.server.stats.connection_opened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self.server.stats.connection_closed()
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+    def log_request(self, code='-', size='-'):
+        # logged with its size and duration once the response has been sent, see _handle()
+        pass
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path == STATS_PATH:
+            self._send_stats()
+        else:
+            self._handle(send_body=True)
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def _handle(self, send_body):
+        stats = self.server.stats
+        self._status = None
+        self._sent_bytes = 0
+        start = time.time()
+        stats.request_started()
+        try:
+            self._serve(send_body)
+        finally:
+            seconds = time.time() - start
+            # without the query string, and decoded, so that each file is only counted once
+            path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+            stats.request_finished(self.client_address[0], self.command, path,
+                                   self._status, self._sent_bytes, start, seconds)
+            self.log_message('"%s" %s %s %.3fs', self.requestline, self._status,
+                             self._sent_bytes, seconds)
+
+    def _send_stats(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        include_requests = query.get('requests', ['0'])[0] not in ('', '0')
+        data = json.dumps(self.server.stats.snapshot(include_requests), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _resolve_path(self):
+        "Returns the filesystem path for the request, or None if it can't be served"
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = path.split('/')[1:]
+        if not parts or any(not part or part.startswith('.') for part in parts):
+            return None
+        return os.path.join(self.server.rootdir, *parts)
+
+    def _send_error_response(self, status, extra_headers=()):
+        # like send_error, but without an html body
+        self.send_response(status)
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _serve(self, send_body):
+        path = self._resolve_path()
+        try:
+            fileobj = open(path, 'rb') if path else None
+        except OSError:
+            fileobj = None
+        if not fileobj:
+            self._send_error_response(404)
+            return
+        with fileobj:
+            file_stat = os.fstat(fileobj.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                self._send_error_response(404)
+                return
+            self._serve_file(fileobj, file_stat, path, send_body)
+
+    def _serve_file(self, fileobj, file_stat, path, send_body):
+        size = file_stat.st_size
+        etag = make_etag(file_stat)
+        last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+        validators = [('ETag', etag), ('Last-Modified', last_modified)]
+
+        if self._not_modified(etag, file_stat):
+            self._send_error_response(304, validators)
+            return
+
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if range_header and self._if_range_matches(etag, last_modified):
+            byte_range = parse_range(range_header, size)
+            if byte_range is False:
+                self._send_error_response(416, [('Content-Range', 'bytes */{}'.format(size))])
+                return
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        length = end - start + 1
+        self.send_header('Content-Type', self.server.guess_type(path))
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in validators:
+            self.send_header(name, value)
+        self.end_headers()
+        if not send_body or length <= 0:
+            return
+        self.wfile.flush()
+        try:
+            # zero-copy where the platform supports it, falling back to send()
+            self._sent_bytes = self.connection.sendfile(fileobj, start, length)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # sendfile leaves the file position just past what was sent
+            self._sent_bytes = fileobj.tell() - start
+            logger.info('%s gave up on %s: %s', self.address_string(), self.path, e)
+            self.close_connection = True
+
+    def _not_modified(self, etag, file_stat):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            # takes precedence over If-Modified-Since, per RFC 7232
+            return _etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(file_stat.st_mtime) <= since
+        return False
+
+    def _if_range_matches(self, etag, last_modified):
+        if_range = self.headers.get('If-Range')
+        return not if_range or if_range.strip() in (etag, last_modified)
+
+
+class ArtifactServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # agents tend to connect all at once when a service is deployed
+    request_queue_size = 64
+
+    def __init__(self, rootdir, host='127.0.0.1', port=0, json_content_type=None):
+        super().__init__((host, port), _Handler)
+        self.rootdir = os.path.abspath(rootdir)
+        self.json_content_type = json_content_type
+        self.stats = ServerStats()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def guess_type(self, path):
+        if self.json_content_type and path.endswith('.json'):
+            return self.json_content_type
+        return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    def start(self):
+        "Serve in a background thread"
+        thread = threading.Thread(target=self.serve_forever, name='artifact-server', daemon=True)
+        thread.start()
+        return thread
+
+
+def _remove_pidfile(path):
+    "Removes the pidfile, unless it's been taken over by a newer server"
+    try:
+        with open(path) as pidfile:
+            if pidfile.read().strip() == str(os.getpid()):
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve a directory of artifacts over HTTP")
+    parser.add_argument("rootdir")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=0,
+            help="Port to listen on (default: an ephemeral port)")
+    parser.add_argument("--json-content-type", default=None,
+            help="Content-Type for .json files, e.g. a universe repo's versioned type")
+    parser.add_argument("--pidfile", default=None,
+            help="File to write our pid to once we're listening, and remove on exit")
+    parser.add_argument("--stats-file", default=None,
+            help="File to write request metrics to as json on exit")
+    args = parser.parse_args(argv[1:])
+    if not os.path.isdir(args.rootdir):
+        logger.error('Not a directory: %s', args.rootdir)
+        return 1
+    server = ArtifactServer(args.rootdir, args.host, args.port, args.json_content_type)
+    logger.info('Serving %s at %s', server.rootdir, server.url)
+    if args.pidfile:
+        with open(args.pidfile, 'w') as pidfile:
+            pidfile.write('{}\n'.format(os.getpid()))
+    # exit cleanly when stopped by publish_http
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info('Exiting: %s', server.stats.summary())
+        if args.stats_file:
+            with open(args.stats_file, 'w') as stats_file:
+                json.dump(server.stats.snapshot(include_requests=True), stats_file, indent=2)
+        if args.pidfile:
+            _remove_pidfile(args.pidfile)
+    return 0
+
+
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest artifact_server
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-499', 1000), (0, 499))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parse_range('bytes=-300', 1000), (700, 999))
+        # clamped to the file:
+        self.assertEqual(parse_range('bytes=900-2000', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=-2000', 1000), (0, 999))
+        self.assertEqual(parse_range(' bytes=1-1 ', 1000), (1, 1))
+
+    def test_parse_range_ignored(self):
+        for header in ('bytes=-', 'bytes=5-1', 'bytes=0-1,5-9', 'items=0-1', 'bytes=a-b', ''):
+            self.assertIsNone(parse_range(header, 1000), header)
+
+    def test_parse_range_unsatisfiable(self):
+        self.assertIs(parse_range('bytes=1000-', 1000), False)
+        self.assertIs(parse_range('bytes=1000-1001', 1000), False)
+        self.assertIs(parse_range('bytes=-0', 1000), False)
+        self.assertIs(parse_range('bytes=0-', 0), False)
+
+    def test_path_stats_ignore_query(self):
+        rootdir = tempfile.mkdtemp(prefix='artifact-server-')
+        self.addCleanup(shutil.rmtree, rootdir)
+        with open(os.path.join(rootdir, 'artifact.zip'), 'wb') as f:
+            f.write(b'content')
+        server = ArtifactServer(rootdir)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server.start()
+        for path in ('/artifact.zip', '/artifact.zip?x=1', '/artifact.zip?x=2', '/artifact%2Ezip'):
+            with urllib.request.urlopen(server.url + path) as response:
+                self.assertEqual(response.read(), b'content')
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(server.url + '/missing.zip?x=1')
+        # requests are recorded just after their responses have been sent
+        deadline = time.time() + 10
+        while server.stats.snapshot()['requests']['total'] < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        snapshot = server.stats.snapshot()
+        self.assertEqual(list(snapshot['paths'].keys()), ['/artifact.zip'])
+        self.assertEqual(snapshot['paths']['/artifact.zip']['requests'], 4)
+        self.assertEqual(snapshot['paths']['/artifact.zip']['bytes'], 4 * len(b'content'))
+        self.assertEqual(snapshot['requests']['by_status'], {'200': 4, '404': 1})
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    sys.exit(main(sys.argv))
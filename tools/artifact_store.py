@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+#
+# A local content-addressed store of build artifacts, shared by publish_aws, publish_http and
+# release_builder, so that an artifact which is already on this machine (built here, or
+# downloaded for an earlier release) never needs to be fetched again, and identical artifacts
+# across packages and versions are only stored once.
+#
+# Env:
+#   ARTIFACT_STORE_DIR (default: ~/.cache/dcos-commons/artifacts)
+#   ARTIFACT_STORE_MAX_GB (default: 10)
+#     Least recently used artifacts are evicted beyond this size
+#   ARTIFACT_STORE_DISABLE
+#     If set, the store isn't used
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+logger = logging.getLogger(__name__)
+
+PLACEMENT_METHODS = ['hardlink', 'reflink', 'copy']
+# for artifacts which are only worth keeping if that takes no extra space
+LINK_METHODS = ['hardlink', 'reflink']
+
+# from linux/fs.h: clone a file's extents into another file on filesystems which support it
+# (btrfs, xfs), so that the copy shares storage with the original until either is modified
+_FICLONE = 0x40049409
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+'''
+
+
+def reflink(srcpath, destpath):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are only supported on linux')
+    with open(srcpath, 'rb') as src, open(destpath, 'wb') as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            dest.close()
+            os.remove(destpath)
+            raise
+    shutil.copystat(srcpath, destpath)
+
+
+def place_file(method, srcpath, destpath):
+    '''Makes the content of srcpath available at destpath (which mustn't exist) using the given
+    method: hardlink, reflink, symlink or copy'''
+    if method == 'hardlink':
+        os.link(srcpath, destpath)
+    elif method == 'reflink':
+        reflink(srcpath, destpath)
+    elif method == 'symlink':
+        os.symlink(os.path.abspath(srcpath), destpath)
+    else:
+        # copy2 keeps the mtime, for detecting whether the file has changed later
+        shutil.copy2(srcpath, destpath)
+
+
+def place_file_with_any(srcpath, destpath, methods=PLACEMENT_METHODS):
+    '''Places srcpath at destpath using the first of the methods which works (e.g. hardlinks only
+    work within a filesystem). Returns the method used.'''
+    for method in methods:
+        try:
+            place_file(method, srcpath, destpath)
+            return method
+        except OSError as e:
+            if method == methods[-1]:
+                raise
+            logger.debug('Unable to {} {} to {}: {}'.format(method, srcpath, destpath, e))
+
+
+def _default_store_dir():
+    return os.environ.get('ARTIFACT_STORE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'dcos-commons', 'artifacts'))
+
+
+class ArtifactStore(object):
+    '''Artifacts keyed by their sha256, with the least recently used ones evicted once the total
+    size exceeds max_bytes.
+
+    Artifacts are added by hardlinking where possible, so adding a freshly built artifact is
+    free. Since a hardlinked artifact could then be modified in place through its other name,
+    each object's size and mtime are recorded when it's added, and an object which no longer
+    matches them is dropped rather than returned.'''
+
+    def __init__(self, store_dir=None, max_bytes=None):
+        self._store_dir = store_dir or _default_store_dir()
+        if max_bytes is None:
+            max_bytes = float(os.environ.get('ARTIFACT_STORE_MAX_GB', 10)) * 1000 * 1000 * 1000
+        self._max_bytes = max_bytes
+        self._objects_dir = os.path.join(self._store_dir, 'objects')
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._index_path = os.path.join(self._store_dir, 'index.db')
+        with self._index() as conn:
+            conn.executescript(_SCHEMA)
+        # the index is shared with other processes too, but this keeps our own evictions orderly
+        self._lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def _index(self):
+        # a connection per operation: callers add and fetch from several threads at once
+        conn = sqlite3.connect(self._index_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+    def _object_path(self, sha256):
+        return os.path.join(self._objects_dir, sha256[:2], sha256)
+
+
+    def _get_valid_path(self, sha256):
+        '''Returns the object's path if it's present and unmodified, dropping it otherwise'''
+        with self._index() as conn:
+            row = conn.execute('SELECT size, mtime_ns FROM objects WHERE sha256 = ?', (sha256,)).fetchone()
+            if not row:
+                return None
+            path = self._object_path(sha256)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if not stat or (stat.st_size, stat.st_mtime_ns) != row:
+                logger.info('Dropping missing or modified artifact from store: {}'.format(sha256))
+                conn.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+                if stat:
+                    os.remove(path)
+                return None
+            conn.execute('UPDATE objects SET last_used = ? WHERE sha256 = ?', (time.time(), sha256))
+            return path
+
+
+    def contains(self, sha256):
+        return self._get_valid_path(sha256) is not None
+
+
+    def get_file(self, sha256, destpath, methods=PLACEMENT_METHODS):
+        '''Places the artifact with the given sha256 at destpath, replacing anything already there.
+        Returns the method used, or None if the store doesn't have the artifact.'''
+        path = self._get_valid_path(sha256)
+        if not path:
+            return None
+        if os.path.lexists(destpath):
+            os.remove(destpath)
+        return place_file_with_any(path, destpath, methods)
+
+
+    def add(self, filepath, sha256, methods=PLACEMENT_METHODS):
+        '''Adds a file whose sha256 has already been calculated, unless the store already has it,
+        using the first of the methods which works. Returns the path of the stored object, which
+        mustn't be modified.'''
+        path = self._get_valid_path(sha256)
+        if path:
+            return path
+        path = self._object_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # place under a temporary name then rename, so that concurrent adds never see a partial object
+        tmp_path = '{}.tmp-{}-{}'.format(path, os.getpid(), threading.get_ident())
+        method = place_file_with_any(filepath, tmp_path, methods)
+        os.replace(tmp_path, path)
+        stat = os.stat(path)
+        with self._index() as conn:
+            conn.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+                         (sha256, stat.st_size, stat.st_mtime_ns, time.time()))
+        logger.info('Added {} to artifact store ({}): {}'.format(os.path.basename(filepath), method, sha256))
+        self._evict(keep=sha256)
+        return path
+
+
+    def _evict(self, keep):
+        with self._lock, self._index() as conn:
+            total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+            if total_bytes <= self._max_bytes:
+                return
+            for sha256, size in conn.execute(
+                    'SELECT sha256, size FROM objects WHERE sha256 != ? ORDER BY last_used', (keep,)).fetchall():
+                if total_bytes <= self._max_bytes:
+                    break
+                logger.info('Evicting least recently used artifact from store ({} bytes): {}'.format(size, sha256))
+                conn.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+                try:
+                    os.remove(self._object_path(sha256))
+                except OSError:
+                    pass
+                total_bytes -= size
+
+
+def add_artifacts(store, sha256s, methods=LINK_METHODS):
+    '''Adds artifacts ({filepath: sha256}) to the store, by default only where they can be linked in
+    for free. The store is only an optimization, so a failure (e.g. the store being on another
+    filesystem, a full disk or a locked index) is logged rather than raised, and the remaining
+    artifacts aren't added. Returns whether they were all added.'''
+    try:
+        for filepath, sha256 in sha256s.items():
+            store.add(filepath, sha256, methods)
+        return True
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Not adding artifacts to the artifact store: {}'.format(e))
+        return False
+
+
+def open_store():
+    '''Returns the artifact store, or None if it's disabled or can't be used'''
+    if os.environ.get('ARTIFACT_STORE_DISABLE', ''):
+        return None
+    try:
+        return ArtifactStore()
+    except (OSError, sqlite3.Error) as e:
+        logger.warning('Unable to use artifact store, continuing without it: {}'.format(e))
+        return None
+
+
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest artifact_store
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='artifact-store-')
+        self.store_dir = os.path.join(self.test_dir, 'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, filename, content):
+        path = os.path.join(self.test_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_add_and_get(self):
+        store = ArtifactStore(self.store_dir)
+        self.assertFalse(store.contains('abc'))
+        self.assertIsNone(store.get_file('abc', os.path.join(self.test_dir, 'out.zip')))
+        stored_path = store.add(self._write('artifact.zip', b'content'), 'abc')
+        self.assertTrue(stored_path.startswith(self.store_dir))
+        self.assertTrue(store.contains('abc'))
+        # adding it again is a no-op:
+        self.assertEqual(store.add(self._write('copy.zip', b'content'), 'abc'), stored_path)
+        out_path = self._write('out.zip', b'replaced')
+        self.assertEqual(store.get_file('abc', out_path, ['copy']), 'copy')
+        with open(out_path, 'rb') as f:
+            self.assertEqual(f.read(), b'content')
+
+    def test_modified_artifact_dropped(self):
+        store = ArtifactStore(self.store_dir)
+        artifact_path = self._write('artifact.zip', b'content')
+        store.add(artifact_path, 'abc', ['hardlink'])
+        # rewritten in place through the build's hardlink:
+        with open(artifact_path, 'ab') as f:
+            f.write(b' and more')
+        self.assertFalse(store.contains('abc'))
+        self.assertFalse(os.path.exists(os.path.join(self.store_dir, 'objects', 'ab', 'abc')))
+
+    def test_evicts_least_recently_used(self):
+        store = ArtifactStore(self.store_dir, max_bytes=25)
+        for sha256 in ('a1', 'b2', 'c3'):
+            store.add(self._write(sha256, b'x' * 10), sha256, ['copy'])
+            time.sleep(0.01)
+            if sha256 == 'b2':
+                # a1 is now more recently used than b2
+                self.assertTrue(store.contains('a1'))
+        self.assertTrue(store.contains('a1'))
+        self.assertFalse(store.contains('b2'))
+        self.assertTrue(store.contains('c3'))
+        # an artifact bigger than the store is kept until the next add
+        store.add(self._write('big', b'x' * 100), 'd4', ['copy'])
+        self.assertEqual([sha256 for sha256 in ('a1', 'c3', 'd4') if store.contains(sha256)], ['d4'])
+
+    def test_add_artifacts_failure_is_logged(self):
+        store = ArtifactStore(self.store_dir)
+        paths = {self._write('a.zip', b'a'): 'a1', os.path.join(self.test_dir, 'missing.zip'): 'b2'}
+        with self.assertLogs(logger, 'WARNING'):
+            self.assertFalse(add_artifacts(store, paths))
+        self.assertTrue(add_artifacts(store, {self._write('c.zip', b'c'): 'c3'}))
+        self.assertTrue(store.contains('c3'))
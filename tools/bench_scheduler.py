@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Benchmark test.py's multi-cluster scheduling offline.
+
+Runs test.py's parallel test flow end to end against a fake CCM (see
+fake_ccm.py), with every framework's tests replaced by fake_test_runner.py,
+so that cluster launches, retries, test scheduling, cluster recycling and
+teardown can be exercised with tens of clusters on one machine.
+
+Frameworks are synthesized by cycling through the real ones, keeping their
+agent requirements and (time-scaled) estimated durations.  At the default
+time scale of 0.001, a 90 minute test takes 5.4 seconds.
+
+  $ ./bench_scheduler.py --clusters 20 --frameworks 60 --launch-failure-rate 0.1
+
+At the end, the wall-clock time is reported alongside fwinfo's prediction,
+together with the fake CCM's request counts and any clusters left running.
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import clustinfo
+import configure_test_cluster
+import fake_ccm
+import fwinfo
+
+logger = logging.getLogger("bench-scheduler")
+
+_TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_ROOT = os.path.dirname(_TOOLS_DIR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark test.py scheduling against a fake CCM")
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--frameworks", type=int, default=None,
+            help="Number of frameworks to test (default: 3 per cluster)")
+    parser.add_argument("--time-scale", type=float, default=0.001,
+            help="Multiplier for framework test durations")
+    parser.add_argument("--launch-seconds", type=float, nargs=2, default=[1, 3],
+            metavar=("MIN", "MAX"), help="Range of fake cluster launch latencies")
+    parser.add_argument("--launch-failure-rate", type=float, default=0.0)
+    parser.add_argument("--request-failure-rate", type=float, default=0.0,
+            help="Fraction of CCM requests which get a 500 response")
+    parser.add_argument("--test-failure-rate", type=float, default=0.0)
+    parser.add_argument("--recycle-seconds", type=float, default=0.5)
+    parser.add_argument("--cluster-teardown", choices=('success-only', 'always', 'never'),
+            default='always')
+    parser.add_argument("--fail-fast", action='store_false', dest='continue_on_error')
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+def _import_test_py():
+    # test.py isn't a module (and would clash with the stdlib's "test"), and
+    # parses sys.argv at import time
+    saved_argv = sys.argv
+    sys.argv = [os.path.join(_REPO_ROOT, 'test.py')]
+    try:
+        spec = importlib.util.spec_from_file_location('dcos_commons_test',
+                                                      os.path.join(_REPO_ROOT, 'test.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        sys.argv = saved_argv
+
+
+def _make_frameworks(count, time_scale, bench_root):
+    """Create count frameworks under bench_root/frameworks, named after the
+    real ones, and register them with fwinfo"""
+    base_names = sorted(os.listdir(os.path.join(_REPO_ROOT, 'frameworks')))
+    for i in range(count):
+        base_name = base_names[i % len(base_names)]
+        name = "%s-%s" % (base_name, i // len(base_names))
+        universe_dir = os.path.join(bench_root, 'frameworks', name, 'universe')
+        os.makedirs(universe_dir)
+        with open(os.path.join(universe_dir, 'package.json'), 'w') as package_file:
+            json.dump({'name': name}, package_file)
+        framework = fwinfo.add_framework(name, repo_root=bench_root)
+        agents, minutes = fwinfo._TEST_REQUIREMENTS.get(base_name,
+                fwinfo._DEFAULT_TEST_REQUIREMENTS)
+        framework.required_agents = agents
+        framework.estimated_duration = minutes * 60 * time_scale
+
+
+def _write_test_plan(path, failure_rate, rand):
+    plan = {}
+    for framework in fwinfo.get_frameworks():
+        # actual durations vary around the estimates
+        plan[framework.name] = {
+            'seconds': framework.estimated_duration * rand.uniform(0.8, 1.2),
+            'fail': rand.random() < failure_rate}
+    with open(path, 'w') as plan_file:
+        json.dump(plan, plan_file)
+    return plan
+
+
+class _FakeClusterInitializer(object):
+    "The fake clusters can't be configured"
+    def __init__(self, *args):
+        pass
+
+    def apply_default_config(self, initmaster=True):
+        pass
+
+    def create_mount_volumes(self):
+        pass
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    rand = random.Random(args.seed)
+    frameworks = args.frameworks or 3 * args.clusters
+
+    ccm = fake_ccm.FakeCCM(tuple(args.launch_seconds), args.launch_failure_rate,
+                           args.request_failure_rate, seed=args.seed)
+    server = fake_ccm.FakeCCMServer(ccm)
+    server.start()
+    os.environ['CCM_URL'] = server.url
+    os.environ['CCM_AUTH_TOKEN'] = 'fake'
+    os.environ['CLUSTER_AUTH_TOKEN'] = 'fake' # skips logging in to the fake clusters
+    os.environ['CCM_GITHUB_LABEL'] = 'bench'
+
+    bench_root = tempfile.mkdtemp(prefix='bench_scheduler_')
+    try:
+        test = _import_test_py()
+        test.work_dir = bench_root
+        # no clusters really exist, so don't touch them
+        configure_test_cluster.ClusterInitializer = _FakeClusterInitializer
+        clustinfo.check_health = lambda cluster: True
+        def fake_recycle(cluster):
+            time.sleep(args.recycle_seconds)
+            return True
+        clustinfo.recycle_cluster = fake_recycle
+        test._runtests_script = lambda repo_root: os.path.join(_TOOLS_DIR, 'fake_test_runner.py')
+        test.STATUS_INTERVAL_SECONDS = max(1, test.STATUS_INTERVAL_SECONDS * args.time_scale)
+        clustinfo.ClusterPool.HEALTH_CHECK_INTERVAL_SECONDS = max(
+            1, clustinfo.ClusterPool.HEALTH_CHECK_INTERVAL_SECONDS * args.time_scale)
+
+        _make_frameworks(frameworks, args.time_scale, bench_root)
+        plan_path = os.path.join(bench_root, 'plan.json')
+        plan = _write_test_plan(plan_path, args.test_failure_rate, rand)
+        os.environ['FAKE_TEST_PLAN'] = plan_path
+        fwinfo.order_by_duration()
+        predicted = fwinfo.predict_run_time(args.clusters)
+
+        run_attrs = argparse.Namespace(parallel=True, cluster_count=args.clusters,
+                                       cluster_teardown=args.cluster_teardown,
+                                       continue_on_error=args.continue_on_error)
+        start = time.time()
+        try:
+            test.run_tests(run_attrs, _REPO_ROOT)
+            result = "all passed"
+        except Exception as e:
+            result = "failed: %s" % e
+        elapsed = time.time() - start
+
+        expected_failures = len([name for name, entry in plan.items() if entry['fail']])
+        launches = clustinfo.get_launch_attempts()
+        logger.info("%s frameworks on %s clusters: %s", frameworks, args.clusters, result)
+        logger.info("Wall time %.1fs, predicted %.1fs for tests alone (%.0f%% overhead)",
+                    elapsed, predicted, 100 * (elapsed - predicted) / predicted)
+        logger.info("Frameworks run: %s/%s, expected failures: %s",
+                    len([f for f in fwinfo.get_frameworks() if f.popen]), frameworks,
+                    expected_failures)
+        logger.info("Cluster launches: %s ok, %s failed",
+                    len([entry for entry in launches if entry.launch_succeeded]),
+                    len([entry for entry in launches if not entry.launch_succeeded]))
+        logger.info("Fake CCM: %s", ccm.stats())
+        # deletions are asynchronous, but the requests have all been made
+        logger.info("Clusters left running after teardown (%s): %s",
+                    args.cluster_teardown, ccm.live_cluster_count())
+    finally:
+        server.shutdown()
+        shutil.rmtree(bench_root, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,11 +6,21 @@ Specifically:
  auth token
  node count
  whether they were auto-created during test invocation
+ whether they're available for new tests, or being recycled
+
+ClusterPool launches clusters ahead of demand and hands them out to
+frameworks as leases, recycling clusters between frameworks rather than
+tearing them down.
 """
 
 import logging
 import os
+import ssl
+import subprocess
+import sys
+import threading
 import time
+import urllib.request
 
 import launch_ccm_cluster
 
@@ -34,11 +44,32 @@ def start_cluster(launch_config=None, reporting_name=None):
     logger.info("Started cluster: %s", cluster.cluster_id)
     return cluster
 
+def start_clusters(launch_configs, reporting_names):
+    """Launch a cluster per launch config, all at once.  Yields each
+    ClusterInfo as soon as it's ready, skipping any which fail to launch."""
+    for name in reporting_names:
+        _launch_recorder.start(name)
+    ccm_token = os.environ['CCM_AUTH_TOKEN']
+    for index, cluster_info in launch_ccm_cluster.start_clusters(ccm_token, launch_configs):
+        reporting_name = reporting_names[index]
+        if not cluster_info:
+            _launch_recorder.finish_fail(reporting_name)
+            logger.info("Failed to start %s", reporting_name)
+            continue
+        cluster = ClusterInfo(cluster_info["url"], cluster_info["auth_token"],
+                cluster_id=cluster_info["id"],
+                agent_count=launch_configs[index].private_agents)
+        _launch_recorder.finish_ok(reporting_name, cluster)
+        _clusters.append(cluster)
+        logger.info("Started cluster: %s", cluster.cluster_id)
+        yield cluster
+
 def get_launch_attempts():
     return _launch_recorder.get_list()
 
-def add_running_cluster(url, auth_token):
-    cluster = ClusterInfo(url, auth_token, external=True)
+def add_running_cluster(url, auth_token, agent_count=6):
+    cluster = ClusterInfo(url, auth_token, external=True,
+            agent_count=agent_count)
     _clusters.append(cluster)
     return cluster
 
@@ -54,10 +85,21 @@ def running_count():
 
 def get_idle_cluster():
     for cluster in _clusters:
-        if not cluster.in_use():
+        if cluster.available and not cluster.in_use():
             return cluster
     return None
 
+def get_cluster_with_capacity(agents):
+    """Best fit: of the clusters with at least this many unclaimed agents,
+    return the one with the fewest, so that bigger gaps stay available for
+    bigger frameworks.  An idle cluster always fits, however many agents are
+    asked for."""
+    candidates = [cluster for cluster in _clusters if cluster.available and
+                  (not cluster.in_use() or cluster.free_agents() >= agents)]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda cluster: cluster.free_agents())
+
 def stop_cluster(cluster):
     github_label = launch_ccm_cluster.determine_github_label()
     ccm_token = os.environ['CCM_AUTH_TOKEN']
@@ -74,24 +116,58 @@ def shutdown_clusters(shutdown_external=False):
         stop_cluster(cluster)
         _clusters.remove(cluster)
 
+def check_health(cluster, timeout_seconds=30):
+    "Returns whether the cluster's adminrouter answers with its version"
+    version_url = "%s/dcos-metadata/dcos-version.json" % cluster.url
+    # test clusters have self-signed certs
+    request = urllib.request.Request(version_url,
+            headers={'Authorization': 'token=%s' % cluster.auth_token})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout_seconds,
+                context=ssl._create_unverified_context())
+        response.read()
+        return True
+    except Exception as e:
+        logger.info("Health check of cluster %s failed: %s", cluster.cluster_id, e)
+        return False
+
+def recycle_cluster(cluster):
+    """Clean up after previous tests so that the cluster can be used by the
+    next framework: garbage collect framework sandboxes, and release any
+    reservations and volumes left behind.  Returns whether that worked."""
+    custom_env = os.environ.copy()
+    custom_env['CLUSTER_URL'] = cluster.url
+    custom_env['CLUSTER_AUTH_TOKEN'] = cluster.auth_token
+    custom_env['TEST_GITHUB_LABEL'] = 'recycle'
+    runtests_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_tests.py')
+    completed_cmd = subprocess.run([sys.executable, runtests_script, 'recycle'],
+                                   env=custom_env)
+    if completed_cmd.returncode != 0:
+        logger.info("Recycling cluster %s returned failure.", cluster.cluster_id)
+        return False
+    return True
+
 def _launch_cluster(launch_config=None):
     ccm_token = os.environ['CCM_AUTH_TOKEN']
     if not launch_config:
         launch_config = launch_ccm_cluster.StartConfig(private_agents=6)
     cluster_info = launch_ccm_cluster.start_cluster(ccm_token, launch_config)
     cluster = ClusterInfo(cluster_info["url"], cluster_info["auth_token"],
-            cluster_id=cluster_info["id"])
+            cluster_id=cluster_info["id"],
+            agent_count=launch_config.private_agents)
     return cluster
 
 
 class ClusterInfo(object):
-    def __init__(self, url, auth_token, cluster_id=None, external=False):
+    def __init__(self, url, auth_token, cluster_id=None, external=False,
+                 agent_count=6):
         self.url = url
         self.auth_token = auth_token
         self.cluster_id = cluster_id
         self.external = external # launched outside local automation
+        self.agent_count = agent_count # private agents
+        self.available = True # False while being recycled or after failing
         self._frameworks_using = set()
-        # self.node_count etc
 
     def claim(self, framework):
         self._frameworks_using.add(framework)
@@ -102,6 +178,11 @@ class ClusterInfo(object):
     def in_use(self):
         return self._frameworks_using
 
+    def free_agents(self):
+        used = sum(framework.required_agents
+                   for framework in self._frameworks_using)
+        return max(0, self.agent_count - used)
+
     def is_running(self):
         return True
 
@@ -151,6 +232,172 @@ class _LaunchRecorder(object):
 _launch_recorder = _LaunchRecorder()
 
 
+class Lease(object):
+    def __init__(self, framework, cluster, timeout_seconds):
+        self.framework = framework
+        self.cluster = cluster
+        self.start_time = time.time()
+        self.expiry = self.start_time + timeout_seconds
+
+    def expired(self, now=None):
+        return (now or time.time()) > self.expiry
+
+
+class ClusterPool(object):
+    """Hands out clusters to frameworks as leases.
+
+    Clusters are launched ahead of demand by prewarm(), in background threads,
+    so that tests can start on the first cluster to come up rather than
+    waiting on each launch in turn.  Each prewarm() launches its clusters as
+    one batch (see start_clusters).  Once all leases on a cluster are
+    released, it's recycled in the background and health checked before
+    being handed out again.  Clusters which fail recycling or health checks
+    are taken out of the pool.
+
+    on_available, if given, is called with each cluster as it becomes
+    available for leasing, from whichever thread made it so.
+    """
+
+    # A lease expires after this multiple of its framework's estimated test
+    # duration, so that a hung test doesn't hold on to its cluster forever.
+    LEASE_TIMEOUT_FACTOR = 3
+    MIN_LEASE_SECONDS = 60 * 60
+    HEALTH_CHECK_INTERVAL_SECONDS = 5 * 60
+
+    def __init__(self, size, agent_count=6, on_available=None):
+        self.size = size
+        self.agent_count = agent_count
+        self._on_available = on_available
+        self._leases = {} # framework name => Lease
+        self._busy = 0 # clusters launching or recycling
+        self._launched = 0
+        self._last_health_check = time.time()
+        self._lock = threading.Lock()
+
+    def prewarm(self, count=None):
+        """Start launching clusters in the background, up to count (default:
+        the pool size) in the pool"""
+        if count is None:
+            count = self.size
+        with self._lock:
+            to_launch = min(count, self.size) - running_count() - self._busy
+            if to_launch <= 0:
+                return
+            reporting_names = ["Cluster %s" % (self._launched + i + 1)
+                               for i in range(to_launch)]
+            self._launched += to_launch
+            self._busy += to_launch
+        threading.Thread(target=self._launch, args=(reporting_names,),
+                         name="launch-%s" % reporting_names[0],
+                         daemon=True).start()
+
+    def busy_count(self):
+        "Number of clusters which are launching or being recycled"
+        with self._lock:
+            return self._busy
+
+    def try_lease(self, framework):
+        """Returns a Lease on a cluster with room for the framework, or None
+        if there's currently no such cluster"""
+        with self._lock:
+            cluster = get_cluster_with_capacity(framework.required_agents)
+            if not cluster:
+                return None
+            cluster.claim(framework)
+            timeout = max(self.MIN_LEASE_SECONDS,
+                          framework.estimated_duration * self.LEASE_TIMEOUT_FACTOR)
+            lease = Lease(framework, cluster, timeout)
+            self._leases[framework.name] = lease
+            return lease
+
+    def release(self, framework):
+        """Give the framework's cluster back, recycling the cluster in the
+        background once nothing else is using it"""
+        with self._lock:
+            lease = self._leases.pop(framework.name)
+            cluster = lease.cluster
+            cluster.unclaim(framework)
+            if cluster.in_use() or cluster not in _clusters:
+                return
+            cluster.available = False
+            self._busy += 1
+        threading.Thread(target=self._recycle, args=(cluster,),
+                         name="recycle-%s" % cluster.cluster_id,
+                         daemon=True).start()
+
+    def expired_leases(self):
+        """Returns the leases which have run past their timeout, or whose
+        cluster has stopped responding.  Clusters are health checked at most
+        every HEALTH_CHECK_INTERVAL_SECONDS."""
+        now = time.time()
+        with self._lock:
+            leases = list(self._leases.values())
+        expired = [lease for lease in leases if lease.expired(now)]
+        if now - self._last_health_check >= self.HEALTH_CHECK_INTERVAL_SECONDS:
+            self._last_health_check = now
+            for cluster in set(lease.cluster for lease in leases):
+                if not check_health(cluster):
+                    logger.info("Cluster %s failed health check, removing from pool",
+                                cluster.cluster_id)
+                    self._remove(cluster)
+                    expired.extend(lease for lease in leases
+                                   if lease.cluster is cluster and lease not in expired)
+        return expired
+
+    def _launch(self, reporting_names):
+        launch_configs = [launch_ccm_cluster.StartConfig(private_agents=self.agent_count)
+                          for _ in reporting_names]
+        started = 0
+        try:
+            for cluster in start_clusters(launch_configs, reporting_names):
+                started += 1
+                with self._lock:
+                    self._busy -= 1
+                self._notify(cluster)
+        except Exception:
+            logger.exception("Launch of %s failed", ", ".join(reporting_names))
+        with self._lock:
+            # the rest failed
+            self._busy -= len(reporting_names) - started
+
+    def _recycle(self, cluster):
+        logger.info("Recycling cluster %s", cluster.cluster_id)
+        ok = False
+        try:
+            ok = recycle_cluster(cluster) and check_health(cluster)
+        except Exception:
+            logger.exception("Recycling cluster %s failed", cluster.cluster_id)
+        if not ok:
+            self._remove(cluster)
+        with self._lock:
+            self._busy -= 1
+            if cluster not in _clusters:
+                return # torn down meanwhile
+            if ok:
+                cluster.available = True
+        if ok:
+            logger.info("Cluster %s recycled", cluster.cluster_id)
+            self._notify(cluster)
+        else:
+            # replace it, so that the pool doesn't dwindle away
+            self.prewarm()
+
+    def _remove(self, cluster):
+        with self._lock:
+            cluster.available = False
+            if cluster in _clusters:
+                _clusters.remove(cluster)
+        if not cluster.external:
+            try:
+                stop_cluster(cluster)
+            except Exception:
+                logger.exception("Failed to stop cluster %s", cluster.cluster_id)
+
+    def _notify(self, cluster):
+        if self._on_available:
+            self._on_available(cluster)
+
+
 ## tests
 
 def _mock_launch_cluster(config=None):
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the subset of the CCM API used by launch_ccm_cluster,
+for exercising the test orchestration without launching real clusters.
+
+Clusters move through CREATING (and optionally RUNNING_NEEDS_INFO) to
+RUNNING after a configurable launch latency, or to CREATING_ERROR at a
+configurable failure rate.  Deleted clusters move through DELETING to
+DELETED.  Individual requests may also be failed with a 500 at a
+configurable rate, to exercise client retries.
+
+Point launch_ccm_cluster at it with CCM_URL, e.g.:
+
+  $ ./fake_ccm.py --port 8080 --launch-seconds 60 --failure-rate 0.1 &
+  $ CCM_URL=http://localhost:8080 CCM_AUTH_TOKEN=fake ./launch_ccm_cluster.py
+
+Launched clusters don't exist, so post-launch configuration must be
+disabled (--configure none), and CLUSTER_AUTH_TOKEN set to skip logging in.
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import random
+import re
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# From launch_ccm_cluster.CCMLauncher._CCM_STATUSES
+RUNNING = 0
+CREATING = 3
+DELETING = 4
+DELETED = 5
+CREATING_ERROR = 7
+RUNNING_NEEDS_INFO = 8
+
+_CLUSTER_PATH = re.compile(r'^/api/cluster/(\d+)/$')
+
+
+class FakeCluster(object):
+    def __init__(self, cluster_id, request, launch_seconds, fails):
+        self.cluster_id = cluster_id
+        self.request = request
+        self.created = time.time()
+        self.ready_time = self.created + launch_seconds
+        self.fails = fails
+        self.deleted = None
+
+    def status(self, delete_seconds):
+        now = time.time()
+        if self.deleted:
+            return DELETED if now >= self.deleted + delete_seconds else DELETING
+        if now < self.ready_time:
+            # CCM reports a cluster as needing info for a while before it's up
+            return CREATING if now < self.ready_time - 1 else RUNNING_NEEDS_INFO
+        return CREATING_ERROR if self.fails else RUNNING
+
+    def cluster_info(self):
+        return {'DnsAddress': 'fake-cluster-%s.localhost' % self.cluster_id,
+                'StackId': 'stack-%s' % self.cluster_id}
+
+
+class FakeCCM(object):
+    """The fake's state and behavior, independent of HTTP.  Launch latencies
+    are chosen uniformly from launch_seconds (min, max)."""
+
+    def __init__(self, launch_seconds=(0, 0), failure_rate=0.0,
+                 request_failure_rate=0.0, delete_seconds=0, seed=None):
+        self.launch_seconds = launch_seconds
+        self.failure_rate = failure_rate
+        self.request_failure_rate = request_failure_rate
+        self.delete_seconds = delete_seconds
+        self._random = random.Random(seed)
+        self._clusters = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        # counters, for checking client behavior
+        self.connection_count = 0
+        self.request_counts = {'POST': 0, 'GET': 0, 'DELETE': 0}
+
+    def create(self, request):
+        with self._lock:
+            cluster_id = self._next_id
+            self._next_id += 1
+            cluster = FakeCluster(cluster_id, request,
+                                  self._random.uniform(*self.launch_seconds),
+                                  self._random.random() < self.failure_rate)
+            self._clusters[cluster_id] = cluster
+        logger.info("Creating cluster %s (%s, ready in %.0fs)", cluster_id,
+                    "will fail" if cluster.fails else "will succeed",
+                    cluster.ready_time - cluster.created)
+        return {'id': cluster_id, 'stack_id': 'stack-%s' % cluster_id,
+                'name': request.get('name')}
+
+    def get(self, cluster_id):
+        cluster = self._clusters.get(cluster_id)
+        if not cluster:
+            return None
+        status = cluster.status(self.delete_seconds)
+        response = {'id': cluster_id, 'status': status, 'cluster_info': ''}
+        if status in (RUNNING, DELETED):
+            # a string containing json, as in the real API
+            response['cluster_info'] = json.dumps(cluster.cluster_info())
+        return response
+
+    def delete(self, cluster_id):
+        cluster = self._clusters.get(cluster_id)
+        if not cluster:
+            return False
+        if not cluster.deleted:
+            cluster.deleted = time.time()
+            logger.info("Deleting cluster %s", cluster_id)
+        return True
+
+    def fail_request(self):
+        with self._lock:
+            return self._random.random() < self.request_failure_rate
+
+    def count_request(self, method):
+        with self._lock:
+            self.request_counts[method] += 1
+
+    def count_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def live_cluster_count(self):
+        "Clusters which are running or on their way, and haven't been deleted"
+        return len([cluster_id for cluster_id in list(self._clusters)
+                    if self.get(cluster_id)['status'] in (RUNNING, CREATING, RUNNING_NEEDS_INFO)])
+
+    def stats(self):
+        statuses = {}
+        for cluster_id in list(self._clusters):
+            status = self.get(cluster_id)['status']
+            statuses[status] = statuses.get(status, 0) + 1
+        return {'connections': self.connection_count,
+                'requests': dict(self.request_counts),
+                'clusters': len(self._clusters),
+                'statuses': statuses}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, like the real CCM
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.ccm.count_connection()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _check_request(self, method):
+        ccm = self.server.ccm
+        ccm.count_request(method)
+        if not self.headers.get('Authorization', '').startswith('Token '):
+            self._send_json(401, {'detail': 'Authentication credentials were not provided.'})
+            return False
+        if ccm.fail_request():
+            self._send_json(500, {'detail': 'Injected failure'})
+            return False
+        return True
+
+    def do_POST(self):
+        body = self._read_body()
+        if not self._check_request('POST'):
+            return
+        if self.path != '/api/cluster/':
+            self._send_json(404, {'detail': 'Not found.'})
+            return
+        self._send_json(201, self.server.ccm.create(json.loads(body.decode('utf-8'))))
+
+    def do_GET(self):
+        if not self._check_request('GET'):
+            return
+        match = _CLUSTER_PATH.match(self.path)
+        status = match and self.server.ccm.get(int(match.group(1)))
+        if not status:
+            self._send_json(404, {'detail': 'Not found.'})
+            return
+        self._send_json(200, status)
+
+    def do_DELETE(self):
+        if not self._check_request('DELETE'):
+            return
+        match = _CLUSTER_PATH.match(self.path)
+        if not match or not self.server.ccm.delete(int(match.group(1))):
+            self._send_json(404, {'detail': 'Not found.'})
+            return
+        self._send_json(200, {})
+
+
+class FakeCCMServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, ccm, port=0, host='127.0.0.1'):
+        super().__init__((host, port), _Handler)
+        self.ccm = ccm
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        "Serve in a background thread"
+        thread = threading.Thread(target=self.serve_forever, name='fake-ccm', daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake CCM API for testing")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--launch-seconds", type=float, nargs='+', default=[60],
+            help="Launch latency, or min and max latency, in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+            help="Fraction of launches which end in CREATING_ERROR")
+    parser.add_argument("--request-failure-rate", type=float, default=0.0,
+            help="Fraction of requests which get a 500 response")
+    parser.add_argument("--delete-seconds", type=float, default=5)
+    args = parser.parse_args()
+    launch_seconds = (args.launch_seconds[0], args.launch_seconds[-1])
+    ccm = FakeCCM(launch_seconds, args.failure_rate, args.request_failure_rate,
+                  args.delete_seconds)
+    server = FakeCCMServer(ccm, args.port)
+    logger.info("Serving fake CCM at %s", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Final stats: %s", ccm.stats())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Stands in for run_tests.py when benchmarking test.py's scheduling (see
+bench_scheduler.py): accepts the same arguments, prints some output, and
+exits after a while, without touching any cluster.
+
+How long each framework's tests take and whether they fail comes from the
+json file named by FAKE_TEST_PLAN:
+
+  {"<framework>": {"seconds": <float>, "fail": <bool>}, ...}
+
+The framework is identified by TEST_GITHUB_LABEL, as set by test.py.
+"""
+
+import json
+import os
+import sys
+import time
+
+# print a line at most this often, as long as the tests run
+OUTPUT_INTERVAL_SECONDS = 1
+
+
+def main(argv):
+    framework = os.environ.get('TEST_GITHUB_LABEL', 'unknown')
+    with open(os.environ['FAKE_TEST_PLAN']) as plan_file:
+        plan = json.load(plan_file).get(framework, {})
+    seconds = plan.get('seconds', 0)
+    print('Fake {} tests against {} for {:.1f}s: {}'.format(
+        framework, os.environ.get('CLUSTER_URL'), seconds, ' '.join(argv[1:])))
+    sys.stdout.flush()
+
+    stop_time = time.time() + seconds
+    while time.time() < stop_time:
+        time.sleep(min(OUTPUT_INTERVAL_SECONDS, max(0, stop_time - time.time())))
+        print('{:.1f}s left'.format(max(0, stop_time - time.time())))
+        sys.stdout.flush()
+
+    if plan.get('fail'):
+        print('Fake {} tests FAILED'.format(framework))
+        return 1
+    print('Fake {} tests passed'.format(framework))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
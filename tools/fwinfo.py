@@ -21,6 +21,22 @@ logger = logging.getLogger(__name__)
 # holds info objects -- TODO: need ordering
 _framework_infos = []
 
+# Rough scheduling hints for the multi-cluster test scheduler: how many of a
+# (6 private agent) test cluster's agents a framework's tests occupy, and how
+# long its test run typically takes.  Light frameworks are packed together
+# onto shared clusters; anything at or above the cluster size gets a cluster
+# to itself.
+_TEST_REQUIREMENTS = {
+    # name: (agents, estimated minutes)
+    'template': (2, 20),
+    'helloworld': (4, 60),
+    'kafka': (6, 90),
+    'cassandra': (6, 90),
+    'elastic': (6, 120),
+    'hdfs': (6, 180),
+}
+_DEFAULT_TEST_REQUIREMENTS = (6, 90)
+
 _repo_root=None
 def init_repo_root(repo_root):
     global _repo_root
@@ -94,6 +110,54 @@ def autodiscover_frameworks(repo_root=None, dcos_version=None):
 def shuffle_order():
     random.shuffle(_framework_infos)
 
+def apply_duration_history(durations):
+    """Replace the built-in duration estimates with measured ones, given
+    {framework name: seconds} (see testhistory.framework_durations)."""
+    for framework in get_frameworks():
+        if framework.name in durations:
+            framework.estimated_duration = durations[framework.name]
+
+def order_by_duration():
+    """Longest-processing-time-first: starting the longest tests first keeps
+    one long test from being left to run alone at the end."""
+    _framework_infos.sort(key=lambda framework: framework.estimated_duration,
+                          reverse=True)
+
+def predict_run_time(cluster_count, cluster_agents=6):
+    """Estimate the wall-clock seconds to run all frameworks, in their current
+    order, across cluster_count clusters, by replaying the test.py scheduler
+    against the frameworks' estimated durations: whenever a test finishes,
+    every pending framework which fits on a cluster is started, in order.
+
+    Raises ValueError if there are no clusters, or if any framework needs
+    more agents than a cluster has, since it could never be started."""
+    if cluster_count < 1:
+        raise ValueError("Need at least one cluster to predict a run time, got %s" % cluster_count)
+    too_big = ["%s (%d agents)" % (framework.name, framework.required_agents)
+               for framework in get_frameworks()
+               if framework.required_agents > cluster_agents]
+    if too_big:
+        raise ValueError("Frameworks need more than the %d agents of a cluster: %s" %
+                         (cluster_agents, ", ".join(too_big)))
+    pending = list(get_frameworks())
+    # per cluster: list of (end time, agents) for its running frameworks
+    clusters = [[] for _ in range(cluster_count)]
+    now = 0
+    while pending:
+        for framework in list(pending):
+            for running in sorted(clusters, key=lambda r: -sum(a for _, a in r)):
+                free = cluster_agents - sum(agents for _, agents in running)
+                if free >= framework.required_agents:
+                    running.append((now + framework.estimated_duration,
+                                    framework.required_agents))
+                    pending.remove(framework)
+                    break
+        # advance to the next completion
+        now = min(end for running in clusters for end, _ in running)
+        for running in clusters:
+            running[:] = [(end, agents) for end, agents in running if end > now]
+    return max([now] + [end for running in clusters for end, _ in running])
+
 def running_frameworks():
     return [framework for framework in get_frameworks() if framework.running]
 
@@ -115,6 +179,9 @@ class FrameworkTestInfo(object):
         # TODO figure out what this trailing slash is for and eliminate
         self.testdir = os.path.join(self.dir, 'tests') + "/"
         self.actions = collections.OrderedDict() # succeeded and failed steps land here
+        agents, minutes = _TEST_REQUIREMENTS.get(self.name, _DEFAULT_TEST_REQUIREMENTS)
+        self.required_agents = agents
+        self.estimated_duration = minutes * 60 # seconds
         self._determine_minimum_dcos_version()
 
     def __repr__(self):
@@ -202,6 +269,34 @@ if __name__ == "__main__":
             add_framework('template')
             self.assertRaises(Exception, add_framework, 'template')
 
+        def test_order_by_duration(self):
+            add_framework('template', repo_root=abs_repo_root)
+            add_framework('hdfs', repo_root=abs_repo_root)
+            add_framework('helloworld', repo_root=abs_repo_root)
+            apply_duration_history({'template': 300, 'helloworld': 3000})
+            order_by_duration()
+            self.assertEqual(get_framework_names(), ['hdfs', 'helloworld', 'template'])
+
+        def test_predict_run_time(self):
+            add_framework('template', repo_root=abs_repo_root)
+            add_framework('hdfs', repo_root=abs_repo_root)
+            add_framework('helloworld', repo_root=abs_repo_root)
+            apply_duration_history({'template': 100, 'hdfs': 1000, 'helloworld': 200})
+            # everything back to back on one cluster, except that template
+            # and helloworld fit alongside each other:
+            self.assertEqual(predict_run_time(1), 1200)
+            # hdfs alone on one cluster, the light frameworks on the other:
+            self.assertEqual(predict_run_time(2), 1000)
+
+        def test_predict_run_time_invalid(self):
+            add_framework('template', repo_root=abs_repo_root)
+            add_framework('hdfs', repo_root=abs_repo_root)
+            self.assertRaises(ValueError, predict_run_time, 0)
+            # hdfs needs 6 agents, so could never be started:
+            self.assertRaises(ValueError, predict_run_time, 2, cluster_agents=4)
+            # hdfs takes a whole cluster, so template has to wait for it:
+            self.assertEqual(predict_run_time(1), (180 + 20) * 60)
+
         def test_running_frameworks(self):
             init_repo_root(abs_repo_root)
             autodiscover_frameworks()
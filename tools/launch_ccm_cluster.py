@@ -15,6 +15,7 @@
 # Configuration: Mostly through env vars. See README.md.
 
 import argparse
+import concurrent.futures
 import http.client
 import json
 import logging
@@ -24,7 +25,9 @@ import random
 import socket
 import string
 import sys
+import threading
 import time
+import urllib.parse
 
 import configure_test_cluster
 import dcos_login
@@ -37,6 +40,18 @@ logging.basicConfig(level=logging.INFO, format="%(message)s")
 class ClusterActionException(Exception):
     pass
 
+
+class _Response(object):
+    "An HTTP response whose body has already been read, so that its connection can be reused"
+
+    def __init__(self, status, body):
+        self.status = status
+        self._body = body
+
+    def read(self):
+        return self._body
+
+
 class CCMLauncher(object):
 
     # NOTE: this will need to be updated once 'stable' is no longer 1.7
@@ -57,16 +72,30 @@ class CCMLauncher(object):
 
     _CCM_HOST = 'ccm.mesosphere.com'
     _CCM_PATH = '/api/cluster/'
+    # requests which may safely be resent if it's unknown whether CCM received them:
+    _IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
 
 
     DEFAULT_TIMEOUT_MINS = 45
     DEFAULT_ATTEMPTS = 2
 
+    _MAX_POLL_INTERVAL_S = 32
+
 
     def __init__(self, ccm_token, github_label):
         self._http_headers = {'Authorization': 'Token ' + ccm_token}
         self._dry_run = os.environ.get('DRY_RUN', '')
         self._github_updater = github_update.GithubStatusUpdater('cluster:{}'.format(github_label))
+        # CCM_URL may point at another CCM API, e.g. tools/fake_ccm.py
+        ccm_url = urllib.parse.urlparse(os.environ.get('CCM_URL', 'https://' + self._CCM_HOST))
+        self._ccm_host = ccm_url.netloc
+        if ccm_url.scheme == 'http':
+            self._connection_class = http.client.HTTPConnection
+        else:
+            self._connection_class = http.client.HTTPSConnection
+        # one keep-alive connection to CCM, shared by all requests from this launcher
+        self._conn = None
+        self._conn_lock = threading.Lock()
 
 
     def _rand_str(self, size):
@@ -103,38 +132,96 @@ class CCMLauncher(object):
             log_error=True,
             debug=False):
         if self._dry_run:
-            logger.info('[DRY RUN] {} https://{}{}'.format(request_method, self._CCM_HOST, request_path))
+            logger.info('[DRY RUN] {} {}{}'.format(request_method, self._ccm_host, request_path))
             if request_json_payload:
                 logger.info('[DRY RUN] Payload: {}'.format(pprint.pformat(request_json_payload)))
             return None
-        conn = http.client.HTTPSConnection(self._CCM_HOST)
-        if debug:
-            conn.set_debuglevel(999)
-
         request_headers = self._http_headers.copy()
         if request_json_payload:
             request_body = json.dumps(request_json_payload).encode('utf-8')
             request_headers['Content-Type'] = 'application/json'
         else:
             request_body = None
-        conn.request(
-            request_method,
-            request_path,
-            body = request_body,
-            headers = request_headers)
-        response = conn.getresponse()
+        with self._conn_lock:
+            response, response_body = self._send(
+                request_method, request_path, request_body, request_headers, debug)
         if log_error and (response.status < 200 or response.status >= 300):
             logger.error('Got {} response to HTTP request:'.format(response.status))
-            logger.error('Request: {} https://{}{}'.format(request_method, self._CCM_HOST, request_path))
+            logger.error('Request: {} {}{}'.format(request_method, self._ccm_host, request_path))
             logger.error('Response:')
             logger.error('  - Status: {} {}'.format(response.status, str(response.msg).strip()))
             logger.error('  - Headers: {}'.format(pprint.pformat(response.getheaders())))
-            logger.error('  - Body: {}'.format(pprint.pformat(response.read())))
+            logger.error('  - Body: {}'.format(pprint.pformat(response_body)))
             return None
         elif debug:
             logger.debug('{}: {}'.format(response.status, str(response.msg).strip()))
             logger.debug(pprint.pformat(response.getheaders()))
-        return response
+        return _Response(response.status, response_body)
+
+
+    def _send(self, request_method, request_path, request_body, request_headers, debug):
+        # A kept-alive connection may have been closed by CCM since it was last used, in which
+        # case the request is retried once on a fresh connection. A failure after the request was
+        # written may instead mean that CCM handled it but the response was lost, so non-idempotent
+        # requests (e.g. the POST which creates a cluster) are only retried if writing them failed.
+        reused = self._conn is not None
+        if not reused:
+            self._conn = self._connection_class(self._ccm_host)
+        if debug:
+            self._conn.set_debuglevel(999)
+        sent = False
+        try:
+            self._conn.request(
+                request_method,
+                request_path,
+                body = request_body,
+                headers = request_headers)
+            sent = True
+            response = self._conn.getresponse()
+            # the body must be consumed before the connection can be reused
+            return response, response.read()
+        except (http.client.HTTPException, socket.error):
+            self._conn.close()
+            self._conn = None
+            if not reused or (sent and request_method not in self._IDEMPOTENT_METHODS):
+                raise
+            logger.info('Connection to {} was closed, reconnecting'.format(self._ccm_host))
+            return self._send(request_method, request_path, request_body, request_headers, debug)
+
+
+    def _get_status(self, cluster_id):
+        "Returns the cluster's status json, or None if it couldn't be retrieved"
+        response = self._query_http('GET', self._CCM_PATH + str(cluster_id) + '/')
+        if not response:
+            return None
+        return json.loads(response.read().decode('utf-8'))
+
+
+    def _check_status(self, cluster_id, status_json, pending_state_codes, complete_state_code):
+        """Returns (done, cluster_info, status_label).  cluster_info is only set once the cluster
+        has reached the complete state; done without cluster_info means the operation failed."""
+        status_code = status_json.get('status', -1)
+        status_label = self._CCM_STATUSES.get(status_code, 'unknown:{}'.format(status_code))
+        if status_code == complete_state_code:
+            # additional check: does the cluster have a non-empty 'cluster_info'?
+            cluster_info_str = status_json.get('cluster_info', '')
+            if cluster_info_str:
+                # cluster_info in the CCM API is a string containing a dict...:
+                logger.info('Cluster {} has entered state {}, returning cluster_info.'.format(
+                    cluster_id, status_label))
+                try:
+                    return True, json.loads(cluster_info_str), status_label
+                except:
+                    logger.error('Failed to parse cluster_info string as JSON. Operation failed?: "{}"'.format(cluster_info_str))
+                    return True, None, status_label
+            else:
+                logger.error('Cluster {} has entered state {}, but lacks cluster_info...'.format(
+                    cluster_id, status_label))
+        elif status_code not in pending_state_codes:
+            logger.error('Cluster {} has entered state {}. Giving up.'.format(
+                cluster_id, status_label))
+            return True, None, status_label
+        return False, None, status_label
 
 
     def wait_for_status(self, cluster_id, pending_status_labels, complete_status_label, timeout_minutes):
@@ -150,33 +237,15 @@ class CCMLauncher(object):
         now = start_time
 
         while now < stop_time:
-            if sleep_duration_s < 32:
+            if sleep_duration_s < self._MAX_POLL_INTERVAL_S:
                 sleep_duration_s *= 2
 
-            response = self._query_http('GET', self._CCM_PATH + str(cluster_id) + '/')
-            if response:
-                status_json = json.loads(response.read().decode('utf-8'))
-                status_code = status_json.get('status', -1)
-                status_label = self._CCM_STATUSES.get(status_code, 'unknown:{}'.format(status_code))
-                if status_code == complete_state_code:
-                    # additional check: does the cluster have a non-empty 'cluster_info'?
-                    cluster_info_str = status_json.get('cluster_info', '')
-                    if cluster_info_str:
-                        # cluster_info in the CCM API is a string containing a dict...:
-                        logger.info('Cluster {} has entered state {}, returning cluster_info.'.format(
-                            cluster_id, status_label))
-                        try:
-                            return json.loads(cluster_info_str)
-                        except:
-                            logger.error('Failed to parse cluster_info string as JSON. Operation failed?: "{}"'.format(cluster_info_str))
-                            return None
-                    else:
-                        logger.error('Cluster {} has entered state {}, but lacks cluster_info...'.format(
-                            cluster_id, status_label))
-                elif status_code not in pending_state_codes:
-                    logger.error('Cluster {} has entered state {}. Giving up.'.format(
-                        cluster_id, status_label))
-                    return None
+            status_json = self._get_status(cluster_id)
+            if status_json:
+                done, cluster_info, status_label = self._check_status(
+                    cluster_id, status_json, pending_state_codes, complete_state_code)
+                if done:
+                    return cluster_info
 
                 logger.info('Cluster {} has state {} after {}, refreshing in {}. ({} left)'.format(
                     cluster_id,
@@ -203,6 +272,21 @@ class CCMLauncher(object):
 
 
     def _start(self, config):
+        cluster_id, stack_id = self._submit(config)
+        cluster_info = self.wait_for_status(
+            cluster_id,
+            self._START_PENDING_LABELS,
+            'RUNNING', # desired state
+            config.start_timeout_mins)
+        return self._finish_start(config, cluster_id, stack_id, cluster_info)
+
+
+    # states to consider valid while waiting for a cluster to start
+    _START_PENDING_LABELS = ['CREATING', 'RUNNING_NEEDS_INFO']
+
+
+    def _submit(self, config):
+        "Requests a new cluster, returning its (cluster_id, stack_id) without waiting for it"
         is_17_cluster = config.ccm_channel in self._DCOS_17_CHANNELS
         template_url = None
         if is_17_cluster:
@@ -270,12 +354,11 @@ class CCMLauncher(object):
         stack_id = response_json.get('stack_id', '')
         if not stack_id:
             raise ClusterActionException('No Stack ID returned in cluster creation response: {}'.format(response_content))
+        return cluster_id, stack_id
 
-        cluster_info = self.wait_for_status(
-            cluster_id,
-            ['CREATING', 'RUNNING_NEEDS_INFO'], # pending states
-            'RUNNING', # desired state
-            config.start_timeout_mins)
+
+    def _finish_start(self, config, cluster_id, stack_id, cluster_info):
+        "Logs in to and configures a cluster which CCM reports as RUNNING"
         if not cluster_info:
             raise ClusterActionException('CCM cluster creation failed or timed out')
         dns_address = cluster_info.get('DnsAddress', '')
@@ -309,6 +392,128 @@ class CCMLauncher(object):
             'auth_token': auth_token
         }
 
+    def start_batch(self, configs, attempts = DEFAULT_ATTEMPTS):
+        """Launches a cluster for each of the configs at once.
+
+        All of the creation requests are submitted up front, then the clusters are tracked by a
+        single polling loop.  Clusters are logged in to and configured in the background as they
+        come up, so that a slow one doesn't hold up the others.
+
+        Yields (index into configs, cluster info) as each cluster becomes ready, so that callers
+        can start using the first cluster while the rest are still launching.  Clusters which
+        fail are relaunched, up to attempts launches each; if they fail on every attempt the
+        cluster info is None.
+        """
+        self._github_updater.update('pending', 'Launching {} clusters'.format(len(configs)))
+        pending_state_codes = [self._CCM_STATUS_LABELS[label] for label in self._START_PENDING_LABELS]
+        running_state_code = self._CCM_STATUS_LABELS['RUNNING']
+
+        # index => [attempts so far, cluster_id, stack_id, stop_time]
+        launching = {}
+        failed_count = 0
+
+        def submit(index):
+            entry = launching.setdefault(index, [0, None, None, None])
+            while entry[0] < attempts:
+                entry[0] += 1
+                try:
+                    entry[1], entry[2] = self._submit(configs[index])
+                    entry[3] = time.time() + 60 * configs[index].start_timeout_mins
+                    return True
+                except (ClusterActionException, socket.error) as e:
+                    logger.error('[{}/{}] Launch request for cluster {} failed: {}'.format(
+                        entry[0], attempts, index, e))
+            del launching[index]
+            return False
+
+        def relaunch_or_fail(index):
+            if launching[index][0] < attempts:
+                logger.error('Relaunching cluster {} (was {})'.format(index, launching[index][1]))
+                return submit(index)
+            del launching[index]
+            return False
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(configs)))
+        configuring = {} # future => index
+        try:
+            for index in range(len(configs)):
+                if not submit(index):
+                    failed_count += 1
+                    yield index, None
+
+            sleep_duration_s = 1
+            while launching or configuring:
+                for index, (_, cluster_id, stack_id, stop_time) in list(launching.items()):
+                    try:
+                        status_json = self._get_status(cluster_id)
+                    except Exception as e:
+                        # one cluster's bad response mustn't abandon the rest: retry on the next poll
+                        logger.error('Failed to get status of cluster {}: {}'.format(cluster_id, e))
+                        status_json = None
+                    if status_json:
+                        done, cluster_info, status_label = self._check_status(
+                            cluster_id, status_json, pending_state_codes, running_state_code)
+                        if done and cluster_info:
+                            del launching[index]
+                            future = executor.submit(self._finish_start, configs[index],
+                                                     cluster_id, stack_id, cluster_info)
+                            configuring[future] = (index, cluster_id)
+                            continue
+                    else:
+                        done, status_label = False, 'unknown'
+                    if not done and time.time() > stop_time:
+                        logger.error('Cluster {} still {} at timeout'.format(cluster_id, status_label))
+                        done = True
+                    if done and not relaunch_or_fail(index):
+                        failed_count += 1
+                        yield index, None
+
+                if launching:
+                    logger.info('Waiting on {} clusters: {}; configuring {}'.format(
+                        len(launching),
+                        ', '.join(str(entry[1]) for entry in launching.values()),
+                        len(configuring)))
+                    if sleep_duration_s < self._MAX_POLL_INTERVAL_S:
+                        sleep_duration_s *= 2
+                # sleep until the next poll, or until a cluster is configured
+                if configuring:
+                    finished, _ = concurrent.futures.wait(
+                        list(configuring), timeout=sleep_duration_s if launching else None,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    finished = []
+                    if launching:
+                        time.sleep(sleep_duration_s)
+                for future in finished:
+                    index, cluster_id = configuring.pop(future)
+                    try:
+                        cluster_info = future.result()
+                    except Exception as e:
+                        # not relaunched: configuration failures tend to be repeatable
+                        logger.error('Configuring cluster {} failed: {}'.format(cluster_id, e))
+                        failed_count += 1
+                        cluster_info = None
+                    yield index, cluster_info
+        finally:
+            executor.shutdown(wait=False)
+            # if we're leaving early (an error, or the caller stopped iterating), don't leak the
+            # clusters which nobody has been handed yet
+            unfinished_ids = [entry[1] for entry in launching.values() if entry[1] is not None]
+            for future, (_, cluster_id) in configuring.items():
+                future.cancel()
+                unfinished_ids.append(cluster_id)
+            for cluster_id in unfinished_ids:
+                try:
+                    self.trigger_stop(StopConfig(str(cluster_id)))
+                except Exception as e:
+                    logger.error('Failed to stop unfinished cluster {}: {}'.format(cluster_id, e))
+            if failed_count:
+                self._github_updater.update('error', '{}/{} cluster launches failed'.format(
+                    failed_count, len(configs)))
+            else:
+                self._github_updater.update('success', 'Launched {} clusters'.format(len(configs)))
+
+
     def stop(self, config, attempts = DEFAULT_ATTEMPTS):
         return self._retry(attempts, self._stop, config, 'shutdown')
 
@@ -423,6 +628,14 @@ def start_cluster(ccm_token, launch_config=None):
         launch_config = StartConfig()
     return _start_cluster(launcher, github_label, attempts, launch_config)
 
+def start_clusters(ccm_token, launch_configs):
+    """Launch several clusters at once for external users.  Yields (index
+    into launch_configs, cluster info or None on failure) as each finishes."""
+    github_label = determine_github_label()
+    launcher = CCMLauncher(ccm_token, github_label)
+    attempts = _determine_attempts()
+    return launcher.start_batch(launch_configs, attempts)
+
 def _start_cluster(launcher, github_label, start_stop_attempts, config):
     try:
         cluster_info = launcher.start(config, start_stop_attempts)
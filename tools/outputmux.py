@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Module to stream the output of several background processes at once.
+
+Each process writes to a pipe which is registered here.  A single thread
+selects over all the pipes, appends whatever arrives to that process's
+output file, and echoes it to stdout with each line prefixed by the
+process's name.  Reads and writes are in bounded chunks, so a chatty
+process never has its whole output held in memory.
+
+Only complete lines are echoed, so that one process's output never lands
+in the middle of another's line (e.g. pytest -vv prints a test's name, then
+its result once it finishes).  A process's incomplete last line is held
+back until it's complete, up to MAX_PARTIAL_LINE bytes.
+
+Per-stream byte counts and the time of the last complete line are kept, so
+that callers can spot processes which have gone quiet.
+"""
+
+import io
+import logging
+import os
+import selectors
+import sys
+import threading
+import time
+import unittest
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# an incomplete line longer than this is echoed as if it were complete
+MAX_PARTIAL_LINE = 64 * 1024
+
+
+class Stream(object):
+    def __init__(self, name, pipe, output_file):
+        self.name = name
+        self.pipe = pipe
+        self.output_file = output_file
+        self.prefix = ("[%s] " % name).encode('utf-8')
+        self.bytes_written = 0
+        self.started = time.time()
+        self.last_line_time = None
+        self.partial = b''  # incomplete last line, not yet echoed
+        self.closed = threading.Event()
+
+    def seconds_since_output(self):
+        return time.time() - (self.last_line_time or self.started)
+
+
+class OutputMux(object):
+    def __init__(self, out=None):
+        self._out = out or sys.stdout.buffer
+        self._selector = selectors.DefaultSelector()
+        self._streams = {}
+        self._pending = [] # added streams not yet registered with the selector
+        self._lock = threading.Lock()
+        self._thread = None
+        # The selector is only touched by the mux thread: add() queues the
+        # stream and writes to this pipe to wake the thread up to register it.
+        self._wake_r, self._wake_w = os.pipe()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+    def add(self, name, pipe, output_file):
+        """Start streaming from pipe, a readable file object.  Returns the
+        Stream, whose closed event is set once the pipe hits EOF and all of
+        its output has been written."""
+        stream = Stream(name, pipe, output_file)
+        with self._lock:
+            self._streams[name] = stream
+            self._pending.append(stream)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name="outputmux", daemon=True)
+                self._thread.start()
+        os.write(self._wake_w, b'x')
+        return stream
+
+    def status(self):
+        """Returns [(name, bytes written, seconds since last output line)]
+        for streams which are still open."""
+        with self._lock:
+            streams = [s for s in self._streams.values() if not s.closed.is_set()]
+        return [(s.name, s.bytes_written, s.seconds_since_output())
+                for s in streams]
+
+    def _run(self):
+        try:
+            while True:
+                for key, _ in self._selector.select():
+                    if key.fileobj == self._wake_r:
+                        os.read(self._wake_r, CHUNK_SIZE)
+                        with self._lock:
+                            pending, self._pending = self._pending, []
+                        for stream in pending:
+                            self._selector.register(stream.pipe, selectors.EVENT_READ, stream)
+                        continue
+                    try:
+                        self._read(key.data)
+                    except Exception:
+                        # e.g. its output file was closed while it was still
+                        # writing; stop streaming it, but carry on with the rest
+                        logger.exception("Output streaming failed for %s", key.data.name)
+                        self._selector.unregister(key.data.pipe)
+                        key.data.pipe.close()
+                        key.data.closed.set()
+        except Exception:
+            logger.exception("Output streaming failed")
+        finally:
+            # don't leave anyone waiting on output which will never arrive;
+            # a later add() starts a new thread
+            with self._lock:
+                self._thread = None
+                streams = list(self._streams.values())
+            for stream in streams:
+                stream.closed.set()
+
+    def _read(self, stream):
+        chunk = os.read(stream.pipe.fileno(), CHUNK_SIZE)
+        if not chunk:
+            self._selector.unregister(stream.pipe)
+            if stream.partial:
+                self._out.write(_prefix_lines(stream, b'\n'))
+                self._out.flush()
+            stream.pipe.close()
+            stream.output_file.flush()
+            stream.closed.set()
+            return
+        stream.output_file.write(chunk)
+        stream.bytes_written += len(chunk)
+        lines = _prefix_lines(stream, chunk)
+        if lines:
+            self._out.write(lines)
+            self._out.flush()
+
+
+def _prefix_lines(stream, chunk):
+    """Returns the complete lines of stream.partial + chunk, each prefixed
+    with the stream's name, and keeps the rest in stream.partial."""
+    lines = (stream.partial + chunk).split(b'\n')
+    # the last piece is an incomplete line, empty if the chunk ended with a newline
+    stream.partial = lines.pop()
+    if len(stream.partial) > MAX_PARTIAL_LINE:
+        lines.append(stream.partial)
+        stream.partial = b''
+    if not lines:
+        return b''
+    stream.last_line_time = time.time()
+    return b''.join(stream.prefix + line + b'\n' for line in lines)
+
+
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest outputmux
+
+    def _stream(self, name='a'):
+        return Stream(name, None, None)
+
+    def test_prefix_complete_lines(self):
+        stream = self._stream()
+        self.assertEqual(_prefix_lines(stream, b'one\ntwo\n'), b'[a] one\n[a] two\n')
+        self.assertEqual(stream.partial, b'')
+        self.assertEqual(_prefix_lines(stream, b'\n'), b'[a] \n')
+
+    def test_partial_line_held_back(self):
+        stream = self._stream()
+        self.assertEqual(_prefix_lines(stream, b'test_foo.py::test_x '), b'')
+        self.assertIsNone(stream.last_line_time)
+        self.assertEqual(_prefix_lines(stream, b'PASS'), b'')
+        self.assertEqual(_prefix_lines(stream, b'ED\nnext'), b'[a] test_foo.py::test_x PASSED\n')
+        self.assertEqual(stream.partial, b'next')
+        self.assertIsNotNone(stream.last_line_time)
+
+    def test_long_partial_line_flushed(self):
+        stream = self._stream()
+        self.assertEqual(_prefix_lines(stream, b'x' * MAX_PARTIAL_LINE), b'')
+        self.assertEqual(_prefix_lines(stream, b'xy'), b'[a] ' + b'x' * (MAX_PARTIAL_LINE + 1) + b'y\n')
+        self.assertEqual(stream.partial, b'')
+
+    def test_streams_dont_share_lines(self):
+        out = io.BytesIO()
+        mux = OutputMux(out)
+        pipes = {}
+        for name in ('a', 'b'):
+            read_fd, write_fd = os.pipe()
+            pipes[name] = (mux.add(name, os.fdopen(read_fd, 'rb'), io.BytesIO()), write_fd)
+        os.write(pipes['a'][1], b'test_foo.py::test_x ')
+        time.sleep(0.1)
+        os.write(pipes['b'][1], b'hello\n')
+        time.sleep(0.1)
+        os.write(pipes['a'][1], b'PASSED\nno newline')
+        for stream, write_fd in pipes.values():
+            os.close(write_fd)
+            self.assertTrue(stream.closed.wait(10))
+        self.assertEqual(sorted(out.getvalue().splitlines()),
+                         [b'[a] no newline', b'[a] test_foo.py::test_x PASSED', b'[b] hello'])
+        self.assertEqual(pipes['a'][0].output_file.getvalue(), b'test_foo.py::test_x PASSED\nno newline')
+
+    def test_closed_after_failure(self):
+        class BrokenOut(object):
+            def write(self, data):
+                raise IOError('broken')
+        mux = OutputMux(BrokenOut())
+        read_fd, write_fd = os.pipe()
+        with self.assertLogs(logger, 'ERROR'):
+            stream = mux.add('a', os.fdopen(read_fd, 'rb'), io.BytesIO())
+            os.write(write_fd, b'line\n')
+            self.assertTrue(stream.closed.wait(10))
+        os.close(write_fd)
@@ -10,15 +10,27 @@
 #   S3_URL (default: s3://${S3_BUCKET}/${S3_DIR_PATH}/<pkg_name>/<random>
 #   ARTIFACT_DIR (default: ...s3.amazonaws.com...)
 #     Base HTTP dir to use when rendering links
+#   S3_ENDPOINT_URL (default: AWS)
+#     Alternate S3-compatible service to upload to
+#   UPLOAD_CONCURRENCY (default: 4)
+#     Number of artifacts to upload at once
 
+import concurrent.futures
+import json
 import logging
 import os
 import os.path
 import random
+import shutil
 import string
+import subprocess
 import sys
+import tempfile
 import time
+import unittest
+import urllib.parse
 
+import artifact_store
 import github_update
 import universe_builder
 
@@ -26,6 +38,161 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
 
+class AWSCLIBackend(object):
+    '''Uploads files to an S3 directory using the aws CLI. Each file's sha256 is stored in its
+    object metadata, so that unchanged files don't need to be uploaded again.'''
+
+    def __init__(self, s3_directory, region='', endpoint_url='', dry_run=False):
+        self._s3_directory = s3_directory
+        self._region = region
+        self._endpoint_url = endpoint_url
+        self._dry_run = dry_run
+
+        # check if aws cli tools are installed
+        try:
+            installed = subprocess.run(['aws', '--version'], stdout=sys.stderr).returncode == 0
+        except FileNotFoundError:
+            installed = False
+        if not installed:
+            raise Exception('Required AWS cli tools not installed.')
+
+
+    def _aws_cmd(self, *args):
+        cmd = ['aws']
+        if self._region:
+            cmd.append('--region={}'.format(self._region))
+        if self._endpoint_url:
+            cmd.append('--endpoint-url={}'.format(self._endpoint_url))
+        return cmd + list(args)
+
+
+    def upload(self, filepath, content_type=None, sha256=None):
+        filename = os.path.basename(filepath)
+        cmd = self._aws_cmd('s3', 'cp', '--acl', 'public-read')
+        if content_type:
+            cmd.extend(['--content-type', content_type])
+        if sha256:
+            cmd.extend(['--metadata', 'sha256={}'.format(sha256)])
+        cmd.extend([filepath, '{}/{}'.format(self._s3_directory, filename)])
+        if self._dry_run:
+            logger.info('[DRY RUN] {}'.format(' '.join(cmd)))
+            return
+        logger.info(' '.join(cmd))
+        if subprocess.run(cmd, stdout=sys.stderr).returncode != 0:
+            raise Exception('Failed to upload {} to S3'.format(filename))
+
+
+    def get_sha256(self, filename):
+        '''Returns the sha256 stored with an already uploaded file, or None'''
+        if self._dry_run:
+            return None
+        parsed = urllib.parse.urlparse('{}/{}'.format(self._s3_directory, filename))
+        cmd = self._aws_cmd('s3api', 'head-object', '--bucket', parsed.netloc, '--key', parsed.path.lstrip('/'))
+        completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if completed.returncode != 0:
+            return None # most likely not there
+        return json.loads(completed.stdout.decode('utf-8')).get('Metadata', {}).get('sha256')
+
+
+class LocalDirectoryBackend(object):
+    '''"Uploads" files to a local directory, for testing. Each file's sha256 is stored alongside it.'''
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+
+    def _sha256_path(self, filename):
+        return os.path.join(self._directory, '.{}.sha256'.format(filename))
+
+
+    def upload(self, filepath, content_type=None, sha256=None):
+        filename = os.path.basename(filepath)
+        shutil.copyfile(filepath, os.path.join(self._directory, filename))
+        if sha256:
+            with open(self._sha256_path(filename), 'w') as sha256_file:
+                sha256_file.write(sha256)
+
+
+    def get_sha256(self, filename):
+        try:
+            with open(self._sha256_path(filename)) as sha256_file:
+                return sha256_file.read().strip()
+        except IOError:
+            return None
+
+
+class ConcurrentUploader(object):
+    '''Uploads files through a backend using a bounded pool of workers, retrying failed uploads with
+    exponential backoff, and optionally skipping files which the backend already has.'''
+
+    def __init__(self, backend, max_workers=4, attempts=3, retry_delay_seconds=2):
+        self._backend = backend
+        self._max_workers = max_workers
+        self._attempts = attempts
+        self._retry_delay_seconds = retry_delay_seconds
+
+
+    def upload_all(self, filepaths, sha256s, skip_unchanged=False):
+        '''Uploads the files, given {filepath: sha256}. Raises an exception listing any files which
+        couldn't be uploaded, after all the others have been.'''
+        start = time.time()
+        results = []
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(self.upload_file, filepath, sha256s.get(filepath), skip_unchanged): filepath
+                       for filepath in filepaths}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append('{}: {}'.format(os.path.basename(futures[future]), e))
+        self._log_summary(results, time.time() - start)
+        if errors:
+            raise Exception('Failed to upload {} of {} artifacts: {}'.format(
+                len(errors), len(filepaths), ', '.join(errors)))
+        return results
+
+
+    def upload_file(self, filepath, sha256, skip_unchanged=False):
+        '''Uploads a single file in the calling thread, with retries. Returns (filepath, bytes uploaded,
+        seconds, attempts), where attempts is 0 if the file was skipped.'''
+        filename = os.path.basename(filepath)
+        if skip_unchanged and sha256 and self._backend.get_sha256(filename) == sha256:
+            logger.info('Skipping unchanged artifact: {}'.format(filename))
+            return filepath, 0, 0, 0
+        for attempt in range(1, self._attempts + 1):
+            start = time.time()
+            try:
+                self._backend.upload(filepath, sha256=sha256)
+                return filepath, os.path.getsize(filepath), time.time() - start, attempt
+            except Exception as e:
+                if attempt == self._attempts:
+                    raise
+                delay = self._retry_delay_seconds * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                logger.info('[{}/{}] Upload of {} failed, retrying in {:.1f}s: {}'.format(
+                    attempt, self._attempts, filename, delay, e))
+                time.sleep(delay)
+
+
+    def _log_summary(self, results, elapsed):
+        uploaded = [result for result in results if result[3]]
+        total_bytes = sum(result[1] for result in uploaded)
+        logger.info('Uploaded {} artifacts ({:.1f} MB) in {:.1f}s ({:.1f} MB/s), skipped {} unchanged:'.format(
+            len(uploaded), total_bytes / 1000000, elapsed, total_bytes / 1000000 / max(elapsed, 0.001),
+            len(results) - len(uploaded)))
+        for filepath, size, seconds, attempts in sorted(results, key=lambda result: -result[2]):
+            if attempts:
+                logger.info('  {}: {:.1f} MB in {:.1f}s ({} attempt{})'.format(
+                    os.path.basename(filepath), size / 1000000, seconds, attempts, '' if attempts == 1 else 's'))
+
+
+def _default_backend(s3_directory, aws_region, dry_run):
+    if s3_directory.startswith('file://'):
+        return LocalDirectoryBackend(urllib.parse.urlparse(s3_directory).path)
+    return AWSCLIBackend(s3_directory, aws_region, os.environ.get('S3_ENDPOINT_URL', ''), dry_run)
+
+
 class AWSPublisher(object):
 
     def __init__(
@@ -33,7 +200,8 @@ class AWSPublisher(object):
             package_name,
             input_dir_path,
             artifact_paths,
-            package_version = 'stub-universe'):
+            package_version = 'stub-universe',
+            backend = None):
         self._dry_run = os.environ.get('DRY_RUN', '')
         self._pkg_name = package_name
         self._pkg_version = package_version
@@ -46,6 +214,8 @@ class AWSPublisher(object):
             time.strftime("%Y%m%d-%H%M%S"),
             ''.join([random.SystemRandom().choice(string.ascii_letters + string.digits) for i in range(16)]))
 
+        # an explicitly provided destination may already hold some of the artifacts
+        self._skip_unchanged = 'S3_URL' in os.environ
         # sample s3_directory: 'infinity-artifacts/autodelete7d/kafka/20160815-134747-S6vxd0gRQBw43NNy'
         self._s3_directory = os.environ.get(
             'S3_URL',
@@ -70,13 +240,12 @@ class AWSPublisher(object):
             self._github_updater.update('error', err)
             raise Exception(err)
 
-        # check if aws cli tools are installed
-        cmd = "aws --version"
-        ret = os.system(cmd)
-        if not ret == 0:
-            err = 'Required AWS cli tools not installed.'
-            self._github_updater.update('error', err)
-            raise Exception(err)
+        try:
+            self._backend = backend or _default_backend(self._s3_directory, self._aws_region, self._dry_run)
+        except Exception as e:
+            self._github_updater.update('error', str(e))
+            raise
+        self._uploader = ConcurrentUploader(self._backend, int(os.environ.get('UPLOAD_CONCURRENCY', 4)))
 
         self._artifact_paths = []
         for artifact_path in artifact_paths:
@@ -92,24 +261,12 @@ class AWSPublisher(object):
 
     def _upload_artifact(self, filepath, content_type=None):
         filename = os.path.basename(filepath)
-        cmdlist = ['aws s3']
-        if self._aws_region:
-            cmdlist.append('--region={}'.format(self._aws_region))
-        cmdlist.append('cp --acl public-read')
-        if content_type:
-            cmdlist.append('--content-type "{}"'.format(content_type))
-        cmdlist.append('{} {}/{} 1>&2'.format(filepath, self._s3_directory, filename))
-        cmd = ' '.join(cmdlist)
-        if self._dry_run:
-            logger.info('[DRY RUN] {}'.format(cmd))
-            ret = 0
-        else:
-            logger.info(cmd)
-            ret = os.system(cmd)
-        if not ret == 0:
+        try:
+            self._backend.upload(filepath, content_type=content_type)
+        except Exception:
             err = 'Failed to upload {} to S3'.format(filename)
             self._github_updater.update('error', err)
-            raise Exception(err)
+            raise
         return '{}/{}'.format(self._http_directory, filename)
 
 
@@ -142,9 +299,10 @@ class AWSPublisher(object):
 
     def upload(self):
         '''generates a unique directory, then uploads artifacts and a new stub universe to that directory'''
+        cache = universe_builder.open_cache()
         builder = universe_builder.UniversePackageBuilder(
             self._pkg_name, self._pkg_version,
-            self._input_dir_path, self._http_directory, self._artifact_paths)
+            self._input_dir_path, self._http_directory, self._artifact_paths, cache=cache)
         try:
             universe_path = builder.build_package()
         except Exception as e:
@@ -157,8 +315,20 @@ class AWSPublisher(object):
         logger.info('---')
         logger.info('Uploading {} artifacts:'.format(len(self._artifact_paths)))
 
-        for path in self._artifact_paths:
-            self._upload_artifact(path)
+        sha256s = universe_builder.get_sha256s(self._artifact_paths, cache)
+        if cache:
+            cache.save()
+        # keep each artifact, so that releasing it from this machine doesn't need to download it
+        # again, where it can be linked into the store for free
+        store = artifact_store.open_store()
+        if store:
+            artifact_store.add_artifacts(store, sha256s)
+
+        try:
+            self._uploader.upload_all(self._artifact_paths, sha256s, self._skip_unchanged)
+        except Exception as e:
+            self._github_updater.update('error', str(e))
+            raise
 
         self._spam_universe_url(universe_url)
 
@@ -205,5 +375,80 @@ Artifacts:       {}
     return 0
 
 
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest publish_aws
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='publish-aws-')
+        self.backend = LocalDirectoryBackend(os.path.join(self.test_dir, 'bucket'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, filename, content):
+        path = os.path.join(self.test_dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_upload_all(self):
+        paths = [self._write('a.zip', 'aaa'), self._write('b.zip', 'bb')]
+        results = ConcurrentUploader(self.backend).upload_all(paths, {paths[0]: 'sha-a'})
+        self.assertEqual(sorted((os.path.basename(r[0]), r[1], r[3]) for r in results), [('a.zip', 3, 1), ('b.zip', 2, 1)])
+        with open(os.path.join(self.test_dir, 'bucket', 'b.zip')) as f:
+            self.assertEqual(f.read(), 'bb')
+        self.assertEqual(self.backend.get_sha256('a.zip'), 'sha-a')
+        self.assertIsNone(self.backend.get_sha256('b.zip'))
+
+    def test_skip_unchanged(self):
+        path = self._write('a.zip', 'aaa')
+        uploader = ConcurrentUploader(self.backend)
+        uploader.upload_all([path], {path: 'sha-1'})
+        self._write('a.zip', 'changed')
+        # same sha256 as the backend already has: left alone
+        self.assertEqual(uploader.upload_all([path], {path: 'sha-1'}, skip_unchanged=True), [(path, 0, 0, 0)])
+        with open(os.path.join(self.test_dir, 'bucket', 'a.zip')) as f:
+            self.assertEqual(f.read(), 'aaa')
+        # only skipped when asked to:
+        self.assertEqual(uploader.upload_all([path], {path: 'sha-1'})[0][3], 1)
+        # and never without a sha256 to compare:
+        self.assertEqual(uploader.upload_all([path], {}, skip_unchanged=True)[0][3], 1)
+        (_, size, _, attempts), = uploader.upload_all([path], {path: 'sha-2'}, skip_unchanged=True)
+        self.assertEqual((size, attempts), (len('changed'), 1))
+        self.assertEqual(self.backend.get_sha256('a.zip'), 'sha-2')
+
+    def test_retry_after_transient_failure(self):
+        failures = {'a.zip': 2}
+        class FlakyBackend(LocalDirectoryBackend):
+            def upload(self, filepath, content_type=None, sha256=None):
+                filename = os.path.basename(filepath)
+                if failures.get(filename):
+                    failures[filename] -= 1
+                    raise Exception('connection reset')
+                super().upload(filepath, content_type, sha256)
+        path = self._write('a.zip', 'aaa')
+        uploader = ConcurrentUploader(FlakyBackend(os.path.join(self.test_dir, 'bucket')), attempts=3, retry_delay_seconds=0)
+        self.assertEqual(uploader.upload_all([path], {path: 'sha-a'})[0][3], 3)
+        self.assertEqual(self.backend.get_sha256('a.zip'), 'sha-a')
+
+    def test_failure_summary(self):
+        class BrokenBackend(LocalDirectoryBackend):
+            def upload(self, filepath, content_type=None, sha256=None):
+                if os.path.basename(filepath) != 'ok.zip':
+                    raise Exception('access denied')
+                super().upload(filepath, content_type, sha256)
+        paths = [self._write(name, 'x') for name in ('ok.zip', 'bad1.zip', 'bad2.zip')]
+        uploader = ConcurrentUploader(BrokenBackend(os.path.join(self.test_dir, 'bucket')), attempts=2, retry_delay_seconds=0)
+        with self.assertRaises(Exception) as context:
+            uploader.upload_all(paths, {})
+        message = str(context.exception)
+        self.assertTrue(message.startswith('Failed to upload 2 of 3 artifacts: '), message)
+        self.assertIn('bad1.zip: access denied', message)
+        self.assertIn('bad2.zip: access denied', message)
+        self.assertNotIn('ok.zip', message)
+        # the others were still uploaded:
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir, 'bucket', 'ok.zip')))
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
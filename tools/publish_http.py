@@ -7,22 +7,74 @@
 #   HTTP_DIR (default: /tmp/dcos-http-<pkgname>/)
 #   HTTP_HOST (default: 172.17.0.1, which is the ip of the VM when running dcos-docker)
 #   HTTP_PORT (default: 0, for an ephemeral port)
+#   HTTP_STAGING (default: auto)
+#     How to place artifacts in HTTP_DIR: hardlink, reflink, symlink, or copy.
+#     auto tries each in that order.
 
+import collections
 import json
 import logging
 import os
 import os.path
-import shutil
+import signal
 import socket
 import subprocess
 import sys
+import time
 
+import artifact_server
+import artifact_store
 import github_update
 import universe_builder
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
+_STAGING_METHODS = ['hardlink', 'reflink', 'symlink', 'copy']
+
+
+def _is_staged(srcpath, destpath):
+    '''Returns whether destpath already holds the current content of srcpath'''
+    if not os.path.exists(destpath):
+        # missing, or a dangling symlink to a build output which has since been cleaned
+        return False
+    if os.path.samefile(srcpath, destpath):
+        # a hardlink or symlink to the artifact itself
+        return True
+    if os.path.islink(destpath):
+        return False
+    src_stat = os.stat(srcpath)
+    dest_stat = os.stat(destpath)
+    # a copy or reflink, made with the source's mtime
+    return src_stat.st_size == dest_stat.st_size and src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+
+
+def stage_file(srcpath, destpath, methods=_STAGING_METHODS):
+    '''Makes the content of srcpath available at destpath, using the first of the methods which works
+    (e.g. hardlinks only work within a filesystem). Returns the method used, or None if destpath was
+    already up to date.'''
+    if _is_staged(srcpath, destpath):
+        return None
+    if os.path.lexists(destpath):
+        os.remove(destpath)
+    return artifact_store.place_file_with_any(srcpath, destpath, methods)
+
+
+def _is_artifact_server(pid):
+    '''Returns whether pid is still an artifact server, rather than having exited and possibly been
+    reused by something else. Without a /proc to check, only whether pid exists is checked.'''
+    if not os.path.isdir('/proc'):
+        try:
+            os.kill(pid, 0)
+            return True
+        except OSError:
+            return False
+    try:
+        with open('/proc/{}/cmdline'.format(pid), 'rb') as cmdline:
+            return b'artifact_server' in cmdline.read()
+    except OSError:
+        return False
+
 
 class HTTPPublisher(object):
 
@@ -39,6 +91,15 @@ class HTTPPublisher(object):
         self._http_dir = os.environ.get('HTTP_DIR', '/tmp/dcos-http-{}/'.format(package_name))
         self._http_host = os.environ.get('HTTP_HOST', '172.17.0.1')
         self._http_port = int(os.environ.get('HTTP_PORT', '0'))
+        staging = os.environ.get('HTTP_STAGING', 'auto')
+        if staging == 'auto':
+            self._staging_methods = _STAGING_METHODS
+        elif staging in _STAGING_METHODS:
+            self._staging_methods = [staging]
+        else:
+            raise Exception('Unknown HTTP_STAGING value (expected auto or one of {}): {}'.format(
+                ', '.join(_STAGING_METHODS), staging))
+        self._staged_counts = collections.Counter()
 
         self._github_updater = github_update.GithubStatusUpdater('upload:{}'.format(package_name))
 
@@ -62,8 +123,9 @@ class HTTPPublisher(object):
     def _copy_artifact(self, http_url_root, filepath):
         filename = os.path.basename(filepath)
         destpath = os.path.join(self._http_dir, filename)
-        logger.info('- {}'.format(destpath))
-        shutil.copyfile(filepath, destpath)
+        method = stage_file(filepath, destpath, self._staging_methods)
+        logger.info('- {} ({})'.format(destpath, method or 'unchanged'))
+        self._staged_counts[method or 'unchanged'] += 1
         return '{}/{}'.format(http_url_root, filename)
 
 
@@ -103,13 +165,28 @@ class HTTPPublisher(object):
             self._github_updater.update('error', err)
             raise
 
-        # wipe files in dir
+        # wipe files in dir which aren't being published again. the rest are left in place, and only
+        # restaged if they've changed
         if not os.path.isdir(self._http_dir):
             os.makedirs(self._http_dir)
+        published_filenames = set(os.path.basename(path) for path in self._artifact_paths + [universe_path])
+        published_filenames.update(os.path.basename(path) for path in [
+            self._pidfile_path(), self._logfile_path(), self._statsfile_path()])
         for filename in os.listdir(self._http_dir):
+            if filename in published_filenames:
+                continue
             path = os.path.join(self._http_dir, filename)
             logger.info('Deleting preexisting file in artifact dir: {}'.format(path))
             os.remove(path)
+        self._staged_counts.clear()
+
+        # keep each artifact for later releases, where it can be linked into the store for free
+        store = artifact_store.open_store()
+        if store:
+            sha256s = universe_builder.get_sha256s(self._artifact_paths, self._cache)
+            if self._cache:
+                self._cache.save()
+            artifact_store.add_artifacts(store, sha256s)
 
         # print universe url early
         universe_url = self._copy_artifact(http_url_root, universe_path)
@@ -121,6 +198,8 @@ class HTTPPublisher(object):
 
         for path in self._artifact_paths:
             self._copy_artifact(http_url_root, path)
+        logger.info('Staged files: {}'.format(', '.join(
+            '{} {}'.format(count, method) for method, count in sorted(self._staged_counts.items()))))
 
         self._spam_universe_url(universe_url)
 
@@ -129,14 +208,53 @@ class HTTPPublisher(object):
 
         return universe_url
 
-    def launch_http(self):
-        # kill any prior matching process
-        procname = 'publish_httpd_{}.py'.format(self._pkg_name)
+    def _pidfile_path(self):
+        # hidden files aren't served
+        return os.path.join(self._http_dir, '.artifact_server.pid')
+
+    def _logfile_path(self):
+        return os.path.join(self._http_dir, '.artifact_server.log')
+
+    def _statsfile_path(self):
+        return os.path.join(self._http_dir, '.artifact_server_stats.json')
+
+    def _stop_previous_server(self):
         try:
-            subprocess.check_call('killall -9 {}'.format(procname).split())
-            logger.info("Killed previous HTTP process(es): {}".format(procname))
-        except:
-            logger.info("No previous HTTP process found: {}".format(procname))
+            with open(self._pidfile_path()) as pidfile:
+                pid = int(pidfile.read().strip())
+        except (OSError, ValueError):
+            logger.info('No previous HTTP process found')
+            return
+        os.remove(self._pidfile_path())
+        if not _is_artifact_server(pid):
+            logger.info('Previous HTTP process has already exited: {}'.format(pid))
+            return
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            logger.info('Unable to stop previous HTTP process {}: {}'.format(pid, e))
+            return
+        # wait for it to let go of its port, in case we're reusing it
+        deadline = time.time() + 10
+        while time.time() < deadline and _is_artifact_server(pid):
+            time.sleep(0.1)
+        logger.info('Stopped previous HTTP process: {} (request metrics: {})'.format(
+            pid, self._statsfile_path()))
+
+    def _wait_for_server(self, process, timeout_seconds=10):
+        # the server writes its pidfile once it's listening
+        deadline = time.time() + timeout_seconds
+        while time.time() < deadline and process.poll() is None:
+            if os.path.exists(self._pidfile_path()):
+                return
+            time.sleep(0.1)
+        raise Exception('HTTP server failed to start, see {}'.format(self._logfile_path()))
+
+
+    def launch_http(self):
+        if not os.path.isdir(self._http_dir):
+            os.makedirs(self._http_dir)
+        self._stop_previous_server()
 
         if self._http_port == 0:
             # hack: grab/release a suitable ephemeral port and hope nobody steals it in the meantime
@@ -149,44 +267,26 @@ class HTTPPublisher(object):
 
         http_url_root = 'http://{}:{}'.format(self._http_host, port)
 
+        self._cache = universe_builder.open_cache()
         self._package_builder = universe_builder.UniversePackageBuilder(
             self._pkg_name, self._pkg_version,
-            self._input_dir_path, http_url_root, self._artifact_paths)
-
-        # hack: write httpd script then run it directly
-        httpd_py_content = '''#!/usr/bin/env python3
-import os, socketserver
-from http.server import SimpleHTTPRequestHandler
-rootdir = '{}'
-host = '{}'
-port = {}
-json_content_type = '{}'
-
-class CustomTypeHandler(SimpleHTTPRequestHandler):
-    def __init__(self, req, client_addr, server):
-        SimpleHTTPRequestHandler.__init__(self, req, client_addr, server)
-    def guess_type(self, path):
-        if path.endswith('.json'):
-            return json_content_type
-        return SimpleHTTPRequestHandler.guess_type(self, path)
-
-os.chdir(rootdir)
-httpd = socketserver.TCPServer((host, port), CustomTypeHandler)
-print('Serving %s at http://%s:%s' % (rootdir, host, port))
-httpd.serve_forever()
-'''.format(self._http_dir, self._http_host, port, self._package_builder.content_type())
-
-        httpd_py_path = os.path.join(self._http_dir, procname)
-        if not os.path.isdir(self._http_dir):
-            os.makedirs(self._http_dir)
-        httpd_py_file = open(httpd_py_path, 'w+')
-        httpd_py_file.write(httpd_py_content)
-        httpd_py_file.flush()
-        httpd_py_file.close()
-
-        os.chmod(httpd_py_path, 0o744)
-        logger.info('Launching HTTPD: {}'.format(httpd_py_path))
-        subprocess.Popen([httpd_py_path, "2&1>", "/dev/null"])
+            self._input_dir_path, http_url_root, self._artifact_paths, cache=self._cache)
+
+        server_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artifact_server.py')
+        logger.info('Launching HTTPD: {} (log: {})'.format(server_py_path, self._logfile_path()))
+        with open(self._logfile_path(), 'w') as logfile:
+            # in its own session, so that it outlives us and isn't hit by a ctrl+c at the terminal
+            process = subprocess.Popen(
+                [sys.executable, server_py_path, self._http_dir,
+                 '--host', self._http_host,
+                 '--port', str(port),
+                 '--json-content-type', self._package_builder.content_type(),
+                 '--pidfile', self._pidfile_path(),
+                 '--stats-file', self._statsfile_path()],
+                stdin=subprocess.DEVNULL, stdout=logfile, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        self._wait_for_server(process)
+        logger.info('Request metrics: {}{}'.format(http_url_root, artifact_server.STATS_PATH))
 
         return http_url_root
 
@@ -2,25 +2,304 @@
 
 import base64
 import collections
+import concurrent.futures
 import difflib
+import hashlib
 import http.client
 import json
 import logging
 import os
 import os.path
 import pprint
+import random
 import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
+import unittest
+import urllib.error
 import urllib.request
 import zipfile
 
+import artifact_store
+import publish_aws
+
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
 
+def _json_value(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def json_diff(last, this, path=''):
+    '''Returns lines describing the changes between two parsed json documents, one per changed value,
+    addressed by its key path. For example:
+      ~ assets.uris.scheduler-zip: "https://a/scheduler.zip" -> "https://b/scheduler.zip"
+      + selected: false
+      - tags[2]: "beta"
+    Unlike a line diff, this isn't thrown off by keys being reordered or reindented.'''
+    if isinstance(last, dict) and isinstance(this, dict):
+        lines = []
+        for key in sorted(set(last) | set(this)):
+            child_path = '{}.{}'.format(path, key) if path else key
+            if key not in this:
+                lines.append('- {}: {}'.format(child_path, _json_value(last[key])))
+            elif key not in last:
+                lines.append('+ {}: {}'.format(child_path, _json_value(this[key])))
+            else:
+                lines.extend(json_diff(last[key], this[key], child_path))
+        return lines
+    if isinstance(last, list) and isinstance(this, list):
+        # match up list entries, so that an insertion doesn't show up as a change to everything after it
+        lines = []
+        matcher = difflib.SequenceMatcher(None, [_json_value(v) for v in last], [_json_value(v) for v in this],
+                                          autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            if tag == 'replace' and i2 - i1 == j2 - j1:
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    lines.extend(json_diff(last[i], this[j], '{}[{}]'.format(path, j)))
+                continue
+            for i in range(i1, i2):
+                lines.append('- {}[{}]: {}'.format(path, i, _json_value(last[i])))
+            for j in range(j1, j2):
+                lines.append('+ {}[{}]: {}'.format(path, j, _json_value(this[j])))
+        return lines
+    if type(last) == type(this) and last == this:
+        return []
+    return ['~ {}: {} -> {}'.format(path or '(root)', _json_value(last), _json_value(this))]
+
+
+def diff_package_file(last_path, this_path, fromfile, tofile):
+    '''Returns a description of the changes between two revisions of a package file, or an empty
+    string if there are none. Json files are compared structurally, anything else (e.g. mustache
+    templates) line by line.'''
+    with open(last_path, 'rb') as last_file, open(this_path, 'rb') as this_file:
+        last_content = last_file.read()
+        this_content = this_file.read()
+    if last_content == this_content:
+        return ''
+    last_text = last_content.decode('utf-8')
+    this_text = this_content.decode('utf-8')
+    if this_path.endswith('.json'):
+        try:
+            lines = json_diff(json.loads(last_text), json.loads(this_text))
+        except ValueError:
+            lines = None # not valid json after all: fall back to a line diff
+        if lines is not None:
+            if not lines:
+                return ''
+            return '--- {}\n+++ {}\n{}\n'.format(fromfile, tofile, '\n'.join(lines))
+    return ''.join(difflib.unified_diff(
+        last_text.splitlines(keepends=True), this_text.splitlines(keepends=True),
+        fromfile=fromfile, tofile=tofile))
+
+
+class ArtifactCopier(object):
+    '''Copies artifacts from their stub universe urls into the release directory.
+
+    Artifacts are downloaded concurrently, each streamed to disk in chunks and hashed as it arrives.
+    Each one is verified against the sha256 listed in the stub universe (and the sha256 which
+    publish_aws stores with the dev upload, if any), then uploaded while later artifacts are still
+    downloading.
+
+    Progress is kept in state_dir, so that a release which fails partway through can be rerun to pick
+    up where it left off: artifacts which were uploaded aren't copied again, and partial downloads
+    are resumed with range requests.
+
+    Artifacts whose sha256 is known up front, or from the response headers, are taken from the
+    artifact store rather than downloaded if it has them, and downloaded artifacts are added to it.'''
+
+    _CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, uploader, state_dir, destination, concurrency=4, attempts=3, retry_delay_seconds=2,
+                 store=None):
+        self._uploader = uploader
+        self._store = store
+        self._state_dir = state_dir
+        self._concurrency = concurrency
+        self._attempts = attempts
+        self._retry_delay_seconds = retry_delay_seconds
+        self._state_lock = threading.Lock()
+
+        os.makedirs(state_dir, exist_ok=True)
+        self._state_path = os.path.join(state_dir, 'state.json')
+        self._state = {'destination': destination, 'artifacts': {}}
+        try:
+            with open(self._state_path) as state_file:
+                state = json.load(state_file)
+            if state.get('destination') == destination:
+                self._state = state
+            else:
+                logger.info('Ignoring copy state for a different destination: {}'.format(state.get('destination')))
+        except (IOError, ValueError):
+            pass
+
+
+    def uploaded_count(self):
+        with self._state_lock:
+            return len([entry for entry in self._state['artifacts'].values() if entry.get('uploaded')])
+
+
+    def copy_all(self, urls, expected_sha256s):
+        '''Copies the artifacts at urls, given {filename: sha256} for the artifacts whose sha256s are
+        known in advance. Raises an exception listing any artifacts which couldn't be copied, after
+        all the others have been.'''
+        start = time.time()
+        errors = []
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._concurrency) as downloads, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self._concurrency) as uploads:
+            download_futures = {}
+            for url in urls:
+                filename = url.split('/')[-1]
+                if self._get_state(filename).get('uploaded'):
+                    logger.info('Already uploaded by a previous attempt: {}'.format(filename))
+                    continue
+                future = downloads.submit(self._download, url, expected_sha256s.get(filename))
+                download_futures[future] = filename
+            upload_futures = {}
+            for future in concurrent.futures.as_completed(download_futures):
+                filename = download_futures[future]
+                try:
+                    path, sha256, size = future.result()
+                except Exception as e:
+                    errors.append('{}: {}'.format(filename, e))
+                    continue
+                upload_futures[uploads.submit(self._upload, filename, path, sha256)] = (filename, size)
+            for future in concurrent.futures.as_completed(upload_futures):
+                filename, size = upload_futures[future]
+                try:
+                    future.result()
+                    results.append(size)
+                except Exception as e:
+                    errors.append('{}: {}'.format(filename, e))
+        elapsed = time.time() - start
+        logger.info('Copied {} artifacts ({:.1f} MB) in {:.1f}s ({:.1f} MB/s), {} already copied'.format(
+            len(results), sum(results) / 1000000, elapsed, sum(results) / 1000000 / max(elapsed, 0.001),
+            len(urls) - len(download_futures)))
+        if errors:
+            raise Exception('Failed to copy {} of {} artifacts: {}'.format(
+                len(errors), len(urls), ', '.join(errors)))
+
+
+    def clear(self):
+        '''Removes the copy state, once the release is complete'''
+        shutil.rmtree(self._state_dir, ignore_errors=True)
+
+
+    def _get_state(self, filename):
+        with self._state_lock:
+            return dict(self._state['artifacts'].get(filename, {}))
+
+
+    def _update_state(self, filename, **fields):
+        with self._state_lock:
+            self._state['artifacts'].setdefault(filename, {}).update(fields)
+            tmp_path = self._state_path + '.tmp'
+            with open(tmp_path, 'w') as state_file:
+                json.dump(self._state, state_file, indent=2)
+            os.replace(tmp_path, self._state_path)
+
+
+    def _download(self, url, expected_sha256):
+        '''Returns (local path, sha256, size) for a verified download of url'''
+        filename = url.split('/')[-1]
+        path = os.path.join(self._state_dir, filename)
+        entry = self._get_state(filename)
+        if entry.get('sha256') and os.path.isfile(path):
+            logger.info('Already downloaded by a previous attempt: {}'.format(filename))
+            return path, entry['sha256'], os.path.getsize(path)
+        if expected_sha256 and self._store and self._store.get_file(expected_sha256, path):
+            logger.info('Using {} from the artifact store'.format(filename))
+            self._update_state(filename, url=url, sha256=expected_sha256, uploaded=False)
+            return path, expected_sha256, os.path.getsize(path)
+        for attempt in range(1, self._attempts + 1):
+            try:
+                logger.info('Downloading {}'.format(url))
+                sha256 = self._fetch(url, path, expected_sha256)
+                break
+            except Exception as e:
+                if attempt == self._attempts:
+                    raise
+                delay = self._retry_delay_seconds * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                logger.info('[{}/{}] Download of {} failed, retrying in {:.1f}s: {}'.format(
+                    attempt, self._attempts, filename, delay, e))
+                time.sleep(delay)
+        if self._store:
+            # the download is deleted once the release is done, so it's worth copying if need be
+            artifact_store.add_artifacts(self._store, {path: sha256}, artifact_store.PLACEMENT_METHODS)
+        self._update_state(filename, url=url, sha256=sha256, uploaded=False)
+        return path, sha256, os.path.getsize(path)
+
+
+    def _fetch(self, url, path, expected_sha256):
+        '''Downloads url to path, resuming any partial download left by an earlier attempt, and
+        returns its sha256 once it's been verified.'''
+        part_path = path + '.part'
+        hasher = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_path):
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(self._CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        source_sha256 = None
+        try:
+            response = urllib.request.urlopen(request, timeout=60)
+        except urllib.error.HTTPError as e:
+            if not (offset and e.code == 416):
+                raise
+            # the partial download was already complete
+            response = None
+        if response:
+            with response:
+                if offset and response.status != 206:
+                    logger.info('Unable to resume download of {}, starting over'.format(url))
+                    hasher = hashlib.sha256()
+                    offset = 0
+                # stored with the object by publish_aws
+                source_sha256 = response.headers.get('x-amz-meta-sha256')
+                source_matches = source_sha256 and (not expected_sha256 or source_sha256 == expected_sha256)
+                if not offset and source_matches and self._store and self._store.get_file(source_sha256, path):
+                    logger.info('Using {} from the artifact store'.format(os.path.basename(path)))
+                    return source_sha256
+                length = response.headers.get('Content-Length')
+                with open(part_path, 'ab' if offset else 'wb') as part_file:
+                    for chunk in iter(lambda: response.read(self._CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+                        part_file.write(chunk)
+            if length is not None and os.path.getsize(part_path) != offset + int(length):
+                # keep what we got, for the next attempt to resume from
+                raise Exception('Download of {} ended early at {} of {} bytes'.format(
+                    url, os.path.getsize(part_path), offset + int(length)))
+
+        sha256 = hasher.hexdigest()
+        for source, expected in (('stub universe', expected_sha256), ('source metadata', source_sha256)):
+            if expected and expected != sha256:
+                os.remove(part_path)
+                raise Exception('Downloaded {} has sha256 {}, but {} says {}'.format(
+                    url, sha256, source, expected))
+        os.replace(part_path, path)
+        return sha256
+
+
+    def _upload(self, filename, path, sha256):
+        # anything uploaded by an earlier attempt which didn't get recorded is skipped by its sha256
+        self._uploader.upload_file(path, sha256, skip_unchanged=True)
+        self._update_state(filename, uploaded=True)
+        os.remove(path)
+
+
 class UniverseReleaseBuilder(object):
 
     def __init__(self, package_version, stub_universe_url,
@@ -159,8 +438,12 @@ class UniverseReleaseBuilder(object):
             # no-op
         else:
             if showdiff:
+                # only the changed lines: templates can be long, and most lines don't change
                 logger.info('Applied templating changes to {}:'.format(path))
-                logger.info('\n'.join(difflib.ndiff(orig_content.split('\n'), new_content.split('\n'))))
+                filename = os.path.basename(path)
+                logger.info(''.join(difflib.unified_diff(
+                    orig_content.splitlines(keepends=True), new_content.splitlines(keepends=True),
+                    fromfile=filename, tofile=filename, n=0)))
             else:
                 logger.info('Applied templating changes to {}'.format(path))
             with open(path, 'w') as newfile:
@@ -188,26 +471,69 @@ class UniverseReleaseBuilder(object):
             new_content_lines = json.dumps(content_json, indent=2, sort_keys=True).split('\n')
             new_content = '\n'.join([line.rstrip() for line in new_content_lines]) + '\n'
             logger.info(new_content)
-            # don't bother showing diff, things get rearranged..
+            # a line diff would be noise, things get rearranged..
+            for line in json_diff(json.loads(orig_content), content_json):
+                logger.info(line)
             self._update_file_content(path, orig_content, new_content, showdiff=False)
 
         # we expect the artifacts to share the same directory prefix as the stub universe file itself:
         original_artifact_prefix = '/'.join(self._stub_universe_url.split('/')[:-1])
         logger.info('[2/2] Replacing artifact prefix {} with {}'.format(
             original_artifact_prefix, self._release_artifact_http_dir))
+        # urls end at the closing quote: there may be several on a line, e.g. in a list of uris
+        artifact_url_pattern = re.compile('({}/[^"]+)"'.format(re.escape(original_artifact_prefix)))
         original_artifact_urls = []
-        for filename in os.listdir(pkgdir):
+        for filename in sorted(os.listdir(pkgdir)):
             path = os.path.join(pkgdir, filename)
             with open(path, 'r') as orig_file:
                 orig_content = orig_file.read()
-                found = re.findall('({}/.+)\"'.format(original_artifact_prefix), orig_content)
-                original_artifact_urls += found
-                new_content = orig_content.replace(original_artifact_prefix, self._release_artifact_http_dir)
-                self._update_file_content(path, orig_content, new_content)
+            if original_artifact_prefix not in orig_content:
+                logger.info('No changes detected in {}'.format(path))
+                continue
+            original_artifact_urls += artifact_url_pattern.findall(orig_content)
+            new_content = orig_content.replace(original_artifact_prefix, self._release_artifact_http_dir)
+            self._update_file_content(path, orig_content, new_content)
         return original_artifact_urls
 
 
-    def _copy_artifacts_s3(self, scratchdir, original_artifact_urls):
+    def _get_artifact_sha256s(self, pkgdir):
+        '''Returns {filename: sha256} for the artifacts whose sha256s are listed in resource.json
+        (e.g. CLI binaries), for verifying their downloads.'''
+        resource_path = os.path.join(pkgdir, 'resource.json')
+        if not os.path.exists(resource_path):
+            return {}
+        with open(resource_path) as resource_file:
+            resource_json = json.load(resource_file)
+        sha256s = {}
+        def find_sha256s(node):
+            if isinstance(node, dict):
+                if 'url' in node and 'contentHash' in node:
+                    for content_hash in node['contentHash']:
+                        if content_hash.get('algo') == 'sha256':
+                            sha256s[node['url'].split('/')[-1]] = content_hash['value']
+                for value in node.values():
+                    find_sha256s(value)
+            elif isinstance(node, list):
+                for value in node:
+                    find_sha256s(value)
+        find_sha256s(resource_json)
+        return sha256s
+
+
+    def _artifact_copier(self):
+        state_dir = os.path.join(
+            os.path.expanduser(os.environ.get('RELEASE_STATE_DIR', '~/.cache/dcos-commons/release_builder')),
+            '{}-{}'.format(self._pkg_name, self._pkg_version))
+        backend = publish_aws.AWSCLIBackend(self._release_artifact_s3_dir)
+        return ArtifactCopier(publish_aws.ConcurrentUploader(backend), state_dir, self._release_artifact_s3_dir,
+                              int(os.environ.get('RELEASE_CONCURRENCY', 4)), store=artifact_store.open_store())
+
+
+    def _copy_artifacts_s3(self, original_artifact_urls, expected_sha256s):
+        # the same artifact may be referenced more than once
+        original_artifact_urls = list(collections.OrderedDict.fromkeys(original_artifact_urls))
+        copier = None if self._dry_run else self._artifact_copier()
+
         # before we do anything else, verify that the upload directory doesn't already exist, to
         # avoid automatically stomping on a previous release. if you *want* to do this, you must
         # manually delete the destination directory first. (and redirect stdout to stderr)
@@ -216,6 +542,9 @@ class UniverseReleaseBuilder(object):
         if ret == 0:
             if self._force_upload:
                 logger.info('Destination {} exists but force upload is configured, proceeding...'.format(self._release_artifact_s3_dir))
+            elif copier and copier.uploaded_count():
+                logger.info('Destination {} exists, resuming previous attempt which uploaded {} artifacts...'.format(
+                    self._release_artifact_s3_dir, copier.uploaded_count()))
             else:
                 raise Exception('Release artifact destination already exists. ' +
                                 'Refusing to continue until destination has been manually removed:\n' +
@@ -225,36 +554,21 @@ class UniverseReleaseBuilder(object):
         else:
             logger.info('Destination {} doesnt exist, proceeding...'.format(self._release_artifact_s3_dir))
 
-        for i in range(len(original_artifact_urls)):
-            progress = '[{}/{}]'.format(i + 1, len(original_artifact_urls))
-            src_url = original_artifact_urls[i]
-            filename = src_url.split('/')[-1]
-
-            local_path = os.path.join(scratchdir, filename)
-            dest_s3_url = '{}/{}'.format(self._release_artifact_s3_dir, filename)
-
-            # download the artifact (dev s3, via http)
-            if self._dry_run:
-                # create stub file to make 'aws s3 cp --dryrun' happy:
-                logger.info('[DRY RUN] {} Downloading {} to {}'.format(progress, src_url, local_path))
-                with open(local_path, 'w') as stub:
-                    stub.write('stub')
-                logger.info('[DRY RUN] {} Uploading {} to {}'.format(progress, local_path, dest_s3_url))
-                ret = os.system('aws s3 cp --dryrun --acl public-read {} {} 1>&2'.format(
-                    local_path, dest_s3_url))
-            else:
-                # download the artifact (http url referenced in package)
-                logger.info('{} Downloading {} to {}'.format(progress, src_url, local_path))
-                urllib.request.URLopener().retrieve(src_url, local_path)
-                # re-upload the artifact (prod s3, via awscli)
-                logger.info('{} Uploading {} to {}'.format(progress, local_path, dest_s3_url))
-                ret = os.system('aws s3 cp --acl public-read {} {} 1>&2'.format(
-                    local_path, dest_s3_url))
-            if ret != 0:
-                raise Exception(
-                    'Failed to upload {} to {}. '.format(local_path, dest_s3_url) +
-                    'Partial release directory may need to be cleared manually before retrying. Exiting early.')
-            os.unlink(local_path)
+        if self._dry_run:
+            for i, src_url in enumerate(original_artifact_urls):
+                progress = '[{}/{}]'.format(i + 1, len(original_artifact_urls))
+                filename = src_url.split('/')[-1]
+                logger.info('[DRY RUN] {} Downloading {} (expected sha256: {})'.format(
+                    progress, src_url, expected_sha256s.get(filename, 'unknown')))
+                logger.info('[DRY RUN] {} Uploading {} to {}/{}'.format(
+                    progress, filename, self._release_artifact_s3_dir, filename))
+            return None
+
+        try:
+            copier.copy_all(original_artifact_urls, expected_sha256s)
+        except Exception as e:
+            raise Exception('{}. Rerun to resume copying the remaining artifacts.'.format(e))
+        return copier
 
 
     def _create_universe_branch(self, scratchdir, pkgdir):
@@ -272,7 +586,7 @@ class UniverseReleaseBuilder(object):
         if ret != 0:
             raise Exception(
                 'Failed to create local Universe git branch {}. '.format(branch) +
-                'Note that any release artifacts were already uploaded to {}, which must be manually deleted before retrying.'.format(self._release_artifact_s3_dir))
+                'Release artifacts were already uploaded to {}, and won\'t be copied again if this is rerun.'.format(self._release_artifact_s3_dir))
         universe_repo = os.path.join(scratchdir, 'universe')
         repo_pkg_base = os.path.join(
             universe_repo,
@@ -311,15 +625,11 @@ class UniverseReleaseBuilder(object):
             shared_files = last_dir_files & this_dir_files
             for filename in shared_files:
                 # file exists in both new and old: calculate diff
-                last_filename = os.path.join(last_dir, filename)
-                this_filename = os.path.join(this_dir, filename)
-                with open(last_filename, 'r') as last_file, open(this_filename, 'r') as this_file:
-                    filediff = ''.join(difflib.unified_diff(
-                        last_file.readlines(), this_file.readlines(),
-                        fromfile='{}/{}'.format(lastnum, filename),
-                        tofile='{}/{}'.format(lastnum + 1, filename)))
-                    if filediff:
-                        filediffs[filename] = filediff
+                filediff = diff_package_file(
+                    os.path.join(last_dir, filename), os.path.join(this_dir, filename),
+                    '{}/{}'.format(lastnum, filename), '{}/{}'.format(lastnum + 1, filename))
+                if filediff:
+                    filediffs[filename] = filediff
         else:
             filediffs = {}
             removed_files = {}
@@ -357,7 +667,7 @@ class UniverseReleaseBuilder(object):
         if ret != 0:
             raise Exception(
                 'Failed to push git branch {} to Universe. '.format(branch) +
-                'Note that any release artifacts were already uploaded to {}, which must be manually deleted before retrying.'.format(self._release_artifact_s3_dir))
+                'Release artifacts were already uploaded to {}, and won\'t be copied again if this is rerun.'.format(self._release_artifact_s3_dir))
         return (branch, commitmsg_path)
 
 
@@ -451,15 +761,20 @@ class UniverseReleaseBuilder(object):
         if self._beta_release:
             pkgdir = self._add_beta_attributes(pkgdir)
 
+        expected_sha256s = self._get_artifact_sha256s(pkgdir)
         original_artifact_urls = self._update_package_get_artifact_source_urls(pkgdir)
-        self._copy_artifacts_s3(scratchdir, original_artifact_urls)
+        copier = self._copy_artifacts_s3(original_artifact_urls, expected_sha256s)
         if self._release_docker_image:
             orig_docker_image = self._original_docker_image(pkgdir)
             if not orig_docker_image:
                 raise Exception('Release to docker specified, but no docker image found in resource.json')
             self._copy_docker_image(pkgdir, orig_docker_image)
         (branch, commitmsg_path) = self._create_universe_branch(scratchdir, pkgdir)
-        return self._create_universe_pr(branch, commitmsg_path)
+        response = self._create_universe_pr(branch, commitmsg_path)
+        if copier:
+            # the artifacts are all in place: nothing left to resume
+            copier.clear()
+        return response
 
 
 def print_help(argv):
@@ -513,5 +828,53 @@ Universe URL:    {}{}
     return 0
 
 
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest release_builder
+
+    def test_json_diff_dicts(self):
+        last = {'name': 'hello', 'version': '1.0', 'tags': ['a'], 'assets': {'uris': {'zip': 'http://a/x.zip'}}}
+        this = {'version': '1.1', 'tags': ['a'], 'assets': {'uris': {'zip': 'http://b/x.zip'}}, 'selected': False}
+        self.assertEqual(json_diff(last, this), [
+            '~ assets.uris.zip: "http://a/x.zip" -> "http://b/x.zip"',
+            '- name: "hello"',
+            '+ selected: false',
+            '~ version: "1.0" -> "1.1"'])
+
+    def test_json_diff_unchanged(self):
+        self.assertEqual(json_diff({'a': [1, {'b': None}]}, {'a': [1, {'b': None}]}), [])
+        # values which compare equal in python, but not in json:
+        self.assertEqual(json_diff({'a': 1}, {'a': True}), ['~ a: 1 -> true'])
+        self.assertEqual(json_diff(1, 1.0), ['~ (root): 1 -> 1.0'])
+
+    def test_json_diff_lists(self):
+        # an insertion isn't reported as a change to everything after it:
+        self.assertEqual(json_diff({'tags': ['a', 'b', 'c']}, {'tags': ['x', 'a', 'b', 'c']}),
+                         ['+ tags[0]: "x"'])
+        self.assertEqual(json_diff(['a', 'b', 'c'], ['a', 'c']), ['- [1]: "b"'])
+        # same-length replacements are diffed in place:
+        self.assertEqual(json_diff([{'id': 1, 'v': 'old'}], [{'id': 1, 'v': 'new'}]),
+                         ['~ [0].v: "old" -> "new"'])
+        self.assertEqual(json_diff({'a': [1]}, {'a': {'b': 1}}), ['~ a: [1] -> {"b": 1}'])
+
+    def test_diff_package_file(self):
+        test_dir = tempfile.mkdtemp(prefix='release-builder-')
+        self.addCleanup(shutil.rmtree, test_dir)
+        def write(filename, content):
+            path = os.path.join(test_dir, filename)
+            with open(path, 'w') as f:
+                f.write(content)
+            return path
+        # reordered and reindented:
+        self.assertEqual(diff_package_file(
+            write('last.json', '{"a": 1, "b": 2}'), write('this.json', '{\n  "b": 2,\n  "a": 1\n}'), 'a/x', 'b/x'), '')
+        self.assertEqual(diff_package_file(
+            write('last.json', '{"a": 1}'), write('this.json', '{"a": 2}'), 'a/x', 'b/x'),
+            '--- a/x\n+++ b/x\n~ a: 1 -> 2\n')
+        # mustache templates fall back to a line diff:
+        self.assertEqual(diff_package_file(
+            write('last.json', '{"a": {{x}}}\n'), write('this.json', '{"a": {{y}}}\n'), 'a/x', 'b/x'),
+            '--- a/x\n+++ b/x\n@@ -1 +1 @@\n-{"a": {{x}}}\n+{"a": {{y}}}\n')
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
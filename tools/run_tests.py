@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import ast
+import glob
 import json
 import logging
 import os
@@ -10,25 +12,33 @@ import string
 import subprocess
 import sys
 import tempfile
+import unittest
+import xml.etree.ElementTree
 
 import cli_install
 import dcos_login
 import github_update
+import outputmux
 import piputil
+import testhistory
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
+# How long to wait for the rest of a shard's output once it has exited
+SHARD_OUTPUT_DRAIN_SECONDS = 60
+
 
 class CITester(object):
 
     def __init__(self, dcos_url, github_label, sandbox_path='', cli_path=None,
-                 fail_fast=False):
+                 fail_fast=False, parallel_modules=1):
         self._dcos_url = dcos_url
         self._sandbox_path = sandbox_path
         self._cli_path = cli_path
         self._github_updater = github_update.GithubStatusUpdater('test:{}'.format(github_label))
         self._fail_fast = fail_fast
+        self._parallel_modules = parallel_modules
 
 
     def _configure_cli_sandbox(self):
@@ -98,6 +108,42 @@ class CITester(object):
             raise
 
 
+    def _install_python_deps(self, package_path, requirements_filename=None):
+        if not os.path.isdir(package_path):
+            os.makedirs(package_path)
+
+        if requirements_filename is not None:
+            logger.info('Using provided requirements.txt: {}'.format(requirements_filename))
+            with open(requirements_filename) as req_f:
+                requirements_text = req_f.read()
+        else:
+            requirements_text = None
+
+        piputil.populate_dcoscommons_packagedir(package_path,
+                                                requirements_text)
+        piputil.activate_libdir(package_path)
+
+
+    def recycle_cluster(self):
+        """Cleans up after previous tests so that the cluster may be reused: reclaims agent disk
+        space and releases any reservations and volumes which were left behind."""
+        package_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recycle', 'python_deps')
+        self._install_python_deps(package_path)
+        sys.path.insert(0, package_path)
+        sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testing'))
+        import sdk_utils
+
+        self._github_updater.update('pending', 'Recycling cluster')
+        try:
+            sdk_utils.gc_frameworks()
+            sdk_utils.unreserve_resources()
+            sdk_utils.list_reserved_resources()
+            self._github_updater.update('success', 'Cluster recycled')
+        except:
+            self._github_updater.update('failure', 'Cluster recycling failed')
+            raise
+
+
     def run_shakedown(self, test_dirs, requirements_filename=None, pytest_types='sanity'):
         normal_path = test_dirs.rstrip(os.sep)
         framework = os.path.basename(os.path.dirname(normal_path))
@@ -111,38 +157,36 @@ class CITester(object):
         else:
             package_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                                            framework, 'python_deps')
+            path_based_name = None
             jenkins_args = ''
 
-        if not os.path.isdir(package_path):
-            os.makedirs(package_path)
-
-        if requirements_filename is not None:
-            logger.info('Using provided requirements.txt: {}'.format(requirements_filename))
-            with open(requirements_filename) as req_f:
-                requirements_text = req_f.read()
-        else:
-            requirements_text = None
-
-        piputil.populate_dcoscommons_packagedir(package_path,
-                                                requirements_text)
-        piputil.activate_libdir(package_path)
+        self._install_python_deps(package_path, requirements_filename)
 
         args = []
-        if jenkins_args:
-            args.append(jenkins_args)
         if self._fail_fast:
             args.append('--exitfirst')
-        args.extend(['-vv', '--fulltrace', '--capture=no', '-m', pytest_types, test_dirs])
+        args.extend(['-vv', '--fulltrace', '--capture=no', '-m', pytest_types])
 
-        sys.path.insert(0, package_path)
-        import pytest
-
-        # old method
-        #cmd = [sys.executable, '-m', 'pytest']
+        parallel_modules = self._parallel_modules
+        if parallel_modules > 1 and os.environ.get('SECURITY', '') == 'strict':
+            # the roles and secrets for the per-shard service folders aren't set up in strict mode
+            logger.warning('Not sharding test modules across {} processes: unsupported with SECURITY=strict'.format(
+                parallel_modules))
+            parallel_modules = 1
 
         self._github_updater.update('pending', 'Running shakedown tests')
         try:
-            returncode = pytest.main(args)
+            if parallel_modules > 1:
+                returncode = self._run_pytest_shards(framework, test_dirs, package_path, args, path_based_name)
+            else:
+                if jenkins_args:
+                    args.insert(0, jenkins_args)
+                args.append(test_dirs)
+                sys.path.insert(0, package_path)
+                import pytest
+                recorder = testhistory.PytestRecorder()
+                returncode = pytest.main(args, plugins=[recorder])
+                testhistory.record_tests(framework, recorder.results)
             if returncode == 0:
                 self._github_updater.update('success', 'Shakedown tests succeeded')
             else:
@@ -151,6 +195,64 @@ class CITester(object):
             self._github_updater.update('failure', 'Shakedown tests failed')
             raise
 
+    def _run_pytest_shards(self, framework, test_dirs, package_path, args, junit_path):
+        """Runs the test modules in test_dirs across parallel pytest processes.
+
+        Modules which declare SHARDABLE = True (see _is_shardable) are spread
+        across the shards, and each shard is given its own TEST_SERVICE_FOLDER
+        so that their services land in distinct Marathon folders. Other modules
+        could collide with each other, so they all go to a single shard which
+        runs them serially as before.
+        """
+        try:
+            history = testhistory.TestHistory()
+            try:
+                module_durations = history.module_durations(framework)
+            finally:
+                history.close()
+        except Exception:
+            logger.exception('Failed to read test history, sharding without durations')
+            module_durations = {}
+        shards = _shard_test_modules(test_dirs, self._parallel_modules, module_durations)
+        report_dir = tempfile.mkdtemp(prefix='shards-', dir=self._sandbox_path or None)
+        # stream the shards' output live, each line prefixed with its shard
+        mux = outputmux.OutputMux()
+        procs = []
+        for index, (folder, modules) in enumerate(shards):
+            shard_env = os.environ.copy()
+            shard_env['PYTHONPATH'] = os.pathsep.join(
+                [package_path] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+            if folder:
+                shard_env['TEST_SERVICE_FOLDER'] = folder
+            shard_args = [sys.executable, '-m', 'pytest'] + args
+            shard_args.append('--junitxml={}'.format(os.path.join(report_dir, 'shard-{}.xml'.format(index))))
+            shard_args.extend(modules)
+            logger.info('Starting shard {} (folder={}) with {} modules: {}'.format(
+                index, folder, len(modules), ' '.join(os.path.basename(m) for m in modules)))
+            log_file = open(os.path.join(report_dir, 'shard-{}.log'.format(index)), 'wb')
+            proc = subprocess.Popen(shard_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=shard_env)
+            stream = mux.add(folder or 'serial', proc.stdout, log_file)
+            procs.append((index, proc, stream, log_file))
+
+        returncode = 0
+        for index, proc, stream, log_file in procs:
+            shard_returncode = proc.wait()
+            if not stream.closed.wait(SHARD_OUTPUT_DRAIN_SECONDS):
+                logger.warning('Shard {} exited, but its output is still open after {}s'.format(
+                    index, SHARD_OUTPUT_DRAIN_SECONDS))
+            log_file.close()
+            logger.info('Shard {} exited with {}, output: {}'.format(index, shard_returncode, log_file.name))
+            if shard_returncode != 0:
+                returncode = shard_returncode
+
+        merged_path = os.path.join(report_dir, 'merged.xml')
+        _merge_junit_reports(
+            [os.path.join(report_dir, 'shard-{}.xml'.format(index)) for index, _, _, _ in procs], merged_path)
+        testhistory.record_tests(framework, testhistory.junit_test_results(merged_path))
+        if junit_path:
+            shutil.copyfile(merged_path, junit_path)
+        return returncode
+
     def run_dcostests(self, test_dirs, dcos_tests_dir, pytest_types='sanity'):
         os.environ['DOCKER_CLI'] = 'false'
         normal_path = test_dirs.rstrip(os.sep)
@@ -207,9 +309,77 @@ SSH_KEY_FILE="" PYTHONPATH=$(pwd) py.test {jenkins_args} -vv --capture=no -m "{p
         shutil.rmtree(self._sandbox_path)
 
 
+def _is_shardable(module_path):
+    """Whether a test module has opted in to running alongside other modules on the same cluster, with
+    a top-level "SHARDABLE = True". Such modules must install everything they create under
+    sdk_utils.get_foldered_name(), so that each shard's services are in a separate folder."""
+    with open(module_path) as f:
+        try:
+            tree = ast.parse(f.read(), module_path)
+        except SyntaxError:
+            return False
+    for node in tree.body:
+        if (isinstance(node, ast.Assign)
+                and any(isinstance(target, ast.Name) and target.id == 'SHARDABLE' for target in node.targets)):
+            try:
+                return ast.literal_eval(node.value) is True
+            except ValueError:
+                return False
+    return False
+
+
+def _shard_test_modules(test_dirs, shard_count, module_durations={}):
+    """Returns a list of (service folder or None, [module paths]) shards for the test modules in test_dirs.
+
+    Shardable modules are balanced across shards longest-first using module_durations (module name =>
+    seconds, from testhistory), with modules lacking any history assumed to take the average time."""
+    modules = sorted(glob.glob(os.path.join(test_dirs, 'test_*.py')))
+    serial_modules = []
+    foldered_modules = []
+    for module in modules:
+        if _is_shardable(module):
+            foldered_modules.append(module)
+        else:
+            serial_modules.append(module)
+    shards = []
+    if serial_modules:
+        shards.append((None, serial_modules))
+    foldered_shard_count = max(1, shard_count - len(shards))
+
+    def module_duration(module):
+        return module_durations.get(os.path.splitext(os.path.basename(module))[0], default_duration)
+    default_duration = sum(module_durations.values()) / len(module_durations) if module_durations else 1
+    shard_modules = [[] for _ in range(foldered_shard_count)]
+    shard_durations = [0] * foldered_shard_count
+    for module in sorted(foldered_modules, key=module_duration, reverse=True):
+        shortest = shard_durations.index(min(shard_durations))
+        shard_modules[shortest].append(module)
+        shard_durations[shortest] += module_duration(module)
+    for i, modules in enumerate(shard_modules):
+        if modules:
+            shards.append(('shard{}'.format(i), sorted(modules)))
+    return shards
+
+
+def _merge_junit_reports(report_paths, output_path):
+    """Combines the testsuites from several junit xml reports into one report."""
+    merged = xml.etree.ElementTree.Element('testsuites')
+    for report_path in report_paths:
+        if not os.path.isfile(report_path):
+            logger.warning('Missing shard report: {}'.format(report_path))
+            continue
+        root = xml.etree.ElementTree.parse(report_path).getroot()
+        # depending on the pytest version, the root is either a testsuite or a testsuites list:
+        suites = [root] if root.tag == 'testsuite' else list(root)
+        merged.extend(suites)
+    xml.etree.ElementTree.ElementTree(merged).write(output_path, encoding='utf-8', xml_declaration=True)
+    logger.info('Merged {} shard reports into {}'.format(len(report_paths), output_path))
+
+
 def print_help(argv):
     logger.info('Syntax: TEST_TYPES="sanity or recovery" CLUSTER_URL="yourcluster.com" {} <"shakedown"|"dcos-tests"> <path/to/tests/> </path/to/requirements.txt | /path/to/dcos-tests>'.format(argv[0]))
     logger.info('  Example (shakedown): $ {} shakedown /path/to/your/tests/ [/path/to/your/requirements.txt]'.format(argv[0]))
+    logger.info('  Example (recycle a cluster for reuse): $ {} recycle'.format(argv[0]))
     logger.info('  Example (dcos-tests, deprecated): $ {} dcos-tests /path/to/your/tests/ /path/to/dcos-tests/'.format(argv[0]))
 
 
@@ -245,12 +415,25 @@ def handle_failfast_option(argv):
         fail_fast = True
     return [ent for ent in argv if ent != fail_flag], fail_fast
 
+def handle_parallel_modules_option(argv):
+    parallel_flag = '--parallel-modules'
+    if not parallel_flag in argv:
+        return argv, 1
+    argv_copy = argv[:]
+    flag_pos = argv_copy.index(parallel_flag)
+    try:
+        parallel_modules = int(argv_copy[flag_pos + 1])
+    except:
+        sys.exit("Missing or invalid count argument for flag --parallel-modules")
+    del argv_copy[flag_pos:flag_pos+2]
+    return argv_copy, parallel_modules
+
 def main(argv):
-    if len(argv) < 3:
+    if len(argv) < 3 and not (len(argv) == 2 and argv[1] == 'recycle'):
         print_help(argv)
         return 1
     test_type = argv[1]
-    test_dirs = argv[2]
+    test_dirs = argv[2] if len(argv) >= 3 else None
 
     # Destructively handle --stub-universe args to avoid disturbing below
     # messy arg parsing
@@ -259,6 +442,7 @@ def main(argv):
     # and again; really need to implement an arg parser when this gets turned
     # into a module.
     argv, fail_fast = handle_failfast_option(argv)
+    argv, parallel_modules = handle_parallel_modules_option(argv)
 
     cluster_url = os.environ.get('CLUSTER_URL', '').strip('"').strip('\'')
     if cluster_url:
@@ -276,7 +460,7 @@ def main(argv):
             return 1
 
     tester = CITester(cluster_url, os.environ.get('TEST_GITHUB_LABEL', test_type),
-                      fail_fast=fail_fast)
+                      fail_fast=fail_fast, parallel_modules=parallel_modules)
 
     if not stub_universes:
         stub_universe_url = os.environ.get('STUB_UNIVERSE_URL', '')
@@ -295,6 +479,8 @@ def main(argv):
                 # use default requirements
                 requirements_filename = None
             tester.run_shakedown(test_dirs, requirements_filename, pytest_types)
+        elif test_type == 'recycle':
+            tester.recycle_cluster()
         elif test_type == 'dcos-tests':
             dcos_tests_dir = argv[3]
             tester.run_dcostests(test_dirs, dcos_tests_dir, pytest_types)
@@ -308,5 +494,66 @@ def main(argv):
     return 0
 
 
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest run_tests
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='run-tests-')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, filename, content):
+        path = os.path.join(self.test_dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_shardable_requires_marker(self):
+        self.assertTrue(_is_shardable(self._write('test_a.py', 'import sdk_utils\nSHARDABLE = True\n')))
+        # using the helper isn't enough:
+        self.assertFalse(_is_shardable(self._write('test_b.py', 'X = sdk_utils.get_foldered_name(PACKAGE_NAME)\n')))
+        self.assertFalse(_is_shardable(self._write('test_c.py', 'SHARDABLE = False\n')))
+        self.assertFalse(_is_shardable(self._write('test_d.py', 'def f():\n    SHARDABLE = True\n')))
+        self.assertFalse(_is_shardable(self._write('test_e.py', '# SHARDABLE = True\n')))
+
+    def test_shard_by_duration(self):
+        for name in ('test_big', 'test_medium', 'test_small', 'test_unknown'):
+            self._write(name + '.py', 'SHARDABLE = True\n')
+        self._write('test_fixed.py', 'PACKAGE_NAME = "hello-world"\n')
+        self._write('helpers.py', 'SHARDABLE = True\n')
+        shards = _shard_test_modules(self.test_dir, 3, {'test_big': 300, 'test_medium': 200, 'test_small': 100})
+        self.assertEqual(
+            [(folder, [os.path.basename(m) for m in modules]) for folder, modules in shards],
+            [(None, ['test_fixed.py']),
+             # test_unknown has no history, so is assumed to take the average of 200s:
+             ('shard0', ['test_big.py', 'test_small.py']),
+             ('shard1', ['test_medium.py', 'test_unknown.py'])])
+
+    def test_shard_helloworld_modules(self):
+        test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'frameworks', 'helloworld', 'tests')
+        shards = _shard_test_modules(test_dir, 3)
+        shard_names = [(folder, [os.path.basename(m) for m in modules]) for folder, modules in shards]
+        self.assertEqual(shard_names[0][0], None)
+        self.assertIn('test_sanity.py', shard_names[0][1])
+        self.assertIn('test_upgrade.py', shard_names[0][1])
+        self.assertEqual([folder for folder, _ in shard_names[1:]], ['shard0', 'shard1'])
+        # without history, the foldered modules are spread evenly across the remaining shards:
+        self.assertEqual(
+            sorted(name for _, names in shard_names[1:] for name in names),
+            ['test_discovery.py', 'test_executor_volumes.py', 'test_sidecar.py', 'test_uninstall.py', 'test_web_url.py'])
+        self.assertEqual(sorted(len(names) for _, names in shard_names[1:]), [2, 3])
+
+    def test_merge_junit_reports(self):
+        suite = self._write('a.xml', '<testsuite name="a"><testcase name="x"/></testsuite>')
+        suites = self._write('b.xml', '<testsuites><testsuite name="b"/><testsuite name="c"/></testsuites>')
+        merged = os.path.join(self.test_dir, 'merged.xml')
+        _merge_junit_reports([suite, os.path.join(self.test_dir, 'missing.xml'), suites], merged)
+        root = xml.etree.ElementTree.parse(merged).getroot()
+        self.assertEqual(root.tag, 'testsuites')
+        self.assertEqual([suite.get('name') for suite in root], ['a', 'b', 'c'])
+        self.assertEqual(len(root.find('testsuite').findall('testcase')), 1)
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
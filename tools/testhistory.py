@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Module to persist the durations and outcomes of framework test runs across
+invocations, so that later runs can be ordered and sharded using how long
+things actually took.
+
+Two kinds of entries are kept in a local SQLite database:
+ Framework runs, recorded by test.py: one per framework per invocation.
+ Individual test runs, recorded by run_tests.py: one per pytest test.
+
+The database location may be overridden with TEST_HISTORY_DB.
+"""
+
+import collections
+import logging
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS framework_runs (
+    framework TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS framework_runs_framework ON framework_runs (framework, start);
+CREATE TABLE IF NOT EXISTS test_runs (
+    framework TEXT NOT NULL,
+    test TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS test_runs_test ON test_runs (framework, test, start);
+'''
+
+
+def default_path():
+    path = os.environ.get('TEST_HISTORY_DB')
+    if path:
+        return path
+    # alongside the tools, like piputil's shared package dir: HOME may be
+    # pointed at a throwaway CLI sandbox by the time we're called.
+    return os.path.join(os.path.abspath(os.path.dirname(__file__)), 'test_history.db')
+
+
+class TestHistory(object):
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._conn = sqlite3.connect(self.path)
+        with self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def record_framework(self, framework, start, duration, ok):
+        with self._conn:
+            self._conn.execute(
+                'INSERT INTO framework_runs VALUES (?, ?, ?, ?)',
+                (framework, start, duration, 1 if ok else 0))
+
+    def record_tests(self, framework, test_results):
+        """test_results: iterable of (test name, start, duration, outcome)"""
+        with self._conn:
+            self._conn.executemany(
+                'INSERT INTO test_runs VALUES (?, ?, ?, ?, ?)',
+                [(framework,) + tuple(result) for result in test_results])
+
+    def framework_durations(self, max_runs=5):
+        """Returns {framework: mean duration in seconds} over each framework's
+        most recent successful runs.  Failed runs are ignored since they
+        often abort early."""
+        return self._mean_recent(
+            'SELECT framework, duration FROM framework_runs WHERE ok = 1 '
+            'ORDER BY start DESC', max_runs)
+
+    def test_durations(self, framework, max_runs=5):
+        """Returns {test: mean duration in seconds} for a framework's tests,
+        over each test's most recent passing runs."""
+        return self._mean_recent(
+            'SELECT test, duration FROM test_runs '
+            'WHERE framework = ? AND outcome = \'passed\' ORDER BY start DESC',
+            max_runs, (framework,))
+
+    def module_durations(self, framework, max_runs=5):
+        """Returns {module name: expected duration in seconds} for a
+        framework's test modules, summing the expected durations of their
+        tests."""
+        durations = collections.defaultdict(float)
+        for test, duration in self.test_durations(framework, max_runs).items():
+            durations[test.split('::')[0]] += duration
+        return dict(durations)
+
+    def _mean_recent(self, query, max_runs, params=()):
+        recent = collections.defaultdict(list)
+        for key, duration in self._conn.execute(query, params):
+            if len(recent[key]) < max_runs:
+                recent[key].append(duration)
+        return {key: sum(durations) / len(durations)
+                for key, durations in recent.items()}
+
+
+def record_framework(framework, start, duration, ok):
+    "Record a framework run, without letting history problems fail the run."
+    try:
+        history = TestHistory()
+        try:
+            history.record_framework(framework, start, duration, ok)
+        finally:
+            history.close()
+    except Exception:
+        logger.exception("Failed to record test history for %s", framework)
+
+
+def test_name(module, name):
+    """Test names are stored as "<module>::<test>", e.g. "test_sanity::test_install",
+    whether they came from a pytest node id or a junit report."""
+    return '{}::{}'.format(module, name)
+
+
+def record_tests(framework, test_results):
+    "Record test runs, without letting history problems fail the run."
+    try:
+        history = TestHistory()
+        try:
+            history.record_tests(framework, test_results)
+        finally:
+            history.close()
+    except Exception:
+        logger.exception("Failed to record test history for %s", framework)
+
+
+class PytestRecorder(object):
+    """pytest plugin which collects (test, start, duration, outcome) for
+    each test, for passing to record_tests()."""
+    def __init__(self):
+        self.results = []
+
+    def pytest_runtest_logreport(self, report):
+        # record the test body, or the setup if that's what failed/skipped
+        if report.when == 'call' or (report.when == 'setup' and report.outcome != 'passed'):
+            # node ids look like "tests/test_sanity.py::test_install[param]"
+            path, _, name = report.nodeid.partition('::')
+            module = os.path.splitext(os.path.basename(path))[0]
+            self.results.append((test_name(module, name), time.time() - report.duration,
+                                 report.duration, report.outcome))
+
+
+def junit_test_results(report_path):
+    """Extracts (test, start, duration, outcome) tuples from a junit xml
+    report.  Start times are approximate: junit reports don't carry them."""
+    results = []
+    mtime = os.path.getmtime(report_path)
+    for testcase in xml.etree.ElementTree.parse(report_path).getroot().iter('testcase'):
+        if testcase.find('failure') is not None or testcase.find('error') is not None:
+            outcome = 'failed'
+        elif testcase.find('skipped') is not None:
+            outcome = 'skipped'
+        else:
+            outcome = 'passed'
+        duration = float(testcase.get('time', 0))
+        # classnames look like "tests.test_sanity"
+        classname_parts = testcase.get('classname', '').split('.')
+        module = next((part for part in classname_parts if part.startswith('test_')), classname_parts[-1])
+        results.append((test_name(module, testcase.get('name', '')), mtime - duration, duration, outcome))
+    return results
@@ -2,15 +2,21 @@
 
 import base64
 import collections
+import concurrent.futures
 import difflib
 import hashlib
 import json
 import logging
+import mmap
 import os
 import os.path
 import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
+import unittest
 
 
 logger = logging.getLogger(__name__)
@@ -32,11 +38,220 @@ _expected_package_filenames = [
     _package_json_filename,
     _resource_json_filename]
 
+_sha256_param_pattern = re.compile('{{sha256:(.+?)}}')
+# any '{{...}}' token: either one of our template params, or left for mustache to fill in at install time
+_template_token_pattern = re.compile('{{([^{}]+)}}')
+# tokens which look like our params, e.g. '{{some-param}}' or '{{sha256:file}}', unlike mustache's
+# '{{service.name}}' or '{{#section}}'
+_template_param_name_pattern = re.compile('^(sha256:.+|[a-z0-9]+(-[a-z0-9]+)+)$')
+
+
+def apply_templating(content, template_mapping):
+    '''Fills in the content's '{{param}}' tokens from the template mapping in a single pass.
+    Returns the new content, {param: replacement count}, and a sorted list of any tokens which look
+    like template params but aren't in the mapping. Other tokens are left as-is.'''
+    used = collections.Counter()
+    unresolved = set()
+    def replace(match):
+        key = match.group(1)
+        value = template_mapping.get(key)
+        if value is None:
+            if _template_param_name_pattern.match(key):
+                unresolved.add(key)
+            return match.group(0)
+        used[key] += 1
+        return value
+    return _template_token_pattern.sub(replace, content), used, sorted(unresolved)
+
+
+# hashlib releases the GIL while hashing large buffers, so artifacts are hashed concurrently
+_HASH_CHUNK_SIZE = 16 * 1024 * 1024
+_MAX_HASH_THREADS = 8
+
+
+def _calculate_sha256(filepath):
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size == 0:
+            # empty files can't be mapped
+            return hasher.hexdigest()
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, size, _HASH_CHUNK_SIZE):
+                    hasher.update(view[offset:offset + _HASH_CHUNK_SIZE])
+    return hasher.hexdigest()
+
+
+def get_sha256s(filepaths, cache=None):
+    '''Returns {filepath: sha256} for the provided files, hashing each distinct file once, in
+    parallel. Files whose sha256 is in the cache (if any) aren't rehashed.'''
+    sha256s = {}
+    to_hash = []
+    for filepath in set(filepaths):
+        sha256 = cache.get_sha256(filepath) if cache else None
+        if sha256:
+            logger.info('Using cached sha256 for unchanged artifact: {}'.format(filepath))
+            sha256s[filepath] = sha256
+        else:
+            to_hash.append(filepath)
+    if not to_hash:
+        return sha256s
+
+    start = time.time()
+    total_bytes = sum(os.path.getsize(filepath) for filepath in to_hash)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(to_hash), _MAX_HASH_THREADS)) as executor:
+        for filepath, sha256 in zip(to_hash, executor.map(_calculate_sha256, to_hash)):
+            sha256s[filepath] = sha256
+            if cache:
+                cache.put_sha256(filepath, sha256)
+    elapsed = time.time() - start
+    logger.info('Hashed {} artifacts ({:.1f} MB) in {:.2f}s: {:.1f} MB/s'.format(
+        len(to_hash), total_bytes / 1000000, elapsed, total_bytes / 1000000 / max(elapsed, 0.001)))
+    return sha256s
+
+
+def _default_cache_dir():
+    return os.environ.get('UNIVERSE_BUILDER_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'dcos-commons', 'universe_builder'))
+
+
+class BuildCache(object):
+    '''Persists work between builds, so that repeated builds in a dev loop only redo what changed:
+    - Artifact sha256s, keyed by the artifact's path, size, mtime and inode. An artifact is only
+      rehashed if any of those have changed.
+    - Generated stub universes, keyed by a hash of everything which went into them. If nothing
+      has changed, the previously generated stub universe is returned as-is.
+    '''
+
+    _SHA256_FILENAME = 'sha256.json'
+    _MAX_UNIVERSES = 20
+
+    def __init__(self, cache_dir=None):
+        self._cache_dir = cache_dir or _default_cache_dir()
+        self._universes_dir = os.path.join(self._cache_dir, 'universes')
+        os.makedirs(self._universes_dir, exist_ok=True)
+        self._sha256_path = os.path.join(self._cache_dir, self._SHA256_FILENAME)
+        try:
+            with open(self._sha256_path) as sha256_file:
+                self._sha256s = json.load(sha256_file)
+        except (IOError, ValueError):
+            self._sha256s = {}
+        self._dirty = False
+        # builds may share a cache across threads (see build_packages)
+        self._lock = threading.Lock()
+
+
+    def _file_key(self, filepath):
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+    def get_sha256(self, filepath):
+        '''Returns the cached sha256 for the file, or None if it isn't cached or the file has changed'''
+        with self._lock:
+            entry = self._sha256s.get(os.path.abspath(filepath))
+        if entry and entry[:3] == self._file_key(filepath):
+            return entry[3]
+        return None
+
+
+    def put_sha256(self, filepath, sha256):
+        entry = self._file_key(filepath) + [sha256]
+        with self._lock:
+            self._sha256s[os.path.abspath(filepath)] = entry
+            self._dirty = True
+
+
+    def get_universe(self, input_hash):
+        '''Returns the path of a copy of a stub universe previously built from identical inputs, or
+        None. Like a freshly built stub universe, the copy is in its own scratch dir, so the caller
+        may modify or remove it, and other builds evicting the cached entry won't affect it.'''
+        universe_dir = os.path.join(self._universes_dir, input_hash)
+        try:
+            filenames = os.listdir(universe_dir)
+        except OSError:
+            return None
+        if len(filenames) != 1:
+            return None
+        scratchdir = tempfile.mkdtemp(prefix='stub-universe-tmp')
+        universe_path = os.path.join(scratchdir, filenames[0])
+        try:
+            shutil.copyfile(os.path.join(universe_dir, filenames[0]), universe_path)
+        except OSError:
+            # evicted by another build in the meantime
+            shutil.rmtree(scratchdir, ignore_errors=True)
+            return None
+        # touch, for eviction
+        try:
+            os.utime(universe_dir)
+        except OSError:
+            pass
+        return universe_path
+
+
+    def put_universe(self, input_hash, universe_path):
+        '''Stores a copy of a newly built stub universe'''
+        universe_dir = os.path.join(self._universes_dir, input_hash)
+        # build in a scratch dir then rename, so that concurrent builds never see a partial entry
+        scratch_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self._universes_dir)
+        cached_path = os.path.join(scratch_dir, os.path.basename(universe_path))
+        shutil.copyfile(universe_path, cached_path)
+        try:
+            os.rename(scratch_dir, universe_dir)
+        except OSError:
+            # another build got there first
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        self._evict()
+
+
+    def _evict(self):
+        entries = [os.path.join(self._universes_dir, name) for name in os.listdir(self._universes_dir)
+                   if not name.startswith('.')]
+        if len(entries) <= self._MAX_UNIVERSES:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self._MAX_UNIVERSES]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # drop entries for files which no longer exist, then write atomically
+            self._sha256s = {path: entry for path, entry in self._sha256s.items() if os.path.exists(path)}
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self._cache_dir)
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(self._sha256s, tmp_file)
+            os.replace(tmp_path, self._sha256_path)
+            self._dirty = False
+
+
+def open_cache():
+    '''Returns the build cache, or None if caching is disabled or the cache can't be used.
+
+    CI builds (WORKSPACE is set) don't use the cache unless UNIVERSE_BUILDER_CACHE_DIR is set
+    explicitly: shared build agents may run several jobs out of the same home directory.'''
+    if os.environ.get('UNIVERSE_BUILDER_CACHE_DISABLE', ''):
+        return None
+    if 'WORKSPACE' in os.environ and not os.environ.get('UNIVERSE_BUILDER_CACHE_DIR', ''):
+        logger.info('Building without the build cache under CI: set UNIVERSE_BUILDER_CACHE_DIR to enable it')
+        return None
+    try:
+        return BuildCache()
+    except OSError as e:
+        logger.warning('Unable to use build cache, building without it: {}'.format(e))
+        return None
+
 
 class UniversePackageBuilder(object):
 
-    def __init__(self, package_name, package_version, input_dir_path, upload_dir_url, artifact_paths, packaging_version=3):
+    def __init__(self, package_name, package_version, input_dir_path, upload_dir_url, artifact_paths, packaging_version=3, cache=None, known_sha256s=None):
         self._cosmos_packaging_version = packaging_version
+        self._cache = cache if cache is not None else open_cache()
+        # {filepath: sha256} of artifacts which have already been hashed, e.g. by build_packages
+        self._known_sha256s = known_sha256s if known_sha256s is not None else {}
         self._pkg_name = package_name
         self._pkg_version = package_version
         self._upload_dir_url = upload_dir_url
@@ -68,21 +283,43 @@ class UniversePackageBuilder(object):
             yield package_filename, open(package_filepath).read()
 
 
-    def _calculate_sha256(self, filepath):
-        BLOCKSIZE = 65536
-        hasher = hashlib.sha256()
-        with open(filepath, 'rb') as fd:
-            buf = fd.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = fd.read(BLOCKSIZE)
-        return hasher.hexdigest()
+    def get_referenced_artifact_paths(self):
+        '''Returns the paths of the artifacts whose sha256s are needed by the package template'''
+        return list(self._get_referenced_artifact_paths(dict(self._iterate_package_files())).values())
+
 
+    def _get_referenced_artifact_paths(self, package_files):
+        '''Returns {filename: filepath} for every '{{sha256:filename}}' template param in the package files'''
+        shafilepaths = {}
+        for content in package_files.values():
+            for shafilename in _sha256_param_pattern.findall(content):
+                shafilepath = self._artifact_file_paths.get(shafilename, '')
+                if not shafilepath:
+                    raise Exception(
+                        'Missing path for artifact file named \'{}\' (to calculate sha256). '.format(shafilename) +
+                        'Please provide the full path to this artifact (known artifacts: {})'.format(self._artifact_file_paths))
+                shafilepaths[shafilename] = shafilepath
+        return shafilepaths
 
-    def _get_template_mapping_for_content(self, orig_content):
+
+    def _get_artifact_sha256s(self, package_files):
+        '''Returns {'sha256:filename': sha256} for every '{{sha256:filename}}' template param in the
+        package files, hashing each referenced artifact once.'''
+        # this avoids calculating shas unless they're requested by the template.
+        shafilepaths = self._get_referenced_artifact_paths(package_files)
+        filepath_sha256s = {path: self._known_sha256s[path] for path in shafilepaths.values()
+                            if path in self._known_sha256s}
+        filepath_sha256s.update(get_sha256s(
+            [path for path in shafilepaths.values() if path not in filepath_sha256s], self._cache))
+        # somefile.txt => sha256:somefile.txt
+        return {'sha256:{}'.format(shafilename): filepath_sha256s[shafilepath]
+                for shafilename, shafilepath in shafilepaths.items()}
+
+
+    def _get_template_mapping(self, artifact_sha256s):
         '''Returns a template mapping (dict) for the following cases:
         - Default params like '{{package-version}}' and '{{artifact-dir}}'
-        - SHA256 params like '{{sha256:artifact.zip}}' (requires user-provided paths to artifact files)
+        - SHA256 params like '{{sha256:artifact.zip}}' (see _get_artifact_sha256s)
         - Custom environment params like 'TEMPLATE_SOME_PARAM' which maps to '{{some-param}}'
         '''
         # default template values (may be overridden via eg TEMPLATE_PACKAGE_VERSION envvars):
@@ -93,16 +330,7 @@ class UniversePackageBuilder(object):
             'jre-jce-unlimited-url': _jre_jce_unlimited_url,
             'libmesos-bundle-url': _libmesos_bundle_url}
 
-        # look for any 'sha256:filename' template params, and get shas for those.
-        # this avoids calculating shas unless they're requested by the template.
-        for shafilename in re.findall('{{sha256:(.+?)}}', orig_content):
-            # somefile.txt => sha256:somefile.txt
-            shafilepath = self._artifact_file_paths.get(shafilename, '')
-            if not shafilepath:
-                raise Exception(
-                    'Missing path for artifact file named \'{}\' (to calculate sha256). '.format(shafilename) +
-                    'Please provide the full path to this artifact (known artifacts: {})'.format(self._artifact_file_paths))
-            template_mapping['sha256:{}'.format(shafilename)] = self._calculate_sha256(shafilepath)
+        template_mapping.update(artifact_sha256s)
 
         # import any custom TEMPLATE_SOME_PARAM environment variables:
         for env_key, env_val in os.environ.items():
@@ -113,24 +341,25 @@ class UniversePackageBuilder(object):
         return template_mapping
 
 
-    def _apply_templating_to_file(self, filename, orig_content):
-        template_mapping = self._get_template_mapping_for_content(orig_content)
-        new_content = orig_content
-        for template_key, template_val in template_mapping.items():
-            new_content = new_content.replace('{{%s}}' % template_key, template_val)
-        if orig_content == new_content:
+    def _apply_templating_to_file(self, filename, orig_content, template_mapping):
+        new_content, used, unresolved = apply_templating(orig_content, template_mapping)
+        for key in unresolved:
+            logger.warning('Unresolved template param in {}: {{{{{}}}}} (no default or TEMPLATE_{} envvar)'.format(
+                filename, key, key.upper().replace('-', '_')))
+        if not used:
             logger.info('')
             logger.info('No templating detected in {}, leaving file as-is'.format(filename))
             return orig_content
         logger.info('')
         logger.info('Applied templating changes to {}:'.format(filename))
         logger.info('Template params used:')
-        template_keys = list(template_mapping.keys())
-        template_keys.sort()
-        for key in template_keys:
-            logger.info('  {{%s}} => %s' % (key, template_mapping[key]))
-        logger.info('Resulting diff:')
-        logger.info('\n'.join(difflib.ndiff(orig_content.split('\n'), new_content.split('\n'))))
+        for key in sorted(used.keys()):
+            logger.info('  {{%s}} => %s (x%d)' % (key, template_mapping[key], used[key]))
+        if os.environ.get('UNIVERSE_BUILDER_DIFF', ''):
+            logger.info('Resulting diff:')
+            logger.info('\n'.join(difflib.unified_diff(
+                orig_content.split('\n'), new_content.split('\n'),
+                fromfile=filename, tofile=filename, n=0, lineterm='')))
         return new_content
 
 
@@ -159,19 +388,61 @@ class UniversePackageBuilder(object):
         return {'packages': [package_json]}
 
 
+    def _get_input_hash(self, package_files, template_mapping):
+        '''Returns a hash of everything which goes into the stub universe, for use as a cache key'''
+        hasher = hashlib.sha256()
+        def add(value):
+            data = value.encode('utf-8')
+            # length-prefixed, so that different inputs can't run together into the same bytes
+            hasher.update(str(len(data)).encode('utf-8') + b':' + data)
+        add(self._pkg_name)
+        add(str(self._cosmos_packaging_version))
+        for filename in sorted(package_files.keys()):
+            add(filename)
+            add(package_files[filename])
+        for key in sorted(template_mapping.keys()):
+            add(key)
+            add(template_mapping[key])
+        return hasher.hexdigest()
+
+
     def build_package(self):
         '''builds a stub universe json package and returns its location on disk'''
-
-        # read files into memory and apply templating to files:
+        try:
+            return self._build_package()
+        finally:
+            if self._cache:
+                self._cache.save()
+
+
+    def _build_package(self):
+        # read files into memory, and collect the params for templating them:
+        package_files = dict(self._iterate_package_files())
+        template_mapping = self._get_template_mapping(self._get_artifact_sha256s(package_files))
+
+        if self._cache:
+            input_hash = self._get_input_hash(package_files, template_mapping)
+            cached_path = self._cache.get_universe(input_hash)
+            if cached_path:
+                logger.info('')
+                logger.info('Package inputs are unchanged, reusing stub universe: {}'.format(cached_path))
+                return cached_path
+
+        # apply templating to files:
         updated_package_files = {}
-        for filename, content in self._iterate_package_files():
-            updated_package_files[filename] = self._apply_templating_to_file(filename, content)
+        for filename, content in package_files.items():
+            updated_package_files[filename] = self._apply_templating_to_file(filename, content, template_mapping)
         scratchdir = tempfile.mkdtemp(prefix='stub-universe-tmp')
         jsonpath = os.path.join(scratchdir, 'stub-universe-{}.json'.format(self._pkg_name))
         jsonfile = open(jsonpath, 'w')
         jsonfile.write(json.dumps(self._generate_packages_dict(updated_package_files), indent=2))
         jsonfile.flush()
         jsonfile.close()
+        if self._cache:
+            try:
+                self._cache.put_universe(input_hash, jsonpath)
+            except OSError as e:
+                logger.warning('Unable to cache stub universe: {}'.format(e))
         return jsonpath
 
 
@@ -181,13 +452,101 @@ class UniversePackageBuilder(object):
             self._cosmos_packaging_version)
 
 
+def build_packages(package_specs, combined_name='combined', cache=None, max_workers=4):
+    '''Builds several stub universe packages in one go, given a list of dicts with the
+    UniversePackageBuilder arguments: 'name', 'version', 'template-dir', 'upload-dir-url' and
+    'artifacts'. Artifacts are hashed once across all of the packages, then the packages are
+    generated in parallel.
+
+    Returns the path of a combined stub universe containing all of the packages, and
+    {package name: path} of each package's own stub universe.'''
+    if cache is None:
+        cache = open_cache()
+    # filled in below, once every package's referenced artifacts are known
+    known_sha256s = {}
+    builders = collections.OrderedDict()
+    for spec in package_specs:
+        if spec['name'] in builders:
+            raise Exception('Duplicate package name in batch: {}'.format(spec['name']))
+        builders[spec['name']] = UniversePackageBuilder(
+            spec['name'], spec['version'], spec['template-dir'].rstrip('/'),
+            spec['upload-dir-url'].rstrip('/'), spec.get('artifacts', []),
+            cache=cache, known_sha256s=known_sha256s)
+
+    # hash everything up front, so that artifacts shared between packages are only hashed once
+    artifact_paths = []
+    for builder in builders.values():
+        artifact_paths.extend(builder.get_referenced_artifact_paths())
+    known_sha256s.update(get_sha256s(artifact_paths, cache))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = collections.OrderedDict(
+            (name, executor.submit(builder.build_package)) for name, builder in builders.items())
+        package_paths = collections.OrderedDict(
+            (name, future.result()) for name, future in futures.items())
+
+    combined_packages = []
+    for package_path in package_paths.values():
+        with open(package_path) as package_file:
+            combined_packages.extend(
+                json.load(package_file, object_pairs_hook=collections.OrderedDict)['packages'])
+    scratchdir = tempfile.mkdtemp(prefix='stub-universe-tmp')
+    combined_path = os.path.join(scratchdir, 'stub-universe-{}.json'.format(combined_name))
+    with open(combined_path, 'w') as combined_file:
+        combined_file.write(json.dumps({'packages': combined_packages}, indent=2))
+    return combined_path, package_paths
+
+
+def _read_manifest(manifest_path):
+    '''Returns (combined name, package specs) from a batch manifest, with relative paths resolved
+    against the manifest's directory. Package specs may omit 'upload-dir-url' if the manifest
+    provides a default.'''
+    with open(manifest_path) as manifest_file:
+        try:
+            manifest = json.load(manifest_file)
+        except ValueError as e:
+            raise Exception('Invalid JSON in manifest {}: {}'.format(manifest_path, e))
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('packages'), list):
+        raise Exception('Manifest {} must be an object with a "packages" list'.format(manifest_path))
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    package_specs = []
+    package_names = set()
+    for index, spec in enumerate(manifest['packages']):
+        if not isinstance(spec, dict):
+            raise Exception('Manifest {} package #{} is not an object: {}'.format(manifest_path, index, spec))
+        missing_keys = [key for key in ('name', 'version', 'template-dir') if not spec.get(key)]
+        if missing_keys:
+            raise Exception('Manifest {} package #{} is missing {}: {}'.format(
+                manifest_path, index, ', '.join(missing_keys), spec))
+        if spec['name'] in package_names:
+            raise Exception('Duplicate package name in manifest {}: {}'.format(manifest_path, spec['name']))
+        package_names.add(spec['name'])
+        spec = dict(spec)
+        spec.setdefault('upload-dir-url', manifest.get('upload-dir-url', ''))
+        spec['template-dir'] = os.path.join(manifest_dir, spec['template-dir'])
+        spec['artifacts'] = [os.path.join(manifest_dir, path) for path in spec.get('artifacts', [])]
+        package_specs.append(spec)
+    return manifest.get('name', 'combined'), package_specs
+
+
 def print_help(argv):
     logger.info('Syntax: {} <package-name> <package-version> <template-package-dir> <artifact-base-path> [artifact files ...]'.format(argv[0]))
     logger.info('  Example: $ {} kafka 1.2.3-4.5.6 /path/to/template/jsons/ https://example.com/path/to/kafka-artifacts /path/to/artifact1.zip /path/to/artifact2.zip /path/to/artifact3.zip'.format(argv[0]))
     logger.info('In addition, environment variables named \'TEMPLATE_SOME_PARAMETER\' will be inserted against the provided package template (with params of the form \'{{some-parameter}}\')')
+    logger.info('Batch syntax: {} --manifest <manifest.json>'.format(argv[0]))
 
 
 def main(argv):
+    if len(argv) == 3 and argv[1] == '--manifest':
+        combined_name, package_specs = _read_manifest(argv[2])
+        logger.info('###\nBatch:           {} ({} packages)\n###'.format(
+            combined_name, len(package_specs)))
+        combined_path, package_paths = build_packages(package_specs, combined_name)
+        logger.info('---')
+        logger.info('Built stub universe packages:')
+        # print the package locations as stdout (the rest of the file is stderr):
+        print(json.dumps({'combined': combined_path, 'packages': package_paths}, indent=2))
+        return 0
     if len(argv) < 5:
         print_help(argv)
         return 1
@@ -219,5 +578,170 @@ Artifacts:       {}
     return 0
 
 
+class tests(unittest.TestCase):
+    # run with: python3 -m unittest universe_builder
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix='universe-builder-')
+        self.cache_dir = os.path.join(self.test_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, filename, content):
+        path = os.path.join(self.test_dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_apply_templating(self):
+        content, used, unresolved = apply_templating(
+            '{"url": "{{artifact-dir}}/a.zip", "sha": "{{sha256:a.zip}}", "b": "{{artifact-dir}}/b.zip"}',
+            {'artifact-dir': 'https://example.com/1.0', 'sha256:a.zip': 'abc'})
+        self.assertEqual(content, '{"url": "https://example.com/1.0/a.zip", "sha": "abc", "b": "https://example.com/1.0/b.zip"}')
+        self.assertEqual(used, {'artifact-dir': 2, 'sha256:a.zip': 1})
+        self.assertEqual(unresolved, [])
+
+    def test_apply_templating_single_pass(self):
+        # replacements which themselves look like params aren't templated again
+        content, used, _ = apply_templating('{{package-version}}', {'package-version': '{{other-param}}', 'other-param': 'x'})
+        self.assertEqual(content, '{{other-param}}')
+        self.assertEqual(used, {'package-version': 1})
+
+    def test_apply_templating_unresolved(self):
+        content, used, unresolved = apply_templating(
+            '{{service.name}} {{#tls}}{{/tls}} {{missing-param}} {{sha256:missing.zip}} {{missing-param}} {{upgrades-from}}',
+            {'upgrades-from': '1.0'})
+        # mustache tokens are left for install time, and aren't reported:
+        self.assertEqual(content, '{{service.name}} {{#tls}}{{/tls}} {{missing-param}} {{sha256:missing.zip}} {{missing-param}} 1.0')
+        self.assertEqual(used, {'upgrades-from': 1})
+        self.assertEqual(unresolved, ['missing-param', 'sha256:missing.zip'])
+
+    def test_cache_off_under_ci_unless_dir_set(self):
+        saved_env = dict(os.environ)
+        try:
+            os.environ.pop('UNIVERSE_BUILDER_CACHE_DISABLE', None)
+            os.environ['WORKSPACE'] = self.test_dir
+            os.environ.pop('UNIVERSE_BUILDER_CACHE_DIR', None)
+            self.assertIsNone(open_cache())
+            os.environ['UNIVERSE_BUILDER_CACHE_DIR'] = self.cache_dir
+            self.assertIsNotNone(open_cache())
+            os.environ['UNIVERSE_BUILDER_CACHE_DISABLE'] = 'true'
+            self.assertIsNone(open_cache())
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+    def _write_template(self, dirname, package_name):
+        os.makedirs(os.path.join(self.test_dir, dirname))
+        self._write(os.path.join(dirname, 'package.json'), json.dumps({'name': package_name, 'version': '{{package-version}}'}))
+        self._write(os.path.join(dirname, 'resource.json'), json.dumps(
+            {'url': '{{artifact-dir}}/shared.zip', 'sha256': '{{sha256:shared.zip}}'}))
+
+    def test_read_manifest(self):
+        manifest_path = self._write('manifest.json', json.dumps({
+            'name': 'batch',
+            'upload-dir-url': 'https://example.com/default',
+            'packages': [
+                {'name': 'a', 'version': '1.0', 'template-dir': 'a/', 'artifacts': ['build/a.zip']},
+                {'name': 'b', 'version': '2.0', 'template-dir': 'b/', 'upload-dir-url': 'https://example.com/b'}]}))
+        combined_name, specs = _read_manifest(manifest_path)
+        self.assertEqual(combined_name, 'batch')
+        self.assertEqual([spec['name'] for spec in specs], ['a', 'b'])
+        self.assertEqual(specs[0]['template-dir'], os.path.join(self.test_dir, 'a/'))
+        self.assertEqual(specs[0]['artifacts'], [os.path.join(self.test_dir, 'build/a.zip')])
+        self.assertEqual(specs[0]['upload-dir-url'], 'https://example.com/default')
+        self.assertEqual(specs[1]['upload-dir-url'], 'https://example.com/b')
+        self.assertEqual(specs[1]['artifacts'], [])
+
+    def test_read_manifest_rejects_bad_entries(self):
+        bad_manifests = {
+            'not json': '{"packages": [',
+            'no packages': '{"name": "batch"}',
+            'not an object': '{"packages": ["a"]}',
+            'missing version': '{"packages": [{"name": "a", "template-dir": "a/"}]}',
+            'duplicate': json.dumps({'packages': [
+                {'name': 'a', 'version': '1.0', 'template-dir': 'a/'},
+                {'name': 'a', 'version': '2.0', 'template-dir': 'a2/'}]})}
+        for description, content in bad_manifests.items():
+            manifest_path = self._write('manifest.json', content)
+            with self.assertRaises(Exception, msg=description) as context:
+                _read_manifest(manifest_path)
+            self.assertIn(manifest_path, str(context.exception))
+
+    def test_build_packages(self):
+        self._write_template('a', 'a')
+        self._write_template('b', 'b')
+        artifact_path = self._write('shared.zip', 'content')
+        combined_path, package_paths = build_packages([
+            {'name': 'a', 'version': '1.0', 'template-dir': os.path.join(self.test_dir, 'a'),
+             'upload-dir-url': 'https://example.com/a/', 'artifacts': [artifact_path]},
+            {'name': 'b', 'version': '2.0', 'template-dir': os.path.join(self.test_dir, 'b'),
+             'upload-dir-url': 'https://example.com/b', 'artifacts': [artifact_path]}],
+            'batch', cache=BuildCache(self.cache_dir))
+        try:
+            self.assertEqual(os.path.basename(combined_path), 'stub-universe-batch.json')
+            self.assertEqual(list(package_paths.keys()), ['a', 'b'])
+            with open(combined_path) as f:
+                packages = json.load(f)['packages']
+            self.assertEqual([(p['name'], p['version']) for p in packages], [('a', '1.0'), ('b', '2.0')])
+            sha256 = hashlib.sha256(b'content').hexdigest()
+            self.assertEqual(packages[0]['resource'], {'url': 'https://example.com/a/shared.zip', 'sha256': sha256})
+            self.assertEqual(packages[1]['resource'], {'url': 'https://example.com/b/shared.zip', 'sha256': sha256})
+            with open(package_paths['b']) as f:
+                self.assertEqual(json.load(f)['packages'], packages[1:])
+        finally:
+            for path in [combined_path] + list(package_paths.values()):
+                shutil.rmtree(os.path.dirname(path))
+
+    def test_build_packages_rejects_duplicate_names(self):
+        self._write_template('a', 'a')
+        spec = {'name': 'a', 'version': '1.0', 'template-dir': os.path.join(self.test_dir, 'a'), 'upload-dir-url': ''}
+        with self.assertRaises(Exception):
+            build_packages([spec, dict(spec)], cache=BuildCache(self.cache_dir))
+
+    def test_cache_returns_private_universe_copies(self):
+        cache = BuildCache(self.cache_dir)
+        self.assertIsNone(cache.get_universe('abc'))
+        cache.put_universe('abc', self._write('stub-universe-hello.json', '{"packages": []}'))
+        first = cache.get_universe('abc')
+        second = cache.get_universe('abc')
+        self.assertNotEqual(first, second)
+        for path in (first, second):
+            self.assertEqual(os.path.basename(path), 'stub-universe-hello.json')
+            self.assertFalse(path.startswith(self.cache_dir))
+        # the caller may do what it likes with its copy:
+        shutil.rmtree(os.path.dirname(first))
+        with open(second) as f:
+            self.assertEqual(f.read(), '{"packages": []}')
+        shutil.rmtree(os.path.dirname(second))
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'universes', 'abc')), ['stub-universe-hello.json'])
+
+    def test_cache_evicts_oldest_universes(self):
+        cache = BuildCache(self.cache_dir)
+        universe_path = self._write('stub-universe.json', '{}')
+        for i in range(BuildCache._MAX_UNIVERSES + 1):
+            cache.put_universe(str(i), universe_path)
+            os.utime(os.path.join(self.cache_dir, 'universes', str(i)), (i, i))
+        cache.put_universe('new', universe_path)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'universes'))), BuildCache._MAX_UNIVERSES)
+        self.assertIsNone(cache.get_universe('0'))
+        self.assertIsNone(cache.get_universe('1'))
+        new_path = cache.get_universe('new')
+        self.assertIsNotNone(new_path)
+        shutil.rmtree(os.path.dirname(new_path))
+
+    def test_cache_sha256s(self):
+        cache = BuildCache(self.cache_dir)
+        artifact_path = self._write('artifact.zip', 'content')
+        self.assertIsNone(cache.get_sha256(artifact_path))
+        cache.put_sha256(artifact_path, 'abc')
+        cache.save()
+        self.assertEqual(BuildCache(self.cache_dir).get_sha256(artifact_path), 'abc')
+        # rewritten with a different size:
+        self._write('artifact.zip', 'new content')
+        self.assertIsNone(cache.get_sha256(artifact_path))
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))